@@ -0,0 +1,53 @@
+"""Benchmark the power allocators.
+
+Run from solar-control-dev/:  python benchmarks/bench_allocation.py
+Prints solve time and power used for greedy vs optimal allocation over
+random device mixes (a third variable-amperage) of 5, 50 and 500 devices.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rootfs', 'usr', 'bin'))
+
+from allocation import Candidate, GreedyAllocator, OptimalAllocator, Option  # noqa: E402
+
+VOLTAGE = 230.0
+RUNS = 5
+
+
+def random_candidates(count, rng):
+    candidates = []
+    for i in range(count):
+        if rng.random() < 1 / 3:
+            low, high = rng.choice([(6, 16), (6, 32), (8, 25)])
+            options = [Option(VOLTAGE * a, a, VOLTAGE * a) for a in range(low, high + 1)]
+        else:
+            options = [Option(float(rng.randrange(100, 3500, 50)))]
+        candidates.append(Candidate(f"device_{i}", i, options))
+    return candidates
+
+
+def bench(allocator, candidates, budget):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        chosen = allocator.allocate(candidates, budget)
+    elapsed = (time.perf_counter() - start) / RUNS
+    return elapsed, sum(option.power for option in chosen.values())
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'devices':>8} {'budget W':>9} {'strategy':>9} {'ms':>9} {'used W':>9}")
+    for count in (5, 50, 500):
+        candidates = random_candidates(count, rng)
+        budget = min(20000.0, 600.0 * count)
+        for allocator in (GreedyAllocator(), OptimalAllocator()):
+            elapsed, used = bench(allocator, candidates, budget)
+            print(f"{count:>8} {budget:>9.0f} {allocator.name:>9} {elapsed * 1000:>9.2f} {used:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark control-phase bookkeeping as the device count grows.
+
+Run from solar-control-dev/:  python benchmarks/bench_plan.py
+Times free mode plus applying the plan (actuation itself is a no-op) for
+100 to 4000 devices, each already planned by Phase 1. Time per device should
+stay flat - i.e. the phases scale linearly.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'rootfs', 'usr', 'bin'))
+
+from allocation import AllocationPlan  # noqa: E402
+from device import Device  # noqa: E402
+from solar_controller import DebugState, DeviceState, SolarController  # noqa: E402
+
+RUNS = 5
+
+
+def make_controller(count, directory):
+    config_file = os.path.join(directory, 'solar_config.json')
+    devices_file = os.path.join(directory, 'devices.json')
+    with open(config_file, 'w') as f:
+        json.dump({}, f)
+    with open(devices_file, 'w') as f:
+        json.dump([], f)
+    controller = SolarController(config_file=config_file, devices_file=devices_file)
+    controller.debug_state = DebugState(timestamp=None, available_power=0, grid_voltage=230.0, grid_power=0)
+    for i in range(count):
+        device = Device(name=f'device_{i}', switch_entity=f'switch.device_{i}', typical_power_draw=1000.0, order=i)
+        controller.device_states[device.name] = DeviceState(device=device, is_on=i % 2 == 0)
+    return controller
+
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as directory:
+        controller = make_controller(count, directory)
+        with patch.object(controller, 'set_device_state'):
+            start = time.perf_counter()
+            for _ in range(RUNS):
+                plan = AllocationPlan()
+                for device_state in controller.device_states.values():
+                    plan.set(device_state, 1000.0)
+                controller._run_free_mode(230.0, plan)
+                controller._apply_state_changes(plan)
+            return (time.perf_counter() - start) / RUNS
+
+
+def main():
+    logging.disable(logging.INFO)
+    print(f"{'devices':>8} {'ms':>9} {'us/device':>10}")
+    for count in (100, 500, 1000, 2000, 4000):
+        elapsed = bench(count)
+        print(f"{count:>8} {elapsed * 1000:>9.2f} {elapsed / count * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Benchmark a whole control loop pass by replaying a cassette.
+
+Run from solar-control-dev/:  python benchmarks/bench_replay.py [CASSETTE]
+Replays a recorded pass (from the debug page's "Record a pass") on a fresh
+controller each time, with HA answered from the cassette, and prints pass
+latency. Without a cassette it records a midday pass of the simulator's
+default house first. The work per pass is identical, so compare the numbers
+before and after a change.
+"""
+
+import logging
+import os
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from simulator import default_scenario  # noqa: E402  (also puts rootfs/usr/bin on the path)
+from cassette import Cassette  # noqa: E402
+from simulator.replay import record_scenario, replay  # noqa: E402
+
+PASSES = 200
+
+
+def main():
+    logging.disable(logging.WARNING)
+    if len(sys.argv) > 1:
+        cassette = Cassette.load(sys.argv[1])
+    else:
+        scenario = default_scenario()
+        cassette = record_scenario(scenario, scenario.start + timedelta(hours=12))
+    replay(cassette, passes=10)  # warm up imports and caches
+    print(replay(cassette, passes=PASSES).report())
+
+
+if __name__ == '__main__':
+    main()
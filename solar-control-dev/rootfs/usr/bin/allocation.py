@@ -0,0 +1,332 @@
+"""Allocation of surplus solar power to optional devices.
+
+Solar control first reserves power for mandatory devices (Phase 1), then has
+to decide which optional devices to run - and at what amperage - within the
+remaining budget. Each device is a Candidate with one or more Options (a
+fixed-power device has one; a variable-amperage device has one per amperage
+step). An allocator picks at most one option per candidate.
+
+- GreedyAllocator: walks devices in priority order and gives each the
+  largest option that still fits. This is the original behaviour.
+- OptimalAllocator: exact multiple-choice knapsack by dynamic programming
+  over power quantized to QUANTUM_W, maximising the priority-weighted power
+  put to use. A large early device that doesn't fit no longer leaves the
+  budget to a small later one when a better combination exists. Its run
+  time is bounded: the quantum is coarsened to keep the table small, and it
+  falls back to greedy if it still runs over its time limit.
+
+Once the set of devices is known, water_fill() shares the current between
+all the variable-amperage devices being run in one pass, so a second EV
+charger or heat pump isn't starved by the first.
+"""
+
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUANTUM_W = 50                  # DP power resolution
+MAX_DP_OPERATIONS = 1_000_000   # table size bound; the quantum is coarsened to stay under it
+TIME_LIMIT_S = 0.25             # fall back to greedy beyond this
+PRIORITY_BIAS = 0.1             # top-priority watts are worth this much more than the lowest's
+
+
+@dataclass(frozen=True)
+class Option:
+    """One way to run a device."""
+    power: float                 # W charged to the budget
+    amperage: Optional[float] = None
+    nominal_power: Optional[float] = None  # W at this amperage (voltage x amps); defaults to power
+
+    @property
+    def nominal(self) -> float:
+        return self.power if self.nominal_power is None else self.nominal_power
+
+
+@dataclass
+class Candidate:
+    """An optional device the allocator may turn on."""
+    name: str
+    priority: int                # lower runs first (device.order)
+    options: List[Option]        # ascending nominal power
+
+
+class GreedyAllocator:
+    """Priority order, largest option that fits."""
+
+    name = 'greedy'
+
+    def allocate(self, candidates: List[Candidate], available_power: float) -> Dict[str, Option]:
+        chosen = {}
+        for candidate in sorted(candidates, key=lambda c: c.priority):
+            option = self._largest_fitting(candidate, available_power)
+            if option is not None and option.power <= available_power:
+                chosen[candidate.name] = option
+                available_power -= option.power
+        return chosen
+
+    @staticmethod
+    def _largest_fitting(candidate: Candidate, available_power: float) -> Optional[Option]:
+        """Largest option whose nominal power fits, else the smallest option
+        (mirrors flooring amperage to the budget, clamped to min_amperage)."""
+        if not candidate.options:
+            return None
+        fitting = [o for o in candidate.options if o.nominal <= available_power]
+        return fitting[-1] if fitting else candidate.options[0]
+
+
+class OptimalAllocator:
+    """Exact, time-bounded multiple-choice knapsack over quantized watts."""
+
+    name = 'optimal'
+
+    def __init__(self, quantum_w: float = QUANTUM_W, max_operations: int = MAX_DP_OPERATIONS,
+                 time_limit_s: float = TIME_LIMIT_S):
+        self.quantum_w = quantum_w
+        self.max_operations = max_operations
+        self.time_limit_s = time_limit_s
+        self.fallback = GreedyAllocator()
+
+    def allocate(self, candidates: List[Candidate], available_power: float) -> Dict[str, Option]:
+        if not candidates or available_power < 0:
+            return {}
+        if math.isinf(available_power):
+            return self.fallback.allocate(candidates, available_power)
+        try:
+            return self._solve(sorted(candidates, key=lambda c: c.priority), available_power)
+        except TimeoutError:
+            logger.warning(f"Optimal allocation of {len(candidates)} devices exceeded "
+                           f"{self.time_limit_s}s - falling back to greedy")
+            return self.fallback.allocate(candidates, available_power)
+
+    def _solve(self, candidates: List[Candidate], available_power: float) -> Dict[str, Option]:
+        deadline = time.perf_counter() + self.time_limit_s
+        n = len(candidates)
+        total_options = sum(len(c.options) for c in candidates)
+
+        quantum = self.quantum_w
+        while total_options * (available_power // quantum + 1) > self.max_operations:
+            quantum *= 2
+        capacity = int(available_power // quantum)
+
+        # Items: (weight in quanta, value) per usable option. Ceil the weight so
+        # any chosen set is guaranteed to fit the real budget.
+        items = []
+        for rank, candidate in enumerate(candidates):
+            weight = 1 + PRIORITY_BIAS * (n - 1 - rank) / (n - 1) if n > 1 else 1.0
+            usable = []
+            for option in candidate.options:
+                if option.nominal > available_power and option is not candidate.options[0]:
+                    continue  # don't command more than the whole budget
+                cost = math.ceil(option.power / quantum) if option.power > 0 else 0
+                if cost <= capacity:
+                    # Tiny nominal-power term: among equal budget use, prefer
+                    # running a device (and at the higher amperage)
+                    usable.append((cost, weight * (option.power + 0.001 * option.nominal), option))
+            items.append(usable)
+
+        # best[c]: max value with total cost <= c
+        best = [0.0] * (capacity + 1)
+        choices = []
+        for usable in items:
+            if time.perf_counter() > deadline:
+                raise TimeoutError
+            new_best = best[:]
+            choice = [None] * (capacity + 1)
+            for cost, value, option in usable:
+                for c in range(cost, capacity + 1):
+                    candidate_value = best[c - cost] + value
+                    if candidate_value > new_best[c]:
+                        new_best[c] = candidate_value
+                        choice[c] = (cost, option)
+            best = new_best
+            choices.append(choice)
+
+        chosen = {}
+        c = capacity
+        for candidate, choice in zip(reversed(candidates), reversed(choices)):
+            picked = choice[c]
+            if picked is not None:
+                cost, option = picked
+                chosen[candidate.name] = option
+                c -= cost
+        return chosen
+
+
+ALLOCATORS = {
+    GreedyAllocator.name: GreedyAllocator,
+    OptimalAllocator.name: OptimalAllocator,
+}
+DEFAULT_ALLOCATOR = OptimalAllocator.name
+
+
+def get_allocator(name: Optional[str] = None):
+    """Return an allocator by name ('optimal' or 'greedy'); unknown names get the default."""
+    allocator_class = ALLOCATORS.get(name or DEFAULT_ALLOCATOR)
+    if allocator_class is None:
+        logger.warning(f"Unknown allocation strategy '{name}' - using {DEFAULT_ALLOCATOR}")
+        allocator_class = ALLOCATORS[DEFAULT_ALLOCATOR]
+    return allocator_class()
+
+
+# ---------------------------------------------------------------------------
+# Sharing current between variable-amperage devices
+# ---------------------------------------------------------------------------
+
+WATER_FILL_PRIORITY_BIAS = 0.5  # the top device's share is this much larger than the lowest's
+
+
+@dataclass(frozen=True)
+class AmperageDemand:
+    """A variable-amperage device taking part in water-filling."""
+    name: str
+    min_amperage: float
+    max_amperage: float
+    watts_per_amp: float
+    weight: float = 1.0
+    step: float = 1.0
+    mandatory: bool = False      # kept at min_amperage even if the budget is short
+
+
+def share_weight(rank: int, count: int) -> float:
+    """Water-filling weight for the device at priority rank (0 = highest) of count."""
+    if count <= 1:
+        return 1.0
+    return 1 + WATER_FILL_PRIORITY_BIAS * (count - 1 - rank) / (count - 1)
+
+
+def _snap_down(amperage: float, demand: AmperageDemand) -> float:
+    """Round down onto the entity's step grid, never below min_amperage."""
+    if demand.step and demand.step > 0:
+        amperage = math.floor(amperage / demand.step + 1e-9) * demand.step
+    return max(demand.min_amperage, min(demand.max_amperage, amperage))
+
+
+def water_fill(demands: List[AmperageDemand], available_power: float) -> Dict[str, float]:
+    """Share available_power as current across variable-amperage devices.
+
+    Every device gets the same current per unit of weight (the "water
+    level"), clamped to its min/max amperage, so later devices aren't starved
+    by earlier ones. Devices that can't be given min_amperage are dropped,
+    lowest weight first (mandatory ones are always kept). Amperages are then
+    rounded down to each entity's step, and the power freed by rounding is
+    handed out a step at a time to the device furthest below its share.
+
+    Returns:
+        Device name -> amperage for every device that runs; dropped devices
+        are absent.
+    """
+    active = sorted(demands, key=lambda d: (not d.mandatory, -d.weight))
+    while active and sum(d.min_amperage * d.watts_per_amp for d in active) > available_power:
+        if active[-1].mandatory:
+            break
+        active.pop()
+    if not active:
+        return {}
+
+    def power_at(level):
+        return sum(max(d.min_amperage, min(d.max_amperage, d.weight * level)) * d.watts_per_amp
+                   for d in active)
+
+    high = max(d.max_amperage / d.weight for d in active)
+    if power_at(high) <= available_power:
+        level = high
+    else:
+        low = 0.0
+        for _ in range(60):
+            mid = (low + high) / 2
+            if power_at(mid) <= available_power:
+                low = mid
+            else:
+                high = mid
+        level = low
+
+    amperages = {d.name: _snap_down(d.weight * level, d) for d in active}
+    remaining = available_power - sum(amperages[d.name] * d.watts_per_amp for d in active)
+    while True:
+        growable = [d for d in active
+                    if d.step > 0 and amperages[d.name] + d.step <= d.max_amperage + 1e-9
+                    and d.step * d.watts_per_amp <= remaining + 1e-9]
+        if not growable:
+            break
+        demand = min(growable, key=lambda d: amperages[d.name] / d.weight)
+        amperages[demand.name] += demand.step
+        remaining -= demand.step * demand.watts_per_amp
+    return amperages
+
+
+# ---------------------------------------------------------------------------
+# The plan built up by the control phases
+# ---------------------------------------------------------------------------
+
+class PlanEntry:
+    """A device to run this pass, at a budgeted power and optional amperage.
+
+    Unpacks like the (device_state, power, amperage) tuples it replaces."""
+
+    __slots__ = ('device_state', 'power', 'amperage')
+
+    def __init__(self, device_state, power: float, amperage: Optional[float] = None):
+        self.device_state = device_state
+        self.power = power
+        self.amperage = amperage
+
+    def __iter__(self):
+        yield self.device_state
+        yield self.power
+        yield self.amperage
+
+    def __repr__(self):
+        return f"PlanEntry({self.device_state.device.name!r}, {self.power!r}, {self.amperage!r})"
+
+
+class AllocationPlan:
+    """The devices to turn on this pass, keyed by device name.
+
+    Membership, lookup, update and removal are O(1); iteration yields
+    PlanEntry objects in the order devices were first added (mandatory
+    devices first, then optional ones by priority).
+    """
+
+    __slots__ = ('_entries',)
+
+    def __init__(self):
+        self._entries: Dict[str, PlanEntry] = {}
+
+    @staticmethod
+    def _name(key) -> str:
+        return key if isinstance(key, str) else key.device.name
+
+    def set(self, device_state, power: float, amperage: Optional[float] = None) -> PlanEntry:
+        """Add a device, or update it in place if it's already planned."""
+        entry = self._entries.get(device_state.device.name)
+        if entry is None:
+            entry = self._entries[device_state.device.name] = PlanEntry(device_state, power, amperage)
+        else:
+            entry.device_state, entry.power, entry.amperage = device_state, power, amperage
+        return entry
+
+    def get(self, key) -> Optional[PlanEntry]:
+        """The entry for a device name or DeviceState, or None."""
+        return self._entries.get(self._name(key))
+
+    def remove(self, key) -> Optional[PlanEntry]:
+        return self._entries.pop(self._name(key), None)
+
+    def names(self):
+        return self._entries.keys()
+
+    def __contains__(self, key) -> bool:
+        return self._name(key) in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self):
+        return f"AllocationPlan({list(self._entries.values())!r})"
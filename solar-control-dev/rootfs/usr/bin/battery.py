@@ -1,10 +1,16 @@
 import json
 import os
 import logging
-from typing import Optional
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from config_store import JsonFileStore, invalidate, validate_object
 
 logger = logging.getLogger(__name__)
 
+# One cached store per battery.json path
+_stores: Dict[str, JsonFileStore] = {}
+
 class Battery:
     def __init__(self, 
                  size_kwh: float,
@@ -49,19 +55,24 @@ class Battery:
             bring_forward_mode=data.get('bring_forward_mode', False)  # Default to False for backward compatibility
         )
 
+    @staticmethod
+    def validate(data) -> dict:
+        """Check battery.json holds the fields from_dict needs."""
+        data = validate_object(data)
+        for key in ('size_kwh', 'battery_percent_entity'):
+            if key not in data:
+                raise ValueError(f"missing required field '{key}'")
+        float(data['size_kwh'])
+        return data
+
     @classmethod
     def load(cls, file_path: str) -> Optional['Battery']:
-        """Load battery configuration from file."""
-        try:
-            if not os.path.exists(file_path):
-                return None
-                
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                return cls.from_dict(data)
-        except Exception as e:
-            logger.error(f"Error loading battery configuration: {e}")
-            return None
+        """Load battery configuration from file (cached until the file changes)."""
+        store = _stores.get(file_path)
+        if store is None:
+            store = _stores.setdefault(file_path, JsonFileStore(file_path, validate=cls.validate))
+        data = store.get()
+        return cls.from_dict(data) if data is not None else None
 
     def save(self, file_path: str) -> bool:
         """Save battery configuration to file."""
@@ -74,9 +85,109 @@ class Battery:
             
             with open(file_path, 'w') as f:
                 json.dump(self.to_dict(), f, indent=4)
+            invalidate(file_path)
             
             logger.info(f"Successfully saved battery configuration to {file_path}")
             return True
         except Exception as e:
             logger.error(f"Error saving battery configuration to {file_path}: {e}")
-            return False 
\ No newline at end of file
+            return False 
+
+
+# --- Battery and forecast math ---
+# Pure functions of already-read values, shared by BatteryStatus and the
+# controller's standalone helpers.
+
+FULL_ENOUGH_PERCENT = 95           # above this the battery no longer has priority
+BRING_FORWARD_MIN_PERCENT = 50     # bring-forward battery factor is 0 at or below this
+BRING_FORWARD_FULL_FORECAST_KWH = 10  # forecast factor reaches 1 at this much energy
+
+
+def charging_requirement_kwh(battery: Optional[Battery], soc_percent: Optional[float]) -> Optional[float]:
+    """Energy needed to charge the battery to 100%, or None if unknown."""
+    if battery is None or soc_percent is None:
+        return None
+    return battery.size_kwh * (100 - soc_percent) / 100
+
+
+def is_full_enough(battery: Optional[Battery], soc_percent: Optional[float]) -> bool:
+    """True if the battery is >95% charged. No battery, or an unknown SoC,
+    places no restriction on device control."""
+    if battery is None or soc_percent is None:
+        return True
+    return soc_percent > FULL_ENOUGH_PERCENT
+
+
+def expected_energy_remaining_kwh(solar_forecast_kwh: Optional[float], battery: Optional[Battery],
+                                  hours_until_sunset: Optional[float],
+                                  battery_energy_needed_kwh: Optional[float]) -> Optional[float]:
+    """Solar forecast left over after household consumption until sunset and
+    charging the battery to full.
+
+    Falls back to the full forecast when there is no battery, no consumption
+    estimate or no sunset time; an unknown charging requirement counts as 0."""
+    if solar_forecast_kwh is None:
+        return None
+    if battery is None or battery.expected_kwh_per_hour is None or hours_until_sunset is None:
+        return solar_forecast_kwh
+    house_energy_needed = battery.expected_kwh_per_hour * hours_until_sunset
+    total_energy_needed = house_energy_needed + (battery_energy_needed_kwh or 0)
+    net_energy = solar_forecast_kwh - total_energy_needed
+    logger.debug(f"Solar forecast: {solar_forecast_kwh}kWh, House needs: {house_energy_needed}kWh, "
+                 f"Battery needs: {battery_energy_needed_kwh}kWh, Total: {total_energy_needed}kWh "
+                 f"over {hours_until_sunset:.2f}h, Net available: {net_energy}kWh")
+    return max(0, net_energy)
+
+
+def bring_forward_power_w(battery: Optional[Battery], soc_percent: Optional[float],
+                          expected_energy_kwh: Optional[float]) -> Optional[float]:
+    """Extra power to bring forward into the day when the battery is well charged.
+
+    The battery's max charging speed scaled by two factors:
+    1. Battery level factor: 0 when battery is at 50%, 1 when battery is at 100%
+    2. Forecast factor: 0 when expected energy is 0, 1 when it is 10kWh or greater
+
+    Returns None if the battery, its max charging speed, the SoC or the
+    forecast is unknown."""
+    if battery is None or battery.max_charging_speed_kw is None:
+        return None
+    if soc_percent is None or expected_energy_kwh is None:
+        return None
+    battery_factor = min(1.0, max(0.0, (soc_percent - BRING_FORWARD_MIN_PERCENT) / (100 - BRING_FORWARD_MIN_PERCENT)))
+    forecast_factor = min(1.0, max(0.0, expected_energy_kwh / BRING_FORWARD_FULL_FORECAST_KWH))
+    power_w = battery_factor * forecast_factor * battery.max_charging_speed_kw * 1000
+    logger.debug(f"Bring forward power: {power_w}W (battery factor: {battery_factor:.2f}, "
+                 f"forecast factor: {forecast_factor:.2f}, max charging speed: {battery.max_charging_speed_kw}kW)")
+    return power_w
+
+
+@dataclass(frozen=True)
+class BatteryStatus:
+    """Battery state and the forecast math derived from it, evaluated once per
+    control loop iteration from a single SoC read."""
+    battery: Optional[Battery]
+    soc_percent: Optional[float]
+    solar_forecast_kwh: Optional[float]
+    hours_until_sunset: Optional[float]
+    charging_requirement_kwh: Optional[float]
+    expected_energy_remaining_kwh: Optional[float]
+    is_full_enough: bool
+    bring_forward_power_w: Optional[float]
+
+    @classmethod
+    def evaluate(cls, battery: Optional[Battery], soc_percent: Optional[float],
+                 solar_forecast_kwh: Optional[float],
+                 hours_until_sunset: Optional[float]) -> 'BatteryStatus':
+        """Derive everything the control loop needs from the raw readings."""
+        requirement = charging_requirement_kwh(battery, soc_percent)
+        expected = expected_energy_remaining_kwh(solar_forecast_kwh, battery, hours_until_sunset, requirement)
+        return cls(
+            battery=battery,
+            soc_percent=soc_percent,
+            solar_forecast_kwh=solar_forecast_kwh,
+            hours_until_sunset=hours_until_sunset,
+            charging_requirement_kwh=requirement,
+            expected_energy_remaining_kwh=expected,
+            is_full_enough=is_full_enough(battery, soc_percent),
+            bring_forward_power_w=bring_forward_power_w(battery, soc_percent, expected),
+        )
@@ -0,0 +1,261 @@
+"""Record and replay the add-on's Home Assistant traffic ("cassettes").
+
+A RecordingAdapter mounted on the shared HassClient passes every request on
+to the real transport and writes down what was asked and what came back.
+The resulting Cassette - those interactions plus the configuration files
+and the time of the pass - is saved as compact (optionally gzipped) JSON.
+A ReplayAdapter serves the same responses back with no network, so a
+recorded pass can be run again and again: for repeatable before/after
+performance numbers, or to reproduce a production decision without access
+to the house.
+
+Request and response headers (including the auth token) are not recorded.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+# Files under DATA_DIR a pass reads: configuration, runtime state and the
+# energy ledger's sunrise baselines
+CASSETTE_FILES = ('solar_config.json', 'devices.json', 'settings.json', 'battery.json',
+                  'state.json', 'energy_baselines.json')
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}
+
+
+def json_response(request, status: int, payload) -> Response:
+    """A requests Response carrying payload as JSON."""
+    response = Response()
+    response.status_code = status
+    response.reason = _REASONS.get(status, '')
+    response._content = json.dumps(payload).encode()
+    response.encoding = 'utf-8'
+    response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+    response.url = request.url
+    response.request = request
+    return response
+
+
+def _request_key(request) -> Tuple[str, str, str]:
+    """(method, path with sorted query, body) - what a replayed request is matched on."""
+    url = urlsplit(request.url)
+    query = urlencode(sorted(parse_qsl(url.query)))
+    body = request.body.decode() if isinstance(request.body, bytes) else (request.body or '')
+    return request.method, url.path + ('?' + query if query else ''), body
+
+
+def _decode(body: str):
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return body
+
+
+def _match_body(decoded) -> str:
+    """A decoded body in the form replay matches on (re-serialized JSON)."""
+    if decoded is None:
+        return ''
+    return decoded if isinstance(decoded, str) else json.dumps(decoded, sort_keys=True)
+
+
+class Cassette:
+    """Recorded HA interactions of one pass, with the files it was run with."""
+
+    def __init__(self, interactions: Optional[List[dict]] = None,
+                 files: Optional[Dict[str, object]] = None,
+                 recorded_at: Optional[datetime] = None):
+        """
+        Args:
+            interactions: {method, path, body, status, response, ms} or, for
+                a request that never got a response, {..., error, message}
+            files: DATA_DIR file name -> parsed JSON content
+            recorded_at: Controller time when the pass started
+        """
+        self.interactions = interactions if interactions is not None else []
+        self.files = files if files is not None else {}
+        self.recorded_at = recorded_at
+
+    def read_files(self, data_dir: str):
+        """Attach the configuration files present in data_dir."""
+        for name in CASSETTE_FILES:
+            try:
+                with open(os.path.join(data_dir, name), 'r') as f:
+                    self.files[name] = json.load(f)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.warning(f"Not adding {name} to the cassette: {e}")
+
+    def service_calls(self) -> List[Tuple[str, object]]:
+        """(path, body) of every service call, in the order they were sent."""
+        return [(i['path'], i['body']) for i in self.interactions
+                if i['method'] == 'POST' and i['path'].startswith('/api/services/')]
+
+    def to_dict(self) -> dict:
+        return {
+            'version': CASSETTE_VERSION,
+            'recorded_at': self.recorded_at.isoformat() if self.recorded_at else None,
+            'files': self.files,
+            'interactions': self.interactions,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Cassette':
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version: {data.get('version')}")
+        recorded_at = data.get('recorded_at')
+        return cls(data.get('interactions') or [], data.get('files') or {},
+                   datetime.fromisoformat(recorded_at) if recorded_at else None)
+
+    def save(self, path: str):
+        """Write compact JSON, gzipped if path ends in .gz."""
+        raw = json.dumps(self.to_dict(), separators=(',', ':')).encode()
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            f.write(raw)
+
+    @classmethod
+    def load(cls, path: str) -> 'Cassette':
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if raw[:2] == b'\x1f\x8b':
+            raw = gzip.decompress(raw)
+        return cls.from_dict(json.loads(raw))
+
+
+class RecordingAdapter(BaseAdapter):
+    """Passes requests on to another transport and records each exchange."""
+
+    def __init__(self, inner: BaseAdapter, cassette: Optional[Cassette] = None):
+        super().__init__()
+        self.inner = inner
+        self.cassette = cassette if cassette is not None else Cassette()
+        self._lock = threading.Lock()  # passes send from several threads at once
+
+    def send(self, request, **kwargs):
+        method, path, body = _request_key(request)
+        interaction = {'method': method, 'path': path, 'body': _decode(body)}
+        started = time.perf_counter()
+        try:
+            response = self.inner.send(request, **kwargs)
+        except Exception as e:
+            interaction.update(error=type(e).__name__, message=str(e),
+                               ms=round((time.perf_counter() - started) * 1000, 1))
+            self._add(interaction)
+            raise
+        interaction.update(status=response.status_code, response=_decode(response.text),
+                           ms=round((time.perf_counter() - started) * 1000, 1))
+        self._add(interaction)
+        return response
+
+    def _add(self, interaction: dict):
+        with self._lock:
+            self.cassette.interactions.append(interaction)
+
+    def close(self):
+        pass  # the wrapped transport belongs to the session
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from a Cassette, deterministically and offline.
+
+    A request gets the next recorded response to the same method, path and
+    body; once those run out the last one is repeated, so the cassette can
+    be replayed any number of times. Failing an exact match (e.g. a history
+    query whose end time moved) it falls back to the same path without its
+    query, then - for a single entity - to the entity's state in a recorded
+    bulk /api/states response. Anything else is a 404 and counted in misses.
+    Recorded connection failures are raised again."""
+
+    def __init__(self, cassette: Cassette, latency: bool = False):
+        """
+        Args:
+            cassette: What to serve
+            latency: Sleep for each interaction's recorded duration
+        """
+        super().__init__()
+        self.cassette = cassette
+        self.latency = latency
+        self.requests = 0
+        self.misses: List[str] = []
+        self._exact: Dict[Tuple[str, str, str], Deque[dict]] = {}
+        self._by_path: Dict[Tuple[str, str], Deque[dict]] = {}
+        self._states: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.rewind()
+
+    def rewind(self):
+        """Start serving the cassette from the beginning again."""
+        with self._lock:
+            self._exact.clear()
+            self._by_path.clear()
+            self._states.clear()
+            for interaction in self.cassette.interactions:
+                self._index(interaction)
+
+    def _index(self, interaction: dict):
+        path = interaction['path']
+        key = (interaction['method'], path, _match_body(interaction.get('body')))
+        self._exact.setdefault(key, deque()).append(interaction)
+        self._by_path.setdefault((interaction['method'], path.split('?')[0]), deque()).append(interaction)
+        if (interaction['method'] == 'GET' and path == '/api/states'
+                and interaction.get('status') == 200 and isinstance(interaction.get('response'), list)):
+            self._states.update({s['entity_id']: s for s in interaction['response']})
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        method, path, body = _request_key(request)
+        with self._lock:
+            self.requests += 1
+            interaction = (self._next(self._exact.get((method, path, _match_body(_decode(body)))))
+                           or self._next(self._by_path.get((method, path.split('?')[0]))))
+            if interaction is None:
+                entity_id = path[len('/api/states/'):] if path.startswith('/api/states/') else None
+                if method == 'GET' and entity_id in self._states:
+                    return json_response(request, 200, self._states[entity_id])
+                self.misses.append(f"{method} {path}")
+                return json_response(request, 404, {'message': f'{method} {path} not in cassette'})
+        if self.latency and interaction.get('ms'):
+            time.sleep(interaction['ms'] / 1000)
+        if 'error' in interaction:
+            raise requests.exceptions.ConnectionError(f"{interaction['error']}: {interaction.get('message')}")
+        return json_response(request, interaction['status'], interaction.get('response'))
+
+    @staticmethod
+    def _next(queue: Optional[Deque[dict]]) -> Optional[dict]:
+        if not queue:
+            return None
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def close(self):
+        pass
+
+
+def record_pass(controller, data_dir: str) -> Cassette:
+    """Run one control loop pass now with every HA request recorded.
+
+    Waits for a pass already in progress, and reads states over REST rather
+    than the WebSocket mirror so the cassette holds everything the pass saw.
+    Files are read before the pass, as the pass found them."""
+    client = controller.hass
+    cassette = Cassette(recorded_at=controller.clock.now())
+    cassette.read_files(data_dir)
+    recorder = RecordingAdapter(client.session.get_adapter(client.base_url + '/'), cassette)
+    with client.mounted(recorder):
+        controller.run_control_loop('cassette', wait=True, rest_only=True)
+    return cassette
@@ -0,0 +1,107 @@
+"""Injectable time source for the controller's timing logic.
+
+Everything that decides by time - min on/off timers, the sunrise baseline of
+the energy ledger, sun position, hours until sunset, the loop's heartbeat -
+asks a Clock instead of calling datetime.now() or time.sleep() directly.
+RealClock is the wall clock. VirtualClock only moves when told to (sleeping
+on it advances it instantly), so the simulator can run days of passes in
+seconds with timers behaving exactly as they would in real time.
+
+Intervals - min on/off timers, loop spacing, in-flight commands - are
+measured with monotonic(), so stepping the wall clock doesn't change them;
+now() is for time-of-day decisions and display.
+
+The process-wide clock is get_clock(); SolarController takes one explicitly
+and defaults to it.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+
+class Clock(ABC):
+    """Wall time, monotonic time and waiting."""
+
+    @abstractmethod
+    def now(self) -> datetime:
+        """Current time, timezone-aware UTC."""
+
+    @abstractmethod
+    def monotonic(self) -> float:
+        """Seconds on a clock that never goes backwards (for intervals)."""
+
+    @abstractmethod
+    def sleep(self, seconds: float):
+        """Block (or, on a virtual clock, advance) for seconds."""
+
+    @abstractmethod
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Wait up to timeout seconds for event; True if it was set."""
+
+
+class RealClock(Clock):
+    """The system clock."""
+
+    def now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        return event.wait(timeout)
+
+
+class VirtualClock(Clock):
+    """A clock that only moves when advanced (or slept on)."""
+
+    def __init__(self, start: Optional[datetime] = None):
+        start = start or datetime.now(timezone.utc)
+        self._now = start if start.tzinfo else start.replace(tzinfo=timezone.utc)
+        self._elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def now(self) -> datetime:
+        with self._lock:
+            return self._now
+
+    def monotonic(self) -> float:
+        with self._lock:
+            return self._elapsed
+
+    def advance(self, seconds: float):
+        """Move time forward."""
+        if seconds < 0:
+            raise ValueError("A virtual clock can't go backwards")
+        with self._lock:
+            self._now += timedelta(seconds=seconds)
+            self._elapsed += seconds
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            self.advance(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        if not event.is_set():
+            self.sleep(timeout)
+        return event.is_set()
+
+
+_clock: Clock = RealClock()
+
+
+def get_clock() -> Clock:
+    """Return the process-wide clock (the wall clock unless replaced)."""
+    return _clock
+
+
+def set_clock(clock: Optional[Clock]):
+    """Replace the process-wide clock; None restores the wall clock."""
+    global _clock
+    _clock = clock if clock is not None else RealClock()
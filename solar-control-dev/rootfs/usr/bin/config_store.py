@@ -0,0 +1,151 @@
+"""Cached, validated, read-only views of the add-on's JSON config files.
+
+The control loop reads solar_config.json, settings.json and battery.json many
+times per iteration. A JsonFileStore parses its file once and serves the
+cached result until the file changes on disk (mtime/size/inode) or a writer
+calls invalidate(path). Values come back as read-only mappings so one caller
+can't silently alter what the next one sees; copy with dict() before editing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from types import MappingProxyType
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# A file modified this recently may be rewritten again within the filesystem's
+# timestamp granularity without its signature changing, so it isn't trusted
+# from cache until it has been stable this long (nanoseconds)
+RACY_WINDOW_NS = 2_000_000_000
+
+_stores = weakref.WeakSet()
+
+
+def freeze(value: Any) -> Any:
+    """Return a read-only copy of parsed JSON (dicts become MappingProxyType,
+    lists become tuples)."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Return a plain, mutable (and JSON-serialisable) copy of a frozen value."""
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def validate_object(data: Any) -> dict:
+    """Default validator: the file must hold a JSON object."""
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+    return data
+
+
+def validate_solar_config(data: Any) -> dict:
+    """Validator for solar_config.json. Bad optional values are dropped with a
+    warning rather than rejecting the whole grid configuration."""
+    data = dict(validate_object(data))
+    if data.get('tariff_modes') is not None and not isinstance(data['tariff_modes'], dict):
+        logger.warning(f"Ignoring invalid tariff_modes in solar config: {data['tariff_modes']!r}")
+        data['tariff_modes'] = {}
+    for key in ('site_export_limit', 'grid_voltage_fixed', 'grid_trigger_delta'):
+        if data.get(key) not in (None, ''):
+            try:
+                float(data[key])
+            except (TypeError, ValueError):
+                logger.warning(f"Ignoring non-numeric {key} in solar config: {data[key]!r}")
+                data[key] = None
+    return data
+
+
+def validate_settings(data: Any) -> dict:
+    """Validator for settings.json."""
+    data = validate_object(data)
+    if not isinstance(data.get('power_optimization_enabled', True), bool):
+        raise ValueError("power_optimization_enabled must be true or false")
+    if not isinstance(data.get('detailed_timings', False), bool):
+        raise ValueError("detailed_timings must be true or false")
+    return data
+
+
+class JsonFileStore:
+    """One JSON file, parsed and validated once per change."""
+
+    def __init__(self, path: str, validate: Callable[[Any], Any] = validate_object,
+                 default: Any = None):
+        """
+        Args:
+            path: JSON file to read
+            validate: Called with the parsed JSON; returns the (possibly
+                normalised) data or raises ValueError
+            default: Returned (frozen) when the file is missing or invalid
+        """
+        self.path = os.path.abspath(path)
+        self.validate = validate
+        self.default = freeze(default)
+        self._lock = threading.Lock()
+        self._signature = None
+        self._loaded_at_ns = 0
+        self._value = self.default
+        self._valid = False
+        _stores.add(self)
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _is_fresh(self, signature) -> bool:
+        if not self._valid or signature != self._signature:
+            return False
+        return signature is None or self._loaded_at_ns - signature[0] > RACY_WINDOW_NS
+
+    def get(self) -> Any:
+        """Return the file's frozen contents, re-reading only if it changed."""
+        signature = self._stat_signature()
+        with self._lock:
+            if self._is_fresh(signature):
+                return self._value
+            self._value = self._load(signature)
+            self._signature = signature
+            self._loaded_at_ns = time.time_ns()
+            self._valid = True
+            return self._value
+
+    def _load(self, signature):
+        if signature is None:
+            logger.debug(f"{self.path} not found - using defaults")
+            return self.default
+        try:
+            with open(self.path, 'r') as f:
+                return freeze(self.validate(json.load(f)))
+        except Exception as e:
+            logger.error(f"Failed to load {self.path}: {e}")
+            return self.default
+
+    def invalidate(self):
+        """Force the next get() to re-read the file."""
+        with self._lock:
+            self._valid = False
+
+
+def invalidate(path: str):
+    """Drop the cached contents of every store reading `path`. Call after
+    writing a config file."""
+    path = os.path.abspath(path)
+    for store in list(_stores):
+        if store.path == path:
+            store.invalidate()
@@ -5,11 +5,22 @@ import os
 import requests
 import logging
 from datetime import datetime, timezone
+from energy_ledger import get_ledger
+from entity_metadata import domain_of, get_registry
+from hass_client import get_client
 from utils import get_sunrise_time, setup_logging
 
 # Configure logging
 logger = setup_logging()
 
+
+def _to_kwh(value: float, unit_of_measurement: str) -> float:
+    """Convert an energy reading to kWh if the sensor is in Wh."""
+    if unit_of_measurement.lower() in ['wh', 'watt-hour', 'watt-hours']:
+        return value / 1000
+    return value
+
+
 @dataclass
 class Device:
     name: str
@@ -111,23 +122,26 @@ class Device:
 
         return cls(**converted_data)
 
-    def update_energy_delivered(self) -> None:
-        """Update the energy delivered tracking using Home Assistant history API"""
+    def update_energy_delivered(self, current_state: Optional[dict] = None) -> None:
+        """Update energy_delivered_today from the energy sensor's current reading
+
+        The reading is compared with the sensor's meter value at sunrise, kept
+        by the energy ledger; Home Assistant history is only queried when the
+        ledger has no baseline for today yet.
+
+        Args:
+            current_state: The energy sensor's state object if the caller already
+                has it (e.g. from the control loop's entity snapshot); fetched
+                from Home Assistant otherwise.
+        """
         if not self.energy_sensor:
             return
 
         try:
-            supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-            if not supervisor_token:
+            hass = get_client()
+            if not hass.has_token:
                 logger.error("No supervisor token found in environment")
                 return
-
-            headers = {
-                "Authorization": f"Bearer {supervisor_token}",
-                "Content-Type": "application/json",
-            }
-            
-            hass_url = os.environ.get('HASS_URL', 'http://supervisor/core')
             
             # Get sunrise time using existing function
             sunrise_time = get_sunrise_time()
@@ -145,58 +159,22 @@ class Device:
                 last_rise = last_rise.astimezone(timezone.utc)
             
             # Get current energy value and check its unit
-            response = requests.get(
-                f"{hass_url}/api/states/{self.energy_sensor}",
-                headers=headers
-            )
-            response.raise_for_status()
-            current_state = response.json()
+            if current_state is None:
+                current_state = hass.get_state(self.energy_sensor)
             
             # Check the unit of measurement
-            unit_of_measurement = current_state.get('attributes', {}).get('unit_of_measurement', '')
-            
-            # Get energy sensor value at dawn
-            dawn_time = last_rise.isoformat()
-            response = requests.get(
-                f"{hass_url}/api/history/period/{dawn_time}",
-                params={
-                    'filter_entity_id': self.energy_sensor,
-                    'minimal_response': 'true'
-                },
-                headers=headers
-            )
-            response.raise_for_status()
-            history = response.json()
-            
-            if not history or not history[0]:
-                logger.error(f"No history data found for {self.energy_sensor} after {dawn_time}")
-                return
-                
-            # Get the first reading after dawn
-            dawn_energy = None
-            for reading in history[0]:
-                try:
-                    dawn_energy = float(reading.get('state', 0))
-                    # Convert to kWh if the sensor is in Wh
-                    if unit_of_measurement.lower() in ['wh', 'watt-hour', 'watt-hours']:
-                        dawn_energy = dawn_energy / 1000
-                    break
-                except (ValueError, TypeError) as e:
-                    logger.warning(f"Invalid energy reading at dawn: {reading.get('state')}")
-                    continue
-            
-            if dawn_energy is None:
-                logger.error(f"Could not find valid energy reading after dawn for {self.energy_sensor}")
-                return
+            unit_of_measurement = get_registry().get(self.energy_sensor, current_state).unit or ''
                 
             # Get current energy value
-            current_energy = float(current_state.get('state', 0))
-            # Convert to kWh if the sensor is in Wh
-            if unit_of_measurement.lower() in ['wh', 'watt-hour', 'watt-hours']:
-                current_energy = current_energy / 1000
+            current_energy = _to_kwh(float(current_state.get('state', 0)), unit_of_measurement)
             
             # Calculate energy delivered today
-            self.energy_delivered_today = current_energy - dawn_energy
+            delivered = get_ledger().update(
+                self.energy_sensor, current_energy, last_rise,
+                fetch_baseline=lambda: self._fetch_dawn_energy(hass, last_rise, unit_of_measurement))
+            if delivered is None:
+                return
+            self.energy_delivered_today = delivered
             logger.info(f"Updated energy delivered for {self.name}: {self.energy_delivered_today:.2f} kWh")
             
         except requests.exceptions.RequestException as e:
@@ -204,6 +182,34 @@ class Device:
         except Exception as e:
             logger.error(f"Failed to update energy delivered for {self.name}: {e}", exc_info=True)
 
+    def _fetch_dawn_energy(self, hass, last_rise: datetime, unit_of_measurement: str) -> Optional[float]:
+        """Look up the energy sensor's first reading after sunrise in HA history (kWh)."""
+        dawn_time = last_rise.isoformat()
+        response = hass.get(
+            f"/api/history/period/{dawn_time}",
+            params={
+                'filter_entity_id': self.energy_sensor,
+                'minimal_response': 'true'
+            }
+        )
+        response.raise_for_status()
+        history = response.json()
+        
+        if not history or not history[0]:
+            logger.error(f"No history data found for {self.energy_sensor} after {dawn_time}")
+            return None
+            
+        # Get the first reading after dawn
+        for reading in history[0]:
+            try:
+                return _to_kwh(float(reading.get('state', 0)), unit_of_measurement)
+            except (ValueError, TypeError):
+                logger.warning(f"Invalid energy reading at dawn: {reading.get('state')}")
+                continue
+        
+        logger.error(f"Could not find valid energy reading after dawn for {self.energy_sensor}")
+        return None
+
     def save(self, devices_file: str):
         """Save this device to the devices configuration file"""
         try:
@@ -264,31 +270,14 @@ class Device:
             logger.debug(f"No switch entity defined for {self.name}")
             return False
             
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        if not supervisor_token:
+        hass = get_client()
+        if not hass.has_token:
             logger.debug("No supervisor token found in environment")
             return False
             
         try:
-            headers = {
-                "Authorization": f"Bearer {supervisor_token}",
-                "Content-Type": "application/json",
-            }
-            
-            hass_url = os.environ.get('HASS_URL', 'http://supervisor/core')
-            
-            # First, get the entity state to determine its type
-            logger.debug(f"Fetching entity state for {self.switch_entity}")
-            response = requests.get(
-                f"{hass_url}/api/states/{self.switch_entity}",
-                headers=headers
-            )
-            response.raise_for_status()
-            entity_data = response.json()
-            logger.debug(f"Entity state response: {entity_data}")
-            
-            # Determine the domain and service based on entity type
-            domain = entity_data['entity_id'].split('.')[0]
+            # The domain comes from the entity ID - no need to fetch the entity
+            domain = domain_of(self.switch_entity)
             service = "turn_on" if state else "turn_off"
             logger.debug(f"Detected domain: {domain}, using service: {service}")
             
@@ -297,13 +286,7 @@ class Device:
             service_data = {"entity_id": self.switch_entity}
             
             logger.debug(f"Sending service call to {domain}.{service} with data: {service_data}")
-            response = requests.post(
-                f"{hass_url}/api/services/{domain}/{service}",
-                headers=headers,
-                json=service_data
-            )
-            
-            response.raise_for_status()
+            response = hass.call_service(domain, service, service_data)
             logger.debug(f"Service call response: {response.status_code} - {response.text}")
             return True
         except Exception as e:
@@ -0,0 +1,141 @@
+"""Per-sensor "energy delivered since sunrise" accounting.
+
+energy_delivered_today used to be worked out by fetching each energy
+sensor's history from sunrise to now on every update - a request that grows
+all day. The ledger instead keeps each sensor's meter reading at sunrise (its
+baseline) and answers current - baseline with no I/O. Baselines are taken
+from the last reading seen before sunrise, persisted to /data so a restart
+doesn't lose them, and only fall back to a single history lookup when no
+such reading exists (e.g. the add-on was started during the day).
+"""
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from clock import get_clock
+
+logger = logging.getLogger(__name__)
+
+# A reading this close before sunrise is used as the day's baseline
+BASELINE_MAX_GAP = timedelta(minutes=15)
+# Sunrise times from different sources (calculated vs sun.sun history) for
+# the same day differ by a few minutes at most
+SAME_SUNRISE_TOLERANCE = timedelta(hours=1)
+
+
+class EnergyLedger:
+    """Dawn baselines for energy sensors, persisted to a JSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        # sensor -> {'sunrise': ISO timestamp, 'baseline_kwh': float}
+        self._baselines: Dict[str, dict] = self._load()
+        # sensor -> (time, kWh) of the latest reading, in memory only
+        self._last_readings: Dict[str, Tuple[datetime, float]] = {}
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"Failed to load energy baselines from {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self._baselines, f, indent=2)
+        except Exception as e:
+            logger.error(f"Failed to save energy baselines to {self.path}: {e}")
+
+    def baseline(self, sensor: str, sunrise: datetime) -> Optional[float]:
+        """The stored baseline for sensor if it belongs to this sunrise."""
+        entry = self._baselines.get(sensor)
+        if not entry:
+            return None
+        try:
+            stored_sunrise = datetime.fromisoformat(entry['sunrise'])
+            if abs(stored_sunrise - sunrise) > SAME_SUNRISE_TOLERANCE:
+                return None
+            return float(entry['baseline_kwh'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def update(self, sensor: str, current_kwh: float, sunrise: datetime,
+               fetch_baseline: Optional[Callable[[], Optional[float]]] = None,
+               now: Optional[datetime] = None) -> Optional[float]:
+        """Record a meter reading and return the energy delivered since sunrise.
+
+        Args:
+            sensor: Energy sensor entity ID
+            current_kwh: Its current reading in kWh
+            sunrise: The most recent sunrise (UTC)
+            fetch_baseline: Called to look up the meter reading at sunrise when
+                the ledger doesn't have one for this sunrise (e.g. a history
+                query); may return None
+            now: Time of the reading (defaults to now)
+
+        Returns:
+            kWh delivered since sunrise, or None if no baseline is available.
+        """
+        now = now or get_clock().now()
+        with self._lock:
+            last = self._last_readings.get(sensor)
+            self._last_readings[sensor] = (now, current_kwh)
+            baseline = self.baseline(sensor, sunrise)
+            if baseline is not None:
+                if last is not None and current_kwh < last[1]:
+                    # Meter went backwards: like HA's total_increasing sensors,
+                    # treat it as reset to zero and carry today's total over
+                    baseline = -(last[1] - baseline)
+                    self._set_baseline(sensor, sunrise, baseline)
+                    logger.info(f"Energy meter {sensor} reset - rebased today's baseline")
+                return current_kwh - baseline
+            if last is not None and last[0] <= sunrise and sunrise - last[0] <= BASELINE_MAX_GAP:
+                baseline = last[1]
+
+        if baseline is None and fetch_baseline is not None:
+            baseline = fetch_baseline()
+        if baseline is None:
+            return None
+        with self._lock:
+            self._set_baseline(sensor, sunrise, baseline)
+        logger.info(f"New sunrise baseline for {sensor}: {baseline:.3f} kWh")
+        return current_kwh - baseline
+
+    def _set_baseline(self, sensor: str, sunrise: datetime, baseline_kwh: float):
+        self._baselines[sensor] = {'sunrise': sunrise.isoformat(), 'baseline_kwh': baseline_kwh}
+        self._save()
+
+
+LEDGER_FILE = 'energy_baselines.json'
+
+_ledger: Optional[EnergyLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> EnergyLedger:
+    """Return the process-wide ledger backed by /data/energy_baselines.json."""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = EnergyLedger(os.path.join(os.environ.get('DATA_DIR', '/data'), LEDGER_FILE))
+    return _ledger
+
+
+def set_ledger(ledger: Optional[EnergyLedger]) -> Optional[EnergyLedger]:
+    """Replace the process-wide ledger and return the one it replaces; with
+    None the next get_ledger() opens DATA_DIR's file afresh."""
+    global _ledger
+    with _ledger_lock:
+        previous, _ledger = _ledger, ledger
+    return previous
@@ -0,0 +1,164 @@
+"""Cached per-entity metadata: domain, unit, device class and number limits.
+
+Actuation used to GET an entity before every service call just to learn its
+domain, and power getters re-read unit_of_measurement on every call. The
+registry keeps what rarely changes about an entity - the domain (taken from
+the entity ID, so never fetched), unit_of_measurement, device_class and, for
+number/input_number entities, min/max/step - filled once from state objects
+the add-on already has. Entries are refreshed when HA reports an
+entity-registry update (via the state mirror), when a state the add-on reads
+(each pass's snapshot, mirrored or fetched) carries different attributes -
+e.g. a number entity's max was changed - or after METADATA_TTL.
+"""
+
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from hass_client import get_client
+
+logger = logging.getLogger(__name__)
+
+METADATA_TTL = 3600  # seconds
+
+
+def domain_of(entity_id: str) -> str:
+    """The entity's domain, e.g. 'switch' for switch.pool_pump."""
+    return entity_id.split('.', 1)[0]
+
+
+def _as_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class EntityMetadata:
+    """What the add-on needs to know about an entity besides its state."""
+    entity_id: str
+    domain: str
+    unit: Optional[str] = None
+    device_class: Optional[str] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+    step: Optional[float] = None
+
+    @classmethod
+    def from_state(cls, entity_id: str, state: Optional[dict]) -> 'EntityMetadata':
+        attributes = (state or {}).get('attributes') or {}
+        return cls(
+            entity_id=entity_id,
+            domain=domain_of(entity_id),
+            unit=attributes.get('unit_of_measurement'),
+            device_class=attributes.get('device_class'),
+            min=_as_float(attributes.get('min')),
+            max=_as_float(attributes.get('max')),
+            step=_as_float(attributes.get('step')),
+        )
+
+    def clamp(self, value: float) -> float:
+        """Clamp a value to the entity's min/max and round it down onto its
+        step grid (which starts at min), so a number entity accepts it."""
+        if self.step and self.step > 0:
+            base = self.min if self.min is not None else 0.0
+            value = base + math.floor((value - base) / self.step + 1e-9) * self.step
+            value = round(value, 6)
+        if self.max is not None:
+            value = min(value, self.max)
+        if self.min is not None:
+            value = max(value, self.min)
+        return value
+
+
+class EntityMetadataRegistry:
+    """Entity ID -> EntityMetadata, refreshed at most every ttl seconds."""
+
+    def __init__(self, ttl: float = METADATA_TTL, fetch: Optional[Callable[[str], dict]] = None):
+        self.ttl = ttl
+        self._fetch = fetch
+        self._entries: Dict[str, tuple] = {}  # entity_id -> (EntityMetadata, monotonic time)
+        self._lock = threading.Lock()
+
+    def _fresh(self, entity_id: str, now: float) -> Optional[EntityMetadata]:
+        entry = self._entries.get(entity_id)
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[0]
+        return None
+
+    def get(self, entity_id: str, state: Optional[dict] = None) -> EntityMetadata:
+        """Metadata for an entity.
+
+        Args:
+            entity_id: The entity
+            state: Its state object if the caller has one; used to fill or
+                refresh the entry without a request
+
+        If nothing is cached and no state is given, the state is fetched once
+        from HA; if that fails the result carries only the domain.
+        """
+        now = time.monotonic()
+        with self._lock:
+            metadata = self._fresh(entity_id, now)
+        if metadata is not None and (state is None or metadata == EntityMetadata.from_state(entity_id, state)):
+            return metadata
+        if state is None:
+            try:
+                state = (self._fetch or get_client().get_state)(entity_id)
+            except Exception as e:
+                logger.warning(f"Could not fetch metadata for {entity_id}: {e}")
+                return EntityMetadata(entity_id, domain_of(entity_id))
+        return self.observe(entity_id, state, now)
+
+    def observe(self, entity_id: str, state: Optional[dict], now: Optional[float] = None) -> EntityMetadata:
+        """Refresh an entity's metadata from a state object already in hand."""
+        metadata = EntityMetadata.from_state(entity_id, state)
+        with self._lock:
+            self._entries[entity_id] = (metadata, time.monotonic() if now is None else now)
+        return metadata
+
+    def prime(self, states: Dict[str, dict]):
+        """Fill entries that are missing, expired or out of date from a batch
+        of states (e.g. a control loop snapshot); an entry whose attributes
+        haven't changed keeps its age."""
+        now = time.monotonic()
+        for entity_id, state in states.items():
+            metadata = EntityMetadata.from_state(entity_id, state)
+            with self._lock:
+                if self._fresh(entity_id, now) != metadata:
+                    self._entries[entity_id] = (metadata, now)
+
+    def invalidate(self, entity_id: Optional[str] = None):
+        """Forget one entity's metadata, or everything if entity_id is None."""
+        with self._lock:
+            if entity_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(entity_id, None)
+
+
+_registry: Optional[EntityMetadataRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> EntityMetadataRegistry:
+    """Return the process-wide metadata registry."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = EntityMetadataRegistry()
+    return _registry
+
+
+def set_registry(registry: Optional[EntityMetadataRegistry]) -> Optional[EntityMetadataRegistry]:
+    """Replace the process-wide registry and return the one it replaces; with
+    None the next get_registry() starts an empty one."""
+    global _registry
+    with _registry_lock:
+        previous, _registry = _registry, registry
+    return previous
@@ -0,0 +1,129 @@
+"""Per-iteration snapshot of Home Assistant entity states.
+
+A control loop pass reads grid power, voltage, tariff, sun.sun, the solar
+forecast, battery SoC and every device's switch/power/SoC/completion sensor —
+often the same entity several times. Instead of one GET per read, the loop
+collects the entity IDs it needs up front and fills them with a single bulk
+/api/states call; the getters then read from the snapshot.
+"""
+
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from clock import Clock, get_clock
+
+logger = logging.getLogger(__name__)
+
+
+def collect_entity_ids(config: dict, devices: Iterable, battery=None) -> Set[str]:
+    """Return every entity ID one control loop iteration may read.
+
+    Args:
+        config: Parsed solar_config.json
+        devices: Device objects from devices.json
+        battery: Battery object, or None if no battery is configured
+    """
+    entity_ids = {'sun.sun'}
+    for key in ('grid_power', 'grid_voltage', 'tariff_rate', 'solar_forecast', 'solar_generation'):
+        if config.get(key):
+            entity_ids.add(config[key])
+    if battery and battery.battery_percent_entity:
+        entity_ids.add(battery.battery_percent_entity)
+    for device in devices:
+        for entity_id in (device.switch_entity, device.current_power_sensor,
+                          device.energy_sensor, device.completion_sensor,
+                          device.car_soc_sensor, device.variable_amperage_control):
+            if entity_id:
+                entity_ids.add(entity_id)
+    return entity_ids
+
+
+class EntitySnapshot:
+    """Entity states captured once at the start of a control loop iteration."""
+
+    def __init__(self, states: Dict[str, dict], requested: Optional[Set[str]] = None,
+                 fetched_at: Optional[datetime] = None, failed: Optional[Set[str]] = None):
+        """
+        Args:
+            states: entity_id -> HA state object (as returned by /api/states)
+            requested: entity IDs the snapshot was asked for. An ID that was
+                requested but is missing from `states` does not exist in HA,
+                unless it is in `failed`.
+            fetched_at: When the states were read (defaults to now)
+            failed: requested IDs that couldn't be read (HA unreachable)
+        """
+        self.states = states
+        self.requested = set(requested) if requested is not None else set(states)
+        self.fetched_at = fetched_at or get_clock().now()
+        self.failed = set(failed or ())
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self.states
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def covers(self, entity_id: str) -> bool:
+        """True if the snapshot is authoritative for entity_id (present or known-missing)."""
+        return entity_id in self.requested
+
+    def get(self, entity_id: str) -> Optional[dict]:
+        """Return the state object for entity_id, or None if not captured."""
+        return self.states.get(entity_id)
+
+    @classmethod
+    def fetch(cls, client, entity_ids: Iterable[str]) -> 'EntitySnapshot':
+        """Fill a snapshot for entity_ids with a single bulk /api/states call.
+
+        Args:
+            client: HassClient to read through
+            entity_ids: Entities to capture
+
+        Raises on network/HTTP errors so the caller can fall back to
+        per-entity reads."""
+        wanted = set(entity_ids)
+        response = client.get("/api/states")
+        response.raise_for_status()
+        states = {
+            state['entity_id']: state
+            for state in response.json()
+            if isinstance(state, dict) and state.get('entity_id') in wanted
+        }
+        missing = wanted - set(states)
+        if missing:
+            logger.warning(f"Entities not found in Home Assistant: {sorted(missing)}")
+        logger.debug(f"Entity snapshot: {len(states)}/{len(wanted)} entities in one request")
+        return cls(states, requested=wanted)
+
+
+class LastGoodStates:
+    """The most recent successfully read state of each entity, with its age.
+
+    When Home Assistant can't be reached, getters serve these (if not older
+    than max_age) instead of falling back to hard-coded defaults."""
+
+    def __init__(self, clock: Optional[Clock] = None):
+        self._clock = clock or get_clock()
+        self._states: Dict[str, Tuple[dict, float]] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, entity_id: str, state: dict, at: Optional[float] = None):
+        with self._lock:
+            self._states[entity_id] = (state, self._clock.monotonic() if at is None else at)
+
+    def remember_all(self, states: Dict[str, dict]):
+        now = self._clock.monotonic()
+        with self._lock:
+            for entity_id, state in states.items():
+                self._states[entity_id] = (state, now)
+
+    def get(self, entity_id: str, max_age: float) -> Optional[Tuple[dict, float]]:
+        """(state, age in seconds) if a state no older than max_age is held."""
+        with self._lock:
+            entry = self._states.get(entity_id)
+        if entry is None:
+            return None
+        age = self._clock.monotonic() - entry[1]
+        return (entry[0], age) if age <= max_age else None
@@ -0,0 +1,351 @@
+"""Shared HTTP client for the Home Assistant REST API.
+
+Every call to Home Assistant (through the supervisor proxy) goes through one
+keep-alive session, so connections are reused across the dozens of requests
+a control loop pass makes. The client adds the auth headers, applies default
+connect/read timeouts so a hung supervisor can't freeze the control thread,
+and keeps per-endpoint latency counters. A RequestAccount opened around a
+control loop pass records every request sent while it is open, by endpoint
+and entity, with latency percentiles. A circuit breaker stops sending
+requests for a while after repeated failures, so an HA outage costs a fast
+CircuitOpenError per call instead of a timeout each.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 5   # seconds
+DEFAULT_READ_TIMEOUT = 15     # seconds
+POOL_SIZE = 10                # keep-alive connections per host
+BREAKER_THRESHOLD = 5         # consecutive failures that open the circuit
+BREAKER_COOLDOWN = 30         # seconds open before a trial request is let through
+
+HA_REQUESTS = Counter('solar_control_ha_requests_total', 'Home Assistant API requests sent.',
+                      ['endpoint', 'result'])
+HA_REQUEST_SECONDS = Histogram('solar_control_ha_request_duration_seconds',
+                               'Home Assistant API request latency.', ['endpoint'])
+HA_REQUESTS_REJECTED = Counter('solar_control_ha_requests_rejected_total',
+                               'Requests not sent because the circuit breaker was open.')
+
+# Collapse per-entity / per-timestamp paths so counters group by endpoint
+_ENDPOINT_PATTERNS = [
+    (re.compile(r'^/api/states/.+$'), '/api/states/{entity_id}'),
+    (re.compile(r'^/api/history/period/.+$'), '/api/history/period/{start}'),
+]
+
+
+def endpoint_name(path: str) -> str:
+    """Return the endpoint a request path belongs to, for latency counters."""
+    for pattern, name in _ENDPOINT_PATTERNS:
+        if pattern.match(path):
+            return name
+    return path
+
+
+def entity_of(path: str, data: Optional[dict] = None, params: Optional[dict] = None) -> Optional[str]:
+    """The entity a request is about, if any: from a state path, a service
+    call's entity_id or a history filter."""
+    if path.startswith('/api/states/'):
+        return path[len('/api/states/'):]
+    for source, key in ((data, 'entity_id'), (params, 'filter_entity_id')):
+        if isinstance(source, dict) and isinstance(source.get(key), str):
+            return source[key]
+    return None
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of samples (0.0 if there are none)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))  # ceil
+    return ordered[int(rank) - 1]
+
+
+def _latency_summary(samples: List[float]) -> dict:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50), 1),
+        'p95_ms': round(percentile(samples, 95), 1),
+        'p99_ms': round(percentile(samples, 99), 1),
+        'max_ms': round(max(samples), 1) if samples else 0.0,
+    }
+
+
+class RequestAccount:
+    """Every request sent while the account is open (see HassClient.account).
+
+    Requests are attributed by time, not by caller: anything the add-on sends
+    to HA while it is open - from the control thread, its worker threads or a
+    web request - is counted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (endpoint, entity_id or None, elapsed ms, failed)
+        self.calls: List[tuple] = []
+
+    def add(self, endpoint: str, entity_id: Optional[str], elapsed_ms: float, failed: bool):
+        with self._lock:
+            self.calls.append((endpoint, entity_id, elapsed_ms, failed))
+
+    @property
+    def count(self) -> int:
+        return len(self.calls)
+
+    def count_for(self, endpoint: str) -> int:
+        """Calls made to one endpoint (as named by endpoint_name)."""
+        return sum(1 for call in self.calls if call[0] == endpoint)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            calls = list(self.calls)
+        by_endpoint: Dict[str, List[float]] = {}
+        by_entity: Dict[str, int] = {}
+        for endpoint, entity_id, elapsed_ms, _ in calls:
+            by_endpoint.setdefault(endpoint, []).append(elapsed_ms)
+            if entity_id:
+                by_entity[entity_id] = by_entity.get(entity_id, 0) + 1
+        summary = _latency_summary([call[2] for call in calls])
+        summary.update({
+            'errors': sum(1 for call in calls if call[3]),
+            'total_ms': round(sum(call[2] for call in calls), 1),
+            'by_endpoint': {endpoint: _latency_summary(samples)
+                            for endpoint, samples in sorted(by_endpoint.items())},
+            'by_entity': dict(sorted(by_entity.items(), key=lambda item: (-item[1], item[0]))),
+        })
+        return summary
+
+
+class EndpointStats:
+    """Call count, error count and latency totals for one endpoint."""
+
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.count, 1) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 1),
+        }
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request while the circuit is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    closed: requests flow. After `threshold` consecutive failures it opens and
+    requests are refused for `cooldown` seconds; then it is half-open and lets
+    one trial request through - success closes it, failure re-opens it.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at: Optional[float] = None
+            self._trial_in_flight = False
+            self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self._opened_at >= self.cooldown else 'open'
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.cooldown and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, failed: bool):
+        with self._lock:
+            self._trial_in_flight = False
+            if not failed:
+                if self._opened_at is not None:
+                    logger.info("Home Assistant reachable again - circuit closed")
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.warning(f"{self._failures} consecutive Home Assistant failures - "
+                                   f"pausing requests for {self.cooldown}s")
+                self._opened_at = time.monotonic()
+
+    def to_dict(self) -> dict:
+        return {'state': self.state, 'consecutive_failures': self._failures, 'rejected': self.rejected}
+
+
+class HassClient:
+    """Pooled, authenticated client for the Home Assistant REST API."""
+
+    def __init__(self, base_url: Optional[str] = None, token: Optional[str] = None,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT):
+        self.base_url = (base_url or os.environ.get('HASS_URL', 'http://supervisor/core')).rstrip('/')
+        self.token = token if token is not None else os.environ.get('SUPERVISOR_TOKEN')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json",
+            "X-Solar-Controller": "solar-control-addon",  # identify our add-on in HA logs
+        })
+        self._stats: Dict[str, EndpointStats] = {}
+        self._stats_lock = threading.Lock()
+        self._accounts: List[RequestAccount] = []
+        self.breaker = CircuitBreaker()
+
+    @property
+    def has_token(self) -> bool:
+        return bool(self.token)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """GET base_url + path with the default timeout."""
+        kwargs.setdefault('timeout', self.timeout)
+        return self._timed(path, self.session.get, self.base_url + path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        """POST base_url + path with the default timeout."""
+        kwargs.setdefault('timeout', self.timeout)
+        return self._timed(path, self.session.post, self.base_url + path, **kwargs)
+
+    def get_state(self, entity_id: str) -> dict:
+        """Return an entity's state object. Raises on network/HTTP errors."""
+        response = self.get(f"/api/states/{entity_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def call_service(self, domain: str, service: str, data: dict) -> requests.Response:
+        """Call a Home Assistant service. Raises on network/HTTP errors."""
+        response = self.post(f"/api/services/{domain}/{service}", json=data)
+        response.raise_for_status()
+        return response
+
+    def _timed(self, path, send, url, **kwargs):
+        if not self.breaker.allow():
+            HA_REQUESTS_REJECTED.inc()
+            raise CircuitOpenError(f"Home Assistant circuit open - not sending {path}")
+        entity_id = entity_of(path, kwargs.get('json'), kwargs.get('params'))
+        start = time.perf_counter()
+        failed = True
+        unreachable = True
+        try:
+            response = send(url, **kwargs)
+            status = getattr(response, 'status_code', None)
+            failed = isinstance(status, int) and status >= 400
+            # 4xx (e.g. an unknown entity) means HA answered; only 5xx and
+            # network errors count towards opening the circuit
+            unreachable = isinstance(status, int) and status >= 500
+            return response
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._record(endpoint_name(path), entity_id, elapsed_ms, failed)
+            self.breaker.record(unreachable)
+
+    def _record(self, endpoint: str, entity_id: Optional[str], elapsed_ms: float, failed: bool):
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.count += 1
+            stats.errors += int(failed)
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, elapsed_ms)
+            accounts = list(self._accounts)
+        HA_REQUESTS.inc(endpoint=endpoint, result='error' if failed else 'ok')
+        HA_REQUEST_SECONDS.observe(elapsed_ms / 1000, endpoint=endpoint)
+        for account in accounts:
+            account.add(endpoint, entity_id, elapsed_ms, failed)
+
+    @contextmanager
+    def account(self) -> Iterator[RequestAccount]:
+        """Record every request sent until the block exits."""
+        account = RequestAccount()
+        with self._stats_lock:
+            self._accounts.append(account)
+        try:
+            yield account
+        finally:
+            with self._stats_lock:
+                self._accounts.remove(account)
+
+    @contextmanager
+    def mounted(self, adapter: BaseAdapter) -> Iterator[BaseAdapter]:
+        """Send every request to base_url through adapter (e.g. a cassette
+        recorder) until the block exits."""
+        prefix = self.base_url + '/'
+        previous = self.session.adapters.get(prefix)
+        self.session.mount(prefix, adapter)
+        try:
+            yield adapter
+        finally:
+            if previous is not None:
+                self.session.mount(prefix, previous)
+            else:
+                self.session.adapters.pop(prefix, None)
+
+    def stats(self) -> Dict[str, dict]:
+        """Per-endpoint call counts and latencies since startup."""
+        with self._stats_lock:
+            return {endpoint: s.to_dict() for endpoint, s in sorted(self._stats.items())}
+
+
+_client: Optional[HassClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> HassClient:
+    """Return the process-wide shared client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HassClient()
+    return _client
+
+
+def set_client(client: Optional[HassClient]) -> Optional[HassClient]:
+    """Replace the process-wide client and return the one it replaces; with
+    None the next get_client() creates a new one."""
+    global _client
+    with _client_lock:
+        previous, _client = _client, client
+    return previous
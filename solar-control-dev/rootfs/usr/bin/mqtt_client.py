@@ -6,6 +6,7 @@ import json
 import os
 from threading import Thread, Timer
 from datetime import datetime
+from metrics import Counter
 from utils import set_mqtt_settings
 
 # MQTT Topics
@@ -53,6 +54,8 @@ ROAD_TRIP_CONFIG_TOPIC = SWITCH_KINDS["road_trip"]["config_topic"]
 ROAD_TRIP_STATE_TOPIC = SWITCH_KINDS["road_trip"]["state_topic"]
 ROAD_TRIP_COMMAND_TOPIC = SWITCH_KINDS["road_trip"]["command_topic"]
 
+MQTT_PUBLISHES = Counter('solar_control_mqtt_publishes_total', 'MQTT messages published.', ['result'])
+
 # Global variables
 mqtt_client: mqtt.Client = None
 subscribed_topics = []
@@ -362,9 +365,13 @@ def publish_message(topic, payload, retain=False):
             if isinstance(payload, (dict, list)):
                 payload = json.dumps(payload)
             mqtt_client.publish(topic, payload, retain=retain)
+            MQTT_PUBLISHES.inc(result='ok')
             return True
         except Exception as e:
             logging.error(f"Error publishing message to {topic}: {e}")
+            MQTT_PUBLISHES.inc(result='failed')
+            return False
+    MQTT_PUBLISHES.inc(result='disconnected')
     return False
 
 def publish_status():
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for, session, flash, abort, json, make_response
+from flask import Flask, render_template, jsonify, request, redirect, url_for, session, flash, abort, json, make_response, send_from_directory
 import atexit
 import os
 import logging
@@ -10,14 +10,21 @@ from datetime import datetime, timezone
 from device import Device
 from battery import Battery
 from solar_controller import SolarController
+from hass_client import get_client
+from cassette import record_pass
+import metrics
+import sun
+from config_store import invalidate as invalidate_config
 from utils import get_sunrise_time, setup_logging, entity_state_to_is_on
 from runtime_state import serialize_runtime_state, apply_runtime_state
+from state_mirror import StateMirror
 from mqtt_client import (connect as mqtt_connect, disconnect as mqtt_disconnect,
                          publish_message, update_device_state, publish_status,
                          sync_device_switch_discovery, sync_global_switch_discovery,
                          publish_switch_state, set_switch_command_handler)
 
 HASS_URL = os.environ.get('HASS_URL', 'http://supervisor/core')
+hass = get_client()
 
 # Set up logging using the centralized configuration
 logger = setup_logging()
@@ -82,13 +89,33 @@ DEVICES_FILE = f'{DATA_DIR}/devices.json'
 SETTINGS_FILE = f'{DATA_DIR}/settings.json'
 BATTERY_FILE = f'{DATA_DIR}/battery.json'
 STATE_FILE = f'{DATA_DIR}/state.json'
+CASSETTE_DIR = f'{DATA_DIR}/cassettes'
+CASSETTES_KEPT = 5
+
+# Live mirror of the entities we use, fed by the HA WebSocket API
+state_mirror = StateMirror(HASS_URL, os.environ.get('SUPERVISOR_TOKEN', ''))
 
 # Create controller instance
 controller = SolarController(
     config_file=CONFIG_FILE,
-    devices_file=DEVICES_FILE
+    devices_file=DEVICES_FILE,
+    state_mirror=state_mirror
 )
 
+def refresh_state_mirror():
+    """Point the state mirror at the entities the current configuration uses."""
+    try:
+        state_mirror.set_entities(controller.referenced_entity_ids())
+    except Exception as e:
+        logger.error(f"Error updating state mirror entities: {e}")
+
+if os.environ.get('SUPERVISOR_TOKEN'):
+    sun.init_location(hass)
+    refresh_state_mirror()
+    state_mirror.start()
+else:
+    logger.warning("No supervisor token - state mirror disabled, reading states over REST")
+
 # Initialize MQTT connection
 logger.info("Initializing MQTT connection...")
 if mqtt_connect():
@@ -168,6 +195,7 @@ def _set_power_optimization(enabled):
     settings['power_optimization_enabled'] = enabled
     with open(SETTINGS_FILE, 'w') as f:
         json.dump(settings, f, indent=4)
+    invalidate_config(SETTINGS_FILE)
     # Legacy plain topic (kept for existing user automations) + discovered switch
     publish_message('solar_control/optimization_enabled', str(enabled).lower(), retain=True)
     publish_switch_state('optimization', None, enabled)
@@ -236,22 +264,11 @@ def get_device_state(name):
             return jsonify({'status': 'error', 'message': 'Device not found'}), 404
 
         # Get the current state from Home Assistant
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        if not supervisor_token:
+        if not hass.has_token:
             logger.error("No supervisor token available in environment")
             return jsonify({'status': 'error', 'message': 'No supervisor token available'}), 500
 
-        headers = {
-            "Authorization": f"Bearer {supervisor_token}",
-            "Content-Type": "application/json",
-        }
-
-        response = requests.get(
-            f"{HASS_URL}/api/states/{device.switch_entity}",
-            headers=headers
-        )
-        response.raise_for_status()
-        state = response.json().get('state', 'off')
+        state = hass.get_state(device.switch_entity).get('state', 'off')
         logger.debug(f"Retrieved state for device {name}: {state}")
 
         # Publish state to MQTT
@@ -302,6 +319,7 @@ def set_device_state(name):
 # teardown_appcontext handler — those run after every request, which was
 # silently killing the MQTT connection on the first page load.)
 atexit.register(mqtt_disconnect)
+atexit.register(state_mirror.stop)
 
 # Log static file configuration
 logger.info('Static folder: %s', app.static_folder)
@@ -447,27 +465,15 @@ def get_sensor_values():
     except (FileNotFoundError, json.JSONDecodeError):
         config = {}
     
-    # Get supervisor token from environment
-    supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-    if not supervisor_token:
+    if not hass.has_token:
         logger.error("No supervisor token found in environment")
         return {}
     
-    headers = {
-        "Authorization": f"Bearer {supervisor_token}",
-        "Content-Type": "application/json",
-    }
-    
     sensor_values = {}
     for entity_id in ['solar_generation', 'grid_power', 'solar_forecast', 'tariff_rate']:
         if entity_id in config and config[entity_id]:
             try:
-                response = requests.get(
-                    f'{HASS_URL}/api/states/{config[entity_id]}',
-                    headers=headers
-                )
-                response.raise_for_status()  # Raise exception for non-200 status codes
-                sensor_values[entity_id] = response.json()
+                sensor_values[entity_id] = _read_entity_state(config[entity_id])
             except Exception as e:
                 logger.error(f"Error fetching {entity_id} value: {e}")
     
@@ -500,12 +506,8 @@ def get_sensor_values():
             # Fetch battery percentage entity state if configured
             if battery.battery_percent_entity:
                 try:
-                    response = requests.get(
-                        f'{HASS_URL}/api/states/{battery.battery_percent_entity}',
-                        headers=headers
-                    )
-                    response.raise_for_status()
-                    sensor_values['battery_percent'] = response.json()
+                    sensor_values['battery_percent'] = _read_entity_state(
+                        battery.battery_percent_entity)
                 except Exception as e:
                     logger.error(f"Error fetching battery_percent value: {e}")
     except Exception as e:
@@ -514,12 +516,19 @@ def get_sensor_values():
     return sensor_values
 
 
+def _read_entity_state(entity_id):
+    """Return an entity's state object, from the live mirror when it has it
+    and over REST otherwise. Raises on REST errors."""
+    state = state_mirror.get(entity_id)
+    if state is not None:
+        return state
+    return hass.get_state(entity_id)
+
+
 def get_entities():
     try:
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        headers = {"Authorization": f"Bearer {supervisor_token}", "Content-Type": "application/json"} if supervisor_token else {}
         logger.info("Attempting to fetch entities from supervisor API")
-        response = requests.get(f'{HASS_URL}/api/states', headers=headers)
+        response = hass.get('/api/states')
         logger.info(f"Supervisor API response status: {response.status_code}")
         
         if response.status_code != 200:
@@ -578,6 +587,7 @@ def configure_grid():
             'grid_voltage_fixed': request.form.get('grid_voltage_fixed'),
             'tariff_rate': request.form.get('tariff_rate'),
             'site_export_limit': request.form.get('site_export_limit'),
+            'grid_trigger_delta': request.form.get('grid_trigger_delta'),
             'tariff_modes': request.form.get('tariff_modes')
         }
         
@@ -589,6 +599,15 @@ def configure_grid():
                 config['site_export_limit'] = None
         else:
             config['site_export_limit'] = None
+
+        # Blank keeps the default; 0 disables early passes on grid changes
+        if config['grid_trigger_delta'] not in (None, ''):
+            try:
+                config['grid_trigger_delta'] = float(config['grid_trigger_delta'])
+            except ValueError:
+                config['grid_trigger_delta'] = None
+        else:
+            config['grid_trigger_delta'] = None
             
         # Parse tariff_modes JSON if provided
         if config['tariff_modes']:
@@ -602,9 +621,11 @@ def configure_grid():
         # Save configuration
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=4)
+        invalidate_config(CONFIG_FILE)
         
         # Update controller configuration
         controller.update_config(config)
+        refresh_state_mirror()
         
         ingress_path = request.headers.get('X-Ingress-Path', '')
         return redirect(ingress_path + '/')    
@@ -671,7 +692,7 @@ def get_device(name):
         
         # Get the device object and update its energy delivered value
         device = device_state.device
-        device.update_energy_delivered()
+        device.update_energy_delivered(state_mirror.get(device.energy_sensor))
         
         # Get the device data and add runtime state
         device_data = device.to_dict()
@@ -697,7 +718,7 @@ def get_devices():
         for device_state in controller.device_states.values():
             device = device_state.device
             # Update energy delivered value
-            device.update_energy_delivered()
+            device.update_energy_delivered(state_mirror.get(device.energy_sensor))
             
             # Get device data and add runtime state
             device_data = device.to_dict()
@@ -798,6 +819,7 @@ def add_device():
         devices.append(device)
         Device.save_all(devices, DEVICES_FILE)
         controller.initialize_device_states()
+        refresh_state_mirror()
         sync_mqtt_discovery()
 
         logger.info(f"Successfully added device: {device.name}")
@@ -827,6 +849,7 @@ def update_device(name):
         devices[device_index] = Device.from_dict(device_data)
         Device.save_all(devices, DEVICES_FILE)
         controller.initialize_device_states()
+        refresh_state_mirror()
         sync_mqtt_discovery()
 
         logger.info(f"Successfully updated device: {name}")
@@ -845,6 +868,7 @@ def delete_device(name):
         devices = [d for d in devices if d.name != name]
         Device.save_all(devices, DEVICES_FILE)
         controller.initialize_device_states()
+        refresh_state_mirror()
         sync_mqtt_discovery()
 
         logger.info(f"Successfully deleted device: {name}")
@@ -902,7 +926,10 @@ def get_status():
         status = {
             'status': 'running',
             'version': APP_VERSION,
-            'power_optimization_enabled': settings.get('power_optimization_enabled', False)
+            'power_optimization_enabled': settings.get('power_optimization_enabled', False),
+            'detailed_timings': settings.get('detailed_timings', False),
+            'hass_requests': hass.stats(),
+            'hass_circuit': hass.breaker.to_dict()
         }
         
         # Add debug state information if available
@@ -916,6 +943,13 @@ def get_status():
         logger.error(f"Error getting status: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Controller internals in the Prometheus text format, for scraping."""
+    response = make_response(metrics.REGISTRY.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 @app.route('/api/control/run', methods=['POST'])
 def run_control_loop():
     try:
@@ -927,6 +961,28 @@ def run_control_loop():
         logger.error(f"Error running control loop: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
+@app.route('/api/debug/cassette', methods=['POST'])
+def record_cassette():
+    """Run a pass now with its Home Assistant traffic recorded to a cassette,
+    for replaying offline (python -m simulator.replay)."""
+    try:
+        cassette = record_pass(controller, DATA_DIR)
+        os.makedirs(CASSETTE_DIR, exist_ok=True)
+        name = f"cassette-{cassette.recorded_at:%Y%m%dT%H%M%SZ}.json.gz"
+        cassette.save(os.path.join(CASSETTE_DIR, name))
+        for old in sorted(os.listdir(CASSETTE_DIR))[:-CASSETTES_KEPT]:
+            os.remove(os.path.join(CASSETTE_DIR, old))
+        logger.info(f"Recorded cassette {name} ({len(cassette.interactions)} requests)")
+        return jsonify({'status': 'success', 'file': name, 'requests': len(cassette.interactions)})
+    except Exception as e:
+        logger.error(f"Error recording cassette: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@app.route('/api/debug/cassettes/<name>', methods=['GET'])
+def download_cassette(name):
+    """Serve a recorded cassette from CASSETTE_DIR as an attachment."""
+    return send_from_directory(CASSETTE_DIR, name, as_attachment=True)
+
 @app.route('/api/settings/power_optimization', methods=['POST'])
 def update_power_optimization():
     try:
@@ -938,26 +994,39 @@ def update_power_optimization():
         logger.error(f"Error updating power optimization setting: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
+@app.route('/api/settings/detailed_timings', methods=['POST'])
+def update_detailed_timings():
+    """Turn per-device timing spans in the debug state on or off."""
+    try:
+        enabled = bool(request.json.get('enabled', False))
+        try:
+            with open(SETTINGS_FILE, 'r') as f:
+                settings = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            settings = {}
+        settings['detailed_timings'] = enabled
+        with open(SETTINGS_FILE, 'w') as f:
+            json.dump(settings, f, indent=4)
+        invalidate_config(SETTINGS_FILE)
+        logger.info(f"Detailed timings set to: {enabled}")
+        return jsonify({'status': 'success'})
+    except Exception as e:
+        logger.error(f"Error updating detailed timings setting: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
 @app.route('/api/states/<entity_id>', methods=['GET'])
 def get_entity_state(entity_id):
     try:
         logger.debug(f"Getting state for entity: {entity_id}")
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        if not supervisor_token:
+        mirrored = state_mirror.get(entity_id)
+        if mirrored is not None:
+            return jsonify(mirrored)
+
+        if not hass.has_token:
             logger.error("No supervisor token available in environment")
             return jsonify({'status': 'error', 'message': 'No supervisor token available'}), 500
 
-        headers = {
-            "Authorization": f"Bearer {supervisor_token}",
-            "Content-Type": "application/json",
-        }
-
-        response = requests.get(
-            f"{HASS_URL}/api/states/{entity_id}",
-            headers=headers
-        )
-        response.raise_for_status()
-        state = response.json()
+        state = hass.get_state(entity_id)
         logger.debug(f"Retrieved state for entity {entity_id}: {state}")
         return jsonify(state)
     except requests.exceptions.RequestException as e:
@@ -989,22 +1058,11 @@ def get_tariff_modes():
             })
 
         # Get the options from Home Assistant
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        if not supervisor_token:
+        if not hass.has_token:
             logger.error("No supervisor token available in environment")
             return jsonify({'status': 'error', 'message': 'No supervisor token available'}), 500
 
-        headers = {
-            "Authorization": f"Bearer {supervisor_token}",
-            "Content-Type": "application/json",
-        }
-
-        response = requests.get(
-            f"{HASS_URL}/api/states/{tariff_rate_entity}",
-            headers=headers
-        )
-        response.raise_for_status()
-        state_data = response.json()
+        state_data = hass.get_state(tariff_rate_entity)
         
         # Get the options from the entity's attributes
         options = state_data.get('attributes', {}).get('options', [])
@@ -1042,6 +1100,7 @@ def api_config_grid():
             'grid_voltage_fixed': data.get('grid_voltage_fixed') or None,
             'tariff_rate': data.get('tariff_rate') or None,
             'site_export_limit': None,
+            'grid_trigger_delta': None,
             'tariff_modes': data.get('tariff_modes', {}),
         }
 
@@ -1051,6 +1110,12 @@ def api_config_grid():
             except (ValueError, TypeError):
                 config['site_export_limit'] = None
 
+        if data.get('grid_trigger_delta') not in (None, ''):
+            try:
+                config['grid_trigger_delta'] = float(data['grid_trigger_delta'])
+            except (ValueError, TypeError):
+                config['grid_trigger_delta'] = None
+
         if isinstance(config['tariff_modes'], str):
             try:
                 config['tariff_modes'] = json.loads(config['tariff_modes'])
@@ -1059,8 +1124,10 @@ def api_config_grid():
 
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=4)
+        invalidate_config(CONFIG_FILE)
 
         controller.update_config(config)
+        refresh_state_mirror()
         return jsonify({'status': 'success'})
     except Exception as e:
         logger.error(f"Error saving grid config via API: {e}")
@@ -1133,6 +1200,7 @@ def update_battery():
 
         # Save configuration
         if battery.save(BATTERY_FILE):
+            refresh_state_mirror()
             logger.info("Successfully updated battery configuration")
             return jsonify({'status': 'success'})
         else:
@@ -1142,20 +1210,13 @@ def update_battery():
         logger.error(f"Error updating battery configuration: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 400
 
-def _get_ha_headers():
-    token = os.environ.get('SUPERVISOR_TOKEN', '')
-    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-
 def _integrate_power_history(entity_id, start_dt):
     """Fetch HA history for a power sensor (W) from start_dt to now and integrate to kWh."""
     try:
         start_str = start_dt.strftime('%Y-%m-%dT%H:%M:%S')
-        resp = requests.get(
-            f"{HASS_URL}/api/history/period/{start_str}",
-            params={'filter_entity_id': entity_id, 'minimal_response': 'true', 'no_attributes': 'true'},
-            headers=_get_ha_headers(),
-            timeout=15
+        resp = hass.get(
+            f"/api/history/period/{start_str}",
+            params={'filter_entity_id': entity_id, 'minimal_response': 'true', 'no_attributes': 'true'}
         )
         states = resp.json()[0] if resp.ok and resp.json() else []
     except Exception as e:
@@ -1193,11 +1254,9 @@ def _integrate_grid_history(entity_id, start_dt):
     """Like _integrate_power_history but splits import (positive) and export (negative) kWh."""
     try:
         start_str = start_dt.strftime('%Y-%m-%dT%H:%M:%S')
-        resp = requests.get(
-            f"{HASS_URL}/api/history/period/{start_str}",
-            params={'filter_entity_id': entity_id, 'minimal_response': 'true', 'no_attributes': 'true'},
-            headers=_get_ha_headers(),
-            timeout=15
+        resp = hass.get(
+            f"/api/history/period/{start_str}",
+            params={'filter_entity_id': entity_id, 'minimal_response': 'true', 'no_attributes': 'true'}
         )
         states = resp.json()[0] if resp.ok and resp.json() else []
     except Exception as e:
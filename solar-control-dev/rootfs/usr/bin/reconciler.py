@@ -0,0 +1,115 @@
+"""Differential actuation: turn a plan into the minimal set of HA commands.
+
+The control phases produce a desired vector {device: (on, amperage)}. The
+reconciler compares it with the last confirmed actual vector (what HA reports,
+plus amperages we've successfully written) and emits commands only for the
+differences. Amperage writes within AMPERAGE_DEADBAND of the current value are
+skipped, and a command already sent but not yet reflected in HA's state (a
+switch whose state change hasn't been reported back yet) isn't re-sent until
+IN_FLIGHT_TIMEOUT passes. Service calls per pass scale with the number of
+changes, not the number of devices.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+AMPERAGE_DEADBAND = 0.5    # A: smaller amperage changes aren't written
+IN_FLIGHT_TIMEOUT = 30.0   # s: re-send an unconfirmed command after this long
+
+
+@dataclass(frozen=True)
+class DeviceTarget:
+    """Desired or actual state of one device."""
+    on: bool
+    amperage: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class Command:
+    """What to send for one device. turn_on None leaves the switch alone;
+    amperage None means no amperage write."""
+    name: str
+    turn_on: Optional[bool]
+    amperage: Optional[float] = None
+    # Batch position: turn-offs (0), then amperage reductions (1), then the
+    # rest (2), so freed power is available before anything draws more
+    batch: int = 2
+
+
+class Reconciler:
+    """Diffs desired against actual device state, deduping in-flight commands."""
+
+    def __init__(self, deadband: float = AMPERAGE_DEADBAND, in_flight_timeout: float = IN_FLIGHT_TIMEOUT):
+        self.deadband = deadband
+        self.in_flight_timeout = in_flight_timeout
+        # (device name, 'switch' | 'amperage') -> (value, monotonic time sent)
+        self._in_flight: Dict[Tuple[str, str], Tuple[object, float]] = {}
+        self._lock = threading.Lock()
+        self.deduplicated = 0
+
+    def _pending(self, name: str, kind: str, value, now: float) -> bool:
+        sent = self._in_flight.get((name, kind))
+        return sent is not None and sent[0] == value and now - sent[1] < self.in_flight_timeout
+
+    def diff(self, desired: Dict[str, DeviceTarget], actual: Dict[str, DeviceTarget],
+             now: Optional[float] = None) -> List[Command]:
+        """Commands that bring actual to desired, in batch order.
+
+        Args:
+            desired: Planned state for every managed device
+            actual: Last confirmed state of the same devices
+        """
+        now = time.monotonic() if now is None else now
+        commands = []
+        with self._lock:
+            for name, want in desired.items():
+                have = actual.get(name, DeviceTarget(False))
+
+                turn_on = None
+                if want.on != have.on:
+                    if self._pending(name, 'switch', want.on, now):
+                        self.deduplicated += 1
+                    else:
+                        turn_on = want.on
+                else:
+                    self._in_flight.pop((name, 'switch'), None)
+
+                amperage = None
+                if want.on and want.amperage is not None:
+                    if have.amperage is not None and abs(want.amperage - have.amperage) < self.deadband:
+                        self._in_flight.pop((name, 'amperage'), None)
+                    elif self._pending(name, 'amperage', want.amperage, now):
+                        self.deduplicated += 1
+                    else:
+                        amperage = want.amperage
+
+                if turn_on is None and amperage is None:
+                    continue
+                if turn_on is False:
+                    batch = 0
+                elif turn_on is None and have.amperage is not None and amperage < have.amperage:
+                    batch = 1
+                else:
+                    batch = 2
+                commands.append(Command(name, turn_on, amperage, batch))
+        return sorted(commands, key=lambda command: command.batch)
+
+    def sent(self, command: Command, now: Optional[float] = None):
+        """Record a command HA accepted; it's in flight until confirmed."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if command.turn_on is not None:
+                self._in_flight[(command.name, 'switch')] = (command.turn_on, now)
+            if command.amperage is not None:
+                self._in_flight[(command.name, 'amperage')] = (command.amperage, now)
+
+    def forget(self, name: str):
+        """Drop in-flight records for a device (e.g. it was removed or failed)."""
+        with self._lock:
+            self._in_flight.pop((name, 'switch'), None)
+            self._in_flight.pop((name, 'amperage'), None)
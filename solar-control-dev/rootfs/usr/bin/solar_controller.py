@@ -1,16 +1,30 @@
 #!/usr/bin/python3
 
+import asyncio
 import logging
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-import requests
 import os
 import math
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional
 from dataclasses import dataclass
+import requests
 from device import Device
-from battery import Battery
+import battery as battery_math
+from battery import Battery, BatteryStatus
+from clock import Clock, get_clock
+from config_store import JsonFileStore, invalidate, thaw, validate_settings, validate_solar_config
+from allocation import (AllocationPlan, AmperageDemand, Candidate, Option, get_allocator,
+                        share_weight, water_fill)
+from entity_metadata import get_registry
+from entity_snapshot import EntitySnapshot, LastGoodStates, collect_entity_ids
+from hass_client import RequestAccount, get_client
+from metrics import Counter, Gauge, Histogram
+from reconciler import Command, DeviceTarget, Reconciler
+from sun import get_sun
+from timing import NULL_SPAN, Span
 import json
 import mqtt_client
 from utils import setup_logging, entity_state_to_is_on
@@ -18,7 +32,42 @@ from utils import setup_logging, entity_state_to_is_on
 # Configure logging
 logger = setup_logging()
 
-
+# Cap on concurrent HA requests while gathering a loop iteration's inputs
+# (kept below the shared client's connection pool size)
+FETCH_CONCURRENCY = 8
+
+# Cap on devices actuated at once, to avoid flooding the supervisor when a
+# tariff change switches many devices in one pass
+ACTUATION_CONCURRENCY = 4
+
+# Prometheus metrics (rendered by /api/metrics)
+LOOP_SECONDS = Histogram('solar_control_loop_duration_seconds', 'Duration of a control loop pass.')
+PHASE_SECONDS = Histogram('solar_control_phase_duration_seconds',
+                          'Duration of each phase of a control loop pass.', ['phase'])
+LOOP_PASSES = Counter('solar_control_loop_passes_total', 'Control loop passes run.', ['trigger'])
+LOOP_SKIPS = Counter('solar_control_loop_skipped_total',
+                     'Control loop passes skipped because one was already running.')
+AVAILABLE_POWER = Gauge('solar_control_available_power_watts', 'Power available to optional devices.')
+GRID_POWER = Gauge('solar_control_grid_power_watts', 'Grid power at the last pass (negative is export).')
+DEVICE_POWER = Gauge('solar_control_device_allocated_power_watts',
+                     'Power allocated to each device by the last pass.', ['device'])
+DEVICE_AMPERAGE = Gauge('solar_control_device_allocated_amperage_amps',
+                        'Amperage allocated to each variable-amperage device by the last pass.', ['device'])
+COMMANDS = Counter('solar_control_commands_total', 'Device commands sent to Home Assistant.', ['result'])
+
+# Loop scheduling: a pass runs at least every HEARTBEAT_INTERVAL, and sooner
+# when grid power moves by more than the configured grid_trigger_delta
+HEARTBEAT_INTERVAL = 60          # seconds
+MIN_LOOP_INTERVAL = 15           # seconds between the starts of two passes
+TRIGGER_DEBOUNCE = 3             # seconds to let a burst of changes settle
+GRID_POLL_INTERVAL = 10          # seconds, grid_power poll when the state mirror is down
+DEFAULT_GRID_TRIGGER_DELTA = 300  # watts
+
+# Resilience when Home Assistant is slow or down: a pass stops making REST
+# reads once LOOP_DEADLINE has passed, and unreadable entities are served from
+# their last good state if it is no older than STALE_MAX_AGE
+LOOP_DEADLINE = 30               # seconds
+STALE_MAX_AGE = 600              # seconds
 
 
 @dataclass
@@ -26,7 +75,8 @@ class DeviceState:
     """Tracks the current state of a device"""
     device: Device
     is_on: bool = False
-    last_state_change: datetime = None
+    last_state_change: datetime = None               # wall time, for display
+    last_state_change_monotonic: Optional[float] = None  # clock.monotonic() then, for min on/off timers
     current_amperage: Optional[float] = None
     has_completed: bool = False
     one_off_charge_target: Optional[float] = None   # kWh requested
@@ -35,6 +85,23 @@ class DeviceState:
     car_soc: Optional[float] = None                  # car: SoC %, refreshed once per control loop
     auto_control: bool = True                        # False = hands off: controller never commands this device
 
+    def mark_state_change(self, clock: Clock):
+        """Record that the device switched now."""
+        self.last_state_change = clock.now()
+        self.last_state_change_monotonic = clock.monotonic()
+
+    def seconds_since_change(self, clock: Clock) -> Optional[float]:
+        """Seconds since the device last switched, or None if it hasn't.
+
+        Measured on the monotonic clock, so stepping the wall clock (NTP, a
+        manual change) doesn't shorten or stretch min on/off times. A state
+        given only a wall time falls back to it."""
+        if self.last_state_change_monotonic is not None:
+            return clock.monotonic() - self.last_state_change_monotonic
+        if self.last_state_change is not None:
+            return (clock.now() - self.last_state_change).total_seconds()
+        return None
+
 @dataclass
 class DebugState:
     """Tracks debug information about the controller's decisions"""
@@ -51,7 +118,16 @@ class DebugState:
     hours_until_sunset: Optional[float] = None
     bring_forward_power: Optional[float] = None
     control_mode: str = 'unknown'
+    trigger: str = 'heartbeat'
+    tariff_mode: Optional[str] = None
+    is_daylight: Optional[bool] = None
     power_breakdown: Optional[List[Dict]] = None
+    actuation: Optional[List[Dict]] = None  # one entry per command sent this pass
+    degraded: bool = False                  # HA couldn't be fully read this pass
+    degraded_reasons: Optional[List[str]] = None
+    actuation_held: bool = False            # degraded badly enough not to touch devices
+    ha_requests: Optional[Dict] = None      # RequestAccount.to_dict() for the pass
+    timings: Optional[Dict] = None          # Span.to_dict() of the pass's phases
 
     def to_dict(self) -> dict:
         return {
@@ -68,31 +144,228 @@ class DebugState:
             'hours_until_sunset': self.hours_until_sunset,
             'bring_forward_power': self.bring_forward_power,
             'control_mode': self.control_mode,
-            'power_breakdown': self.power_breakdown or []
+            'trigger': self.trigger,
+            'tariff_mode': self.tariff_mode,
+            'is_daylight': self.is_daylight,
+            'power_breakdown': self.power_breakdown or [],
+            'actuation': self.actuation or [],
+            'degraded': self.degraded,
+            'degraded_reasons': self.degraded_reasons or [],
+            'actuation_held': self.actuation_held,
+            'ha_requests': self.ha_requests or {},
+            'timings': self.timings or {}
         }
 
+@dataclass
+class IterationContext:
+    """Conditions evaluated once at the start of a control loop iteration, so
+    every phase sees the same values"""
+    tariff_mode: str
+    is_daylight: bool
+    grid_voltage: float
+    control_mode: str = 'unknown'
+
 class SolarController:
-    def __init__(self, config_file: str, devices_file: str):
+    def __init__(self, config_file: str, devices_file: str, state_mirror=None,
+                 clock: Optional[Clock] = None):
         self.config_file = config_file
+        self.clock = clock or get_clock()  # every timing decision reads this
         self.devices_file = devices_file
         self.settings_file = os.environ.get('DATA_DIR', '/data') + '/settings.json'
+        self._config_store = JsonFileStore(config_file, validate=validate_solar_config, default={})
+        self._settings_store = JsonFileStore(self.settings_file, validate=validate_settings,
+                                             default={'power_optimization_enabled': True})  # Default to enabled
         self.device_states: Dict[str, DeviceState] = {}
-        self.supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        self.hass_url = os.environ.get('HASS_URL', 'http://supervisor/core')
+        self.hass = get_client()
         self.debug_state: Optional[DebugState] = None
         self.manual_power_override: Optional[float] = None
         self._loop_lock = threading.Lock()
+        self._snapshot: Optional[EntitySnapshot] = None
+        self._context: Optional[IterationContext] = None  # set for the duration of a loop iteration
+        self._current_battery: Optional[Battery] = None
+        self._battery_status: Optional[BatteryStatus] = None  # evaluated once per loop iteration
+        self.state_mirror = state_mirror  # StateMirror fed by the HA WebSocket API, if running
+        self._rest_only = False           # ignore the mirror for this pass (recording a cassette)
+        self._wake = threading.Event()    # set to run the next pass early
+        self._trigger = 'heartbeat'       # why the current pass is running
+        self._last_run_grid_power: Optional[float] = None
+        self._reconciler = Reconciler()   # turns each pass's plan into the minimal command set
+        self._actuation_pool = ThreadPoolExecutor(max_workers=ACTUATION_CONCURRENCY,
+                                                  thread_name_prefix='actuate')
+        self.entity_metadata = get_registry()
+        self._last_good = LastGoodStates(self.clock)
+        self._deadline: Optional[float] = None     # monotonic time the current pass stops reading REST
+        self._degraded_reasons: List[str] = []
+        self._inputs_missing = False               # an input fell back to a hard-coded default
+        self.last_pass_requests: Optional[RequestAccount] = None
+        self._timings = NULL_SPAN                  # root Span of the pass in progress
+        if state_mirror is not None:
+            state_mirror.add_listener(self._on_entity_change)
+            state_mirror.add_registry_listener(self.entity_metadata.invalidate)
         
-    def get_headers(self) -> dict:
-        """Get headers for Home Assistant API requests"""
-        return {
-            "Authorization": f"Bearer {self.supervisor_token}",
-            "Content-Type": "application/json",
-            "X-Solar-Controller": "solar-control-addon"  # Add custom header to identify our addon
-        }
+    def get_entity_state(self, entity_id: str) -> dict:
+        """Return the Home Assistant state object for an entity.
+
+        Served from the current iteration's snapshot when one is active, then
+        from the live WebSocket mirror, otherwise fetched with a single GET.
+        If HA can't be reached (or the pass is past its deadline) the last
+        good state is served instead, and the pass is marked degraded.
+        Raises on failure (including an entity the snapshot knows does not
+        exist) so callers keep their existing error handling and fallbacks."""
+        if self._snapshot is not None and self._snapshot.covers(entity_id):
+            state = self._snapshot.get(entity_id)
+            if state is not None:
+                return state
+            if entity_id in self._snapshot.failed:
+                return self._last_good_state(entity_id, ConnectionError(f"Could not read {entity_id}"))
+            raise LookupError(f"Entity {entity_id} not available from Home Assistant")
+        if self.state_mirror is not None and not self._rest_only:
+            state = self.state_mirror.get(entity_id)
+            if state is not None:
+                return state
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            return self._last_good_state(entity_id, TimeoutError(f"Loop deadline passed - not reading {entity_id}"))
+        try:
+            state = self.hass.get_state(entity_id)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code < 500:
+                raise  # HA answered: the entity is missing, not stale
+            return self._last_good_state(entity_id, e)
+        except requests.exceptions.RequestException as e:
+            return self._last_good_state(entity_id, e)
+        self._last_good.remember(entity_id, state)
+        return state
+
+    def _last_good_state(self, entity_id: str, error: Exception) -> dict:
+        """Serve an entity's last good state after a failed read, or re-raise
+        error if there is none recent enough. Either way the pass is degraded."""
+        entry = self._last_good.get(entity_id, STALE_MAX_AGE)
+        if entry is None:
+            self.note_degraded(f"{entity_id} unavailable: {error}", inputs_missing=True)
+            raise error
+        state, age = entry
+        self.note_degraded(f"{entity_id} is {age:.0f}s old")
+        logger.warning(f"Using last good state of {entity_id} ({age:.0f}s old): {error}")
+        return state
+
+    def note_degraded(self, reason: str, inputs_missing: bool = False):
+        """Record why this pass isn't working from fresh HA data."""
+        if reason not in self._degraded_reasons:
+            self._degraded_reasons.append(reason)
+        self._inputs_missing = self._inputs_missing or inputs_missing
+
+    @property
+    def is_degraded(self) -> bool:
+        """True if the current pass is running on stale or missing inputs."""
+        return bool(self._degraded_reasons)
+
+    def referenced_entity_ids(self) -> set:
+        """All entity IDs referenced by the grid, device and battery configuration."""
+        battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
+        entity_ids = collect_entity_ids(self.load_config(), Device.load_all(self.devices_file), battery)
+        if get_sun() is not None:
+            entity_ids.discard('sun.sun')  # sun times are calculated locally
+        return entity_ids
+
+    def take_entity_snapshot(self) -> Optional[EntitySnapshot]:
+        """Capture every entity this iteration needs.
+
+        Taken from the WebSocket mirror when it is live and tracking all of
+        them (no network at all), otherwise with one bulk request. Returns
+        None if that fails; getters then fall back to per-entity GETs."""
+        try:
+            entity_ids = self.referenced_entity_ids()
+            if self.state_mirror is not None and not self._rest_only:
+                # Follow config changes; newly referenced entities are synced
+                # by the mirror and served by REST until then
+                self.state_mirror.set_entities(entity_ids)
+                if self.state_mirror.covers(entity_ids):
+                    return EntitySnapshot(self.state_mirror.snapshot(entity_ids),
+                                          requested=entity_ids)
+            return EntitySnapshot.fetch(self.hass, entity_ids)
+        except Exception as e:
+            logger.warning(f"Bulk entity fetch failed, falling back to per-entity reads: {e}")
+            return None
+
+    async def _fetch_entities_concurrently(self, entity_ids) -> EntitySnapshot:
+        """Fetch entities one GET each, all in flight at once (bounded by
+        FETCH_CONCURRENCY). Used when the bulk read fails, so the pass costs
+        one round trip of latency rather than one per entity. Entities that
+        fail are left out and read as unavailable by the getters."""
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def fetch(entity_id):
+            async with semaphore:
+                try:
+                    return entity_id, await asyncio.to_thread(self.hass.get_state, entity_id)
+                except requests.exceptions.HTTPError as e:
+                    if e.response is not None and e.response.status_code < 500:
+                        return entity_id, None  # doesn't exist
+                    logger.warning(f"Failed to fetch {entity_id}: {e}")
+                    return entity_id, False
+                except Exception as e:
+                    logger.warning(f"Failed to fetch {entity_id}: {e}")
+                    return entity_id, False
+
+        results = await asyncio.gather(*(fetch(e) for e in sorted(entity_ids)))
+        return EntitySnapshot({e: state for e, state in results if state},
+                              requested=set(entity_ids),
+                              failed={e for e, state in results if state is False})
+
+    async def _update_energy_tracking(self, span: Span = NULL_SPAN):
+        """Refresh every device's energy-delivered counter concurrently. An
+        update is normally answered by the energy ledger with no I/O, but a
+        sensor with no baseline for today yet (e.g. after starting during the
+        day) needs one history lookup; gathering keeps those lookups from
+        adding up device by device, and devices don't depend on each other."""
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def update(device):
+            async with semaphore:
+                current = self._snapshot.get(device.energy_sensor) if self._snapshot else None
+                with span.detail(device.name):
+                    await asyncio.to_thread(device.update_energy_delivered, current)
+
+        await asyncio.gather(*(update(device_state.device)
+                               for device_state in self.device_states.values()
+                               if device_state.device.energy_sensor))
+
+    async def _gather_inputs(self):
+        """Data-gathering phase of a loop iteration.
+
+        Everything that talks to Home Assistant happens here, with independent
+        requests running concurrently; the decision phase that follows is
+        synchronous and reads only what was gathered (getters are served from
+        self._snapshot)."""
+        with self._timings.span('state_sync'):
+            self._snapshot = await asyncio.to_thread(self.take_entity_snapshot)
+            if self._snapshot is None:
+                entity_ids = await asyncio.to_thread(self.referenced_entity_ids)
+                self._snapshot = await self._fetch_entities_concurrently(entity_ids)
+            self._last_good.remember_all(self._snapshot.states)
+            self.entity_metadata.prime(self._snapshot.states)
+
+        # Initialize/update device states
+        with self._timings.span('device_states'):
+            self.initialize_device_states()
+
+        # Refresh car SoC caches (and auto-clear completed road trips)
+        with self._timings.span('car_refresh') as phase:
+            self.refresh_car_states(phase)
+
+        # Update energy delivered tracking for each device
+        with self._timings.span('energy') as phase:
+            await self._update_energy_tracking(phase)
         
+    def _unit_of(self, entity_id: str, state: dict, default: str) -> str:
+        """unit_of_measurement from the metadata registry (filled from state
+        if the entity isn't cached yet)."""
+        return self.entity_metadata.get(entity_id, state).unit or default
+
     def get_grid_voltage(self) -> float:
         """Get the current grid voltage"""
+        if self._context is not None:
+            return self._context.grid_voltage
         config = self.load_config()
         if config.get('grid_voltage_fixed'):
             return float(config['grid_voltage_fixed'])
@@ -103,12 +376,7 @@ class SolarController:
             
         try:
             logger.debug(f"Fetching grid voltage from {config['grid_voltage']}")
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['grid_voltage']}", 
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            voltage = float(response.json().get('state', 230.0))
+            voltage = float(self.get_entity_state(config['grid_voltage']).get('state', 230.0))
             logger.debug(f"Grid voltage: {voltage}V")
             return voltage
         except Exception as e:
@@ -149,15 +417,11 @@ class SolarController:
 
         try:
             logger.debug(f"Fetching grid power from {config['grid_power']}")
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['grid_power']}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            grid_power = float(response.json().get('state', 0))
+            grid_state = self.get_entity_state(config['grid_power'])
+            grid_power = float(grid_state.get('state', 0))
 
             # Convert to watts if needed
-            unit = response.json().get('attributes', {}).get('unit_of_measurement', 'W')
+            unit = self._unit_of(config['grid_power'], grid_state, 'W')
             if unit.lower() == 'kw':
                 grid_power *= 1000
                 logger.debug(f"Converted grid power from kW to W: {grid_power}W")
@@ -240,22 +504,12 @@ class SolarController:
             return 0.0
             
     def load_config(self) -> dict:
-        """Load configuration from file"""
-        try:
-            with open(self.config_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Failed to load config: {e}")
-            return {}
+        """Load configuration (read-only; re-read from file only when it changes)"""
+        return self._config_store.get()
             
     def load_settings(self) -> dict:
-        """Load settings from file"""
-        try:
-            with open(self.settings_file, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Failed to load settings: {e}")
-            return {'power_optimization_enabled': True}  # Default to enabled
+        """Load settings (read-only; re-read from file only when it changes)"""
+        return self._settings_store.get()
             
     def get_device_state_from_hass(self, device: Device) -> Optional[bool]:
         """Get the current state of a device from Home Assistant.
@@ -266,12 +520,7 @@ class SolarController:
         counts as on."""
         try:
             logger.debug(f"Fetching state for device {device.name} from {device.switch_entity}")
-            response = requests.get(
-                f"{self.hass_url}/api/states/{device.switch_entity}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            state = entity_state_to_is_on(response.json().get('state'))
+            state = entity_state_to_is_on(self.get_entity_state(device.switch_entity).get('state'))
             logger.debug(f"Device {device.name} state: {state}")
             return state
         except Exception as e:
@@ -301,12 +550,13 @@ class SolarController:
                 if new_is_on is not None and self.device_states[device.name].is_on != new_is_on:
                     logger.info(f"External state change detected for {device.name}: {new_is_on}")
                     self.device_states[device.name].is_on = new_is_on
-                    self.device_states[device.name].last_state_change = datetime.now(timezone.utc)
+                    self.device_states[device.name].mark_state_change(self.clock)
                 
         # Remove states for devices that no longer exist
+        device_names = {d.name for d in devices}
         self.device_states = {
             name: state for name, state in self.device_states.items()
-            if name in {d.name for d in devices}
+            if name in device_names
         }
         
     def get_device_power(self, device_state: DeviceState) -> float:
@@ -320,15 +570,11 @@ class SolarController:
         if device.current_power_sensor:
             try:
                 logger.debug(f"Fetching power for {device.name} from {device.current_power_sensor}")
-                response = requests.get(
-                    f"{self.hass_url}/api/states/{device.current_power_sensor}",
-                    headers=self.get_headers()
-                )
-                response.raise_for_status()
-                power = float(response.json().get('state', 0))
+                power_state = self.get_entity_state(device.current_power_sensor)
+                power = float(power_state.get('state', 0))
                 
                 # Convert to watts if needed
-                unit = response.json().get('attributes', {}).get('unit_of_measurement', 'W')
+                unit = self._unit_of(device.current_power_sensor, power_state, 'W')
                 if unit.lower() == 'kw':
                     power *= 1000
                     logger.debug(f"Converted power for {device.name} from kW to W: {power}W")
@@ -355,12 +601,8 @@ class SolarController:
             return False
             
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/{device_state.device.completion_sensor}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            return response.json().get('state', 'off').lower() == 'on'
+            state = self.get_entity_state(device_state.device.completion_sensor)
+            return state.get('state', 'off').lower() == 'on'
         except Exception as e:
             logger.error(f"Failed to check completion for {device_state.device.name}: {e}")
             return False
@@ -368,7 +610,7 @@ class SolarController:
     def set_device_state(self, device_state: DeviceState, turn_on: bool, amperage: Optional[float] = None):
         """Set a device's state in Home Assistant"""
         device = device_state.device
-        current_time = datetime.now(timezone.utc)
+        since_change = device_state.seconds_since_change(self.clock)
         
         try:
             # For variable load devices, we can always set the amperage
@@ -377,32 +619,26 @@ class SolarController:
                 logger.debug(f"Device details - min_amperage: {device.min_amperage}A, max_amperage: {device.max_amperage}A")
                 logger.debug(f"Control entity: {device.variable_amperage_control}")
                 
-                service_data = {
-                    "entity_id": device.variable_amperage_control,
-                    "value": amperage
-                }
-                logger.debug(f"Sending request to Home Assistant: {service_data}")
-                
-                # First check the entity type
+                # Domain and number limits come from the metadata registry, so
+                # the write is a single POST
                 try:
-                    logger.debug(f"Checking entity type for {device.variable_amperage_control}")
-                    entity_response = requests.get(
-                        f"{self.hass_url}/api/states/{device.variable_amperage_control}",
-                        headers=self.get_headers()
-                    )
-                    entity_response.raise_for_status()
-                    entity_type = entity_response.json().get('entity_id', '').split('.')[0]
-                    
+                    metadata = self.entity_metadata.get(device.variable_amperage_control)
+                    clamped = metadata.clamp(amperage)
+                    if clamped != amperage:
+                        logger.info(f"Clamped {device.name} amperage {amperage}A to {clamped}A "
+                                    f"(entity min {metadata.min}, max {metadata.max}, step {metadata.step})")
+                        amperage = clamped
+                    service_data = {
+                        "entity_id": device.variable_amperage_control,
+                        "value": amperage
+                    }
+                    logger.debug(f"Sending request to Home Assistant: {service_data}")
+
                     # Use appropriate service based on entity type
-                    service = "input_number/set_value" if entity_type == "input_number" else "number/set_value"
-                    logger.debug(f"Using service: {service} for entity type: {entity_type}")
+                    domain = "input_number" if metadata.domain == "input_number" else "number"
+                    logger.debug(f"Using service: {domain}/set_value for entity type: {metadata.domain}")
                     
-                    response = requests.post(
-                        f"{self.hass_url}/api/services/{service}",
-                        headers=self.get_headers(),
-                        json=service_data
-                    )
-                    response.raise_for_status()
+                    response = self.hass.call_service(domain, "set_value", service_data)
                     logger.info(f"Successfully set amperage for {device.name} to {amperage}A")
                     logger.debug(f"Response status: {response.status_code}")
                     logger.debug(f"Response content: {response.text}")
@@ -418,12 +654,11 @@ class SolarController:
                 # reset the min on/off timer. (Re-sending turn_on on every amperage
                 # change used to re-arm min_on_time indefinitely.)
                 logger.debug(f"{device.name} already {'on' if turn_on else 'off'} - no switch change needed")
-            elif not (device_state.is_on and device_state.last_state_change and
-                   (current_time - device_state.last_state_change).total_seconds() < device.min_on_time):
+            elif not (device_state.is_on and since_change is not None and since_change < device.min_on_time):
                 success = device.set_state(turn_on)
                 if success:
                     device_state.is_on = turn_on
-                    device_state.last_state_change = current_time
+                    device_state.mark_state_change(self.clock)
                     logger.info(f"Set {device.name} to {'on' if turn_on else 'off'}" +
                               (f" with {amperage}A" if amperage is not None else ""))
                 else:
@@ -473,12 +708,7 @@ class SolarController:
         if not device.car_soc_sensor:
             return None
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/{device.car_soc_sensor}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            return float(response.json().get('state'))
+            return float(self.get_entity_state(device.car_soc_sensor).get('state'))
         except Exception as e:
             logger.warning(f"Failed to read car SoC for {device.name}: {e}")
             return None
@@ -509,12 +739,13 @@ class SolarController:
             return 'solar'
         return 'full'
 
-    def refresh_car_states(self):
+    def refresh_car_states(self, span: Span = NULL_SPAN):
         """Refresh cached car SoC values and auto-clear finished road trips."""
         for device_state in self.device_states.values():
             device = device_state.device
             if device.is_car and device.car_soc_sensor:
-                device_state.car_soc = self.get_car_soc(device)
+                with span.detail(device.name):
+                    device_state.car_soc = self.get_car_soc(device)
                 if (device_state.road_trip and device_state.car_soc is not None
                         and device_state.car_soc >= 99.5):
                     logger.info(f"Road trip charge complete for {device.name} "
@@ -549,23 +780,22 @@ class SolarController:
             return 0.0
             
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['grid_power']}", 
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            grid_power = float(response.json().get('state', 0))
-            
-            # Convert to watts if needed
-            unit = response.json().get('attributes', {}).get('unit_of_measurement', 'W')
-            if unit.lower() == 'kw':
-                grid_power *= 1000
-                
-            return grid_power
+            return self._grid_power_from_state(config['grid_power'], self.get_entity_state(config['grid_power']))
         except Exception as e:
             logger.error(f"Failed to get grid power: {e}")
             return 0.0
 
+    def _grid_power_from_state(self, entity_id: str, grid_state: dict) -> float:
+        """Grid power in watts from the grid_power entity's state object."""
+        grid_power = float(grid_state.get('state', 0))
+        
+        # Convert to watts if needed
+        unit = self._unit_of(entity_id, grid_state, 'W')
+        if unit.lower() == 'kw':
+            grid_power *= 1000
+            
+        return grid_power
+
     def get_tariff_rate(self) -> str:
         """Get the current tariff rate from the configured entity
         
@@ -578,12 +808,7 @@ class SolarController:
             return ''
             
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['tariff_rate']}", 
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            return response.json().get('state', '')
+            return self.get_entity_state(config['tariff_rate']).get('state', '')
         except Exception as e:
             logger.error(f"Failed to get tariff rate: {e}")
             return ''
@@ -594,6 +819,8 @@ class SolarController:
         Returns:
             str: The current tariff mode ('normal', 'cheap', or 'free')
         """
+        if self._context is not None:
+            return self._context.tariff_mode
         config = self.load_config()
         if not config.get('tariff_rate'):
             logger.warning("No tariff rate configured, defaulting to normal mode")
@@ -601,12 +828,7 @@ class SolarController:
             
         try:
             # Get current tariff rate from Home Assistant
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['tariff_rate']}", 
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            current_tariff = response.json().get('state')
+            current_tariff = self.get_entity_state(config['tariff_rate']).get('state')
             
             if not current_tariff:
                 logger.warning("No current tariff rate available, defaulting to normal mode")
@@ -642,13 +864,14 @@ class SolarController:
         Returns:
             datetime: Sunset time in local timezone, or None if unable to determine
         """
+        sun_calc = get_sun()
+        if sun_calc is not None:
+            sunset_time = sun_calc.next_sunset()
+            if sunset_time is not None:
+                logger.debug(f"Sunset time (calculated): {sunset_time}")
+                return sunset_time
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/sun.sun",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            sun_data = response.json()
+            sun_data = self.get_entity_state('sun.sun')
             
             # Get sunset time from attributes
             sunset_str = sun_data.get('attributes', {}).get('next_setting')
@@ -675,7 +898,7 @@ class SolarController:
         if not sunset_time:
             return None
             
-        current_time = datetime.now(timezone.utc)
+        current_time = self.clock.now()
         time_until_sunset = sunset_time - current_time
         hours_until_sunset = time_until_sunset.total_seconds() / 3600
         
@@ -695,15 +918,10 @@ class SolarController:
             
         try:
             logger.debug(f"Fetching solar forecast from {config['solar_forecast']}")
-            response = requests.get(
-                f"{self.hass_url}/api/states/{config['solar_forecast']}", 
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            forecast_data = response.json()
+            forecast_data = self.get_entity_state(config['solar_forecast'])
             
             forecast_value = float(forecast_data.get('state', 0))
-            unit = forecast_data.get('attributes', {}).get('unit_of_measurement', 'kWh')
+            unit = self._unit_of(config['solar_forecast'], forecast_data, 'kWh')
             
             # Convert to kWh if needed
             if unit.lower() == 'wh':
@@ -718,145 +936,71 @@ class SolarController:
             logger.error(f"Failed to get solar forecast: {e}")
             return None
 
+    def read_battery_soc(self, battery: Battery) -> Optional[float]:
+        """Read the battery's state of charge (%), or None if unavailable."""
+        try:
+            battery_data = self.get_entity_state(battery.battery_percent_entity)
+            current_percentage = float(battery_data.get('state', 0))
+            logger.debug(f"Current battery percentage: {current_percentage}%")
+            return current_percentage
+        except Exception as e:
+            logger.error(f"Failed to read battery SoC from {battery.battery_percent_entity}: {e}")
+            return None
+
+    def get_battery_status(self, battery: Optional[Battery]) -> BatteryStatus:
+        """Read SoC, forecast and time to sunset once and derive all battery math from them."""
+        soc = self.read_battery_soc(battery) if battery else None
+        status = BatteryStatus.evaluate(battery, soc, self.get_solar_forecast_remaining(),
+                                        self.get_hours_until_sunset())
+        if battery:
+            logger.info(f"Battery SoC: {soc}%, needs {status.charging_requirement_kwh}kWh; "
+                        f"expected energy remaining: {status.expected_energy_remaining_kwh}kWh; "
+                        f"bring forward power: {status.bring_forward_power_w}W")
+        return status
+
+    def _load_battery(self, battery=None) -> Optional[Battery]:
+        if battery is None:
+            battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
+        if not battery:
+            logger.debug("No battery configuration found")
+        return battery or None
+
     def get_battery_charging_requirement(self, battery=None) -> Optional[float]:
         """Calculate the energy required to fully charge the battery.
 
         Returns:
             float: Energy required to charge battery in kWh, or None if unable to determine
         """
-        try:
-            # Use provided battery or load from file
-            if battery is None:
-                battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
-            if not battery:
-                logger.debug("No battery configuration found")
-                return None
-                
-            # Get current battery percentage
-            response = requests.get(
-                f"{self.hass_url}/api/states/{battery.battery_percent_entity}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            battery_data = response.json()
-            
-            current_percentage = float(battery_data.get('state', 0))
-            logger.debug(f"Current battery percentage: {current_percentage}%")
-            
-            # Calculate energy needed to charge to 100%
-            energy_needed = battery.size_kwh * (100 - current_percentage) / 100
-            
-            logger.debug(f"Battery charging requirement: {energy_needed}kWh")
-            return energy_needed
-            
-        except Exception as e:
-            logger.error(f"Failed to calculate battery charging requirement: {e}")
+        battery = self._load_battery(battery)
+        if not battery:
             return None
+        return battery_math.charging_requirement_kwh(battery, self.read_battery_soc(battery))
 
     def is_battery_full_enough(self, battery=None) -> bool:
         """Check if the battery is full enough (>95%) to allow normal device control.
 
         Returns:
-            bool: True if battery is >95% charged, False otherwise or if unable to determine
+            bool: True if battery is >95% charged (or absent/unreadable), False otherwise
         """
-        try:
-            if battery is None:
-                battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
-            if not battery:
-                logger.debug("No battery configuration found")
-                return True  # No battery means no restrictions
-                
-            # Get current battery percentage
-            response = requests.get(
-                f"{self.hass_url}/api/states/{battery.battery_percent_entity}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            battery_data = response.json()
-            
-            current_percentage = float(battery_data.get('state', 0))
-            logger.debug(f"Current battery percentage: {current_percentage}%")
-            
-            # Consider battery "full enough" if >95%
-            is_full_enough = current_percentage > 95
-            logger.debug(f"Battery full enough: {is_full_enough}")
-            return is_full_enough
-            
-        except Exception as e:
-            logger.error(f"Failed to check battery fullness: {e}")
-            return True  # Default to allowing control if we can't determine
+        battery = self._load_battery(battery)
+        if not battery:
+            return True  # No battery means no restrictions
+        return battery_math.is_full_enough(battery, self.read_battery_soc(battery))
 
     def get_bring_forward_power(self, battery=None) -> Optional[float]:
         """Calculate the bring forward power based on battery level and solar forecast.
 
-        The calculation uses two factors:
-        1. Battery level factor: 0 when battery is at 50%, 1 when battery is at 100%
-        2. Forecast factor: 0 when solar forecast is 0, 1 when solar forecast is 10kWh or greater
+        See battery.bring_forward_power_w. The control loop uses the value
+        from its per-iteration BatteryStatus instead.
 
         Returns:
             float: Bring forward power in watts, or None if unable to determine
         """
-        try:
-            if battery is None:
-                battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
-            if not battery:
-                logger.debug("No battery configuration found")
-                return None
-                
-            if battery.max_charging_speed_kw is None:
-                logger.debug("No maximum charging speed configured for battery")
-                return None
-                
-            # Get current battery percentage
-            response = requests.get(
-                f"{self.hass_url}/api/states/{battery.battery_percent_entity}",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            battery_data = response.json()
-            
-            current_percentage = float(battery_data.get('state', 0))
-            logger.debug(f"Current battery percentage: {current_percentage}%")
-            
-            # Calculate bring_forward_battery factor (0 at 50%, 1 at 100%)
-            if current_percentage <= 50:
-                bring_forward_battery = 0.0
-            elif current_percentage >= 100:
-                bring_forward_battery = 1.0
-            else:
-                # Linear interpolation between 50% and 100%
-                bring_forward_battery = (current_percentage - 50) / 50
-                
-            logger.debug(f"Bring forward battery factor: {bring_forward_battery}")
-            
-            # Get solar forecast remaining
-            solar_forecast = self.get_expected_energy_remaining(battery)
-            if solar_forecast is None:
-                logger.debug("Unable to get solar forecast")
-                return None
-                
-            # Calculate bring_forward_forecast factor (0 at 0kWh, 1 at 10kWh or greater)
-            if solar_forecast <= 0:
-                bring_forward_forecast = 0.0
-            elif solar_forecast >= 10:
-                bring_forward_forecast = 1.0
-            else:
-                # Linear interpolation between 0kWh and 10kWh
-                bring_forward_forecast = solar_forecast / 10
-                
-            logger.debug(f"Bring forward forecast factor: {bring_forward_forecast}")
-            
-            # Calculate final bring forward power
-            bring_forward_power_kw = bring_forward_battery * bring_forward_forecast * battery.max_charging_speed_kw
-            bring_forward_power_w = bring_forward_power_kw * 1000  # Convert kW to W
-            
-            logger.info(f"Bring forward power: {bring_forward_power_w}W (battery factor: {bring_forward_battery:.2f}, forecast factor: {bring_forward_forecast:.2f}, max charging speed: {battery.max_charging_speed_kw}kW)")
-            
-            return bring_forward_power_w
-            
-        except Exception as e:
-            logger.error(f"Failed to calculate bring forward power: {e}")
+        battery = self._load_battery(battery)
+        if not battery or battery.max_charging_speed_kw is None:
             return None
+        return battery_math.bring_forward_power_w(battery, self.read_battery_soc(battery),
+                                                  self.get_expected_energy_remaining(battery))
 
     def get_expected_energy_remaining(self, battery=None) -> Optional[float]:
         """Calculate the expected energy remaining in the forecast today after accounting
@@ -871,52 +1015,22 @@ class SolarController:
             logger.warning("Unable to get solar forecast - cannot calculate expected energy remaining")
             return None
 
-        try:
-            if battery is None:
-                battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
-            if not battery:
-                logger.debug("No battery configuration found - using full solar forecast")
-                return solar_forecast
-
-            if battery.expected_kwh_per_hour is None:
-                logger.debug("Battery configured but expected_kwh_per_hour not set - using full solar forecast")
-                return solar_forecast
-
-            # Get hours until sunset
-            hours_until_sunset = self.get_hours_until_sunset()
-            if hours_until_sunset is None:
-                logger.warning("Unable to get hours until sunset - using full solar forecast")
-                return solar_forecast
-
-            # Calculate house energy consumption
-            house_energy_needed = battery.expected_kwh_per_hour * hours_until_sunset
-
-            # Calculate battery charging requirement
-            battery_energy_needed = self.get_battery_charging_requirement(battery)
-            if battery_energy_needed is None:
-                logger.warning("Unable to calculate battery charging requirement - using house energy only")
-                battery_energy_needed = 0
-
-            total_energy_needed = house_energy_needed + battery_energy_needed
-            net_energy = solar_forecast - total_energy_needed
-
-            logger.info(f"Solar forecast: {solar_forecast}kWh, House needs: {house_energy_needed}kWh, Battery needs: {battery_energy_needed}kWh, Total: {total_energy_needed}kWh over {hours_until_sunset:.2f}h, Net available: {net_energy}kWh")
-
-            return max(0, net_energy)
-
-        except Exception as e:
-            logger.error(f"Failed to calculate expected energy remaining: {e}")
-            return solar_forecast  # Fall back to full solar forecast
+        battery = self._load_battery(battery)
+        if not battery or battery.expected_kwh_per_hour is None:
+            return solar_forecast
+        return battery_math.expected_energy_remaining_kwh(
+            solar_forecast, battery, self.get_hours_until_sunset(),
+            self.get_battery_charging_requirement(battery))
 
     def is_between_dawn_and_dusk(self) -> bool:
         """Check if current time is between dawn and dusk using sun.sun entity"""
+        if self._context is not None:
+            return self._context.is_daylight
+        sun_calc = get_sun()
+        if sun_calc is not None:
+            return sun_calc.is_above_horizon()
         try:
-            response = requests.get(
-                f"{self.hass_url}/api/states/sun.sun",
-                headers=self.get_headers()
-            )
-            response.raise_for_status()
-            sun_data = response.json()
+            sun_data = self.get_entity_state('sun.sun')
             
             # Check if sun is above horizon
             return sun_data['state'] == 'above_horizon'
@@ -925,7 +1039,7 @@ class SolarController:
             logger.error(f"Failed to check sun state: {e}")
             return True  # Default to True if we can't determine state
 
-    def _run_free_mode(self, voltage: float, devices_to_turn_on: List[Tuple]):
+    def _run_free_mode(self, voltage: float, devices_to_turn_on: AllocationPlan):
         """Run free tariff mode control logic - maximize all devices"""
         logger.info("Running in free tariff mode - maximizing all devices")
         optional_devices = []
@@ -939,7 +1053,7 @@ class SolarController:
                 continue
 
             # Check if device is already in devices_to_turn_on
-            existing_index = next((i for i, (d, _, _) in enumerate(devices_to_turn_on) if d == device_state), None)
+            existing = device_state in devices_to_turn_on
 
             # Skip if device has completed its task
             if device.run_once and device_state.has_completed:
@@ -948,8 +1062,7 @@ class SolarController:
                     'power': 0,
                     'reason': 'Task completed'
                 })
-                if existing_index is not None:
-                    devices_to_turn_on.pop(existing_index)
+                devices_to_turn_on.remove(device_state)
                 continue
 
             # Skip fully-charged cars
@@ -959,13 +1072,12 @@ class SolarController:
                     'power': 0,
                     'reason': 'Car fully charged'
                 })
-                if existing_index is not None:
-                    devices_to_turn_on.pop(existing_index)
+                devices_to_turn_on.remove(device_state)
                 continue
 
             # Skip if device is in minimum off time (and not already locked on by Phase 1)
-            if existing_index is None and not device_state.is_on and device_state.last_state_change:
-                time_since_change = (datetime.now(timezone.utc) - device_state.last_state_change).total_seconds()
+            if not existing and not device_state.is_on and device_state.last_state_change:
+                time_since_change = device_state.seconds_since_change(self.clock)
                 if time_since_change < device.min_off_time:
                     logger.info(f"Skipping {device.name} in free mode - minimum off time not met")
                     optional_devices.append({
@@ -979,16 +1091,10 @@ class SolarController:
             if device.has_variable_amperage:
                 max_amperage = device.max_amperage
                 power_needed = voltage * max_amperage
-                if existing_index is not None:
-                    devices_to_turn_on[existing_index] = (device_state, power_needed, max_amperage)
-                else:
-                    devices_to_turn_on.append((device_state, power_needed, max_amperage))
+                devices_to_turn_on.set(device_state, power_needed, max_amperage)
             else:
                 power_needed = device.typical_power_draw
-                if existing_index is not None:
-                    devices_to_turn_on[existing_index] = (device_state, power_needed, None)
-                else:
-                    devices_to_turn_on.append((device_state, power_needed, None))
+                devices_to_turn_on.set(device_state, power_needed, None)
             
             optional_devices.append({
                 'name': device.name,
@@ -998,59 +1104,163 @@ class SolarController:
         
         self.debug_state.optional_devices = optional_devices
 
-    def run_control_loop(self):
+    def run_control_loop(self, trigger: str = 'manual', wait: bool = False, rest_only: bool = False):
         """Main control loop - runs one iteration.
 
         Guarded by a lock: the background thread and the /api/control/run
         endpoint can both trigger it, and overlapping runs would race on
-        device_states/debug_state and duplicate HA service calls."""
-        if not self._loop_lock.acquire(blocking=False):
+        device_states/debug_state and duplicate HA service calls.
+
+        Args:
+            trigger: Why this pass runs ('heartbeat', 'grid change', 'manual'),
+                shown in the debug state
+            wait: Wait for a pass in progress to finish instead of skipping
+            rest_only: Read every state over REST even if the WebSocket
+                mirror is live, so a cassette records all of them"""
+        if not self._loop_lock.acquire(blocking=wait):
             logger.info("Control loop already running - skipping this iteration")
+            LOOP_SKIPS.inc()
             return
         try:
+            self._trigger = trigger
+            self._rest_only = rest_only
             self._run_control_loop_iteration()
         finally:
+            self._rest_only = False
             self._loop_lock.release()
 
-    def _run_control_loop_iteration(self):
+    def grid_trigger_delta(self) -> Optional[float]:
+        """Grid power change (W) that triggers an early pass, or None if disabled."""
+        value = self.load_config().get('grid_trigger_delta')
+        if value in (None, ''):
+            return DEFAULT_GRID_TRIGGER_DELTA
         try:
-            # Initialize/update device states
-            self.initialize_device_states()
-
-            # Refresh car SoC caches (and auto-clear completed road trips)
-            self.refresh_car_states()
-            
-            # Get current conditions
-            grid_power = self.get_grid_power()
-            voltage = self.get_grid_voltage()
-            current_time = datetime.now(timezone.utc)
-            
-            # Load settings
-            settings = self.load_settings()
-            power_optimization_enabled = settings.get('power_optimization_enabled', True)
-            
-            # Load battery config once for the whole loop iteration
+            value = float(value)
+        except (TypeError, ValueError):
+            return DEFAULT_GRID_TRIGGER_DELTA
+        return value if value > 0 else None
+
+    def on_grid_power(self, grid_power: float):
+        """Wake the loop if grid power has moved far enough from the value the
+        last pass acted on."""
+        delta = self.grid_trigger_delta()
+        if delta is None or self._last_run_grid_power is None:
+            return
+        change = grid_power - self._last_run_grid_power
+        if abs(change) >= delta and not self._wake.is_set():
+            logger.info(f"Grid power changed by {change:+.0f}W since last pass - running early")
+            self._wake.set()
+
+    def _on_entity_change(self, entity_id: str, new_state: Optional[dict]):
+        """State mirror listener (runs on the WebSocket thread - keep it cheap)."""
+        if new_state is None or entity_id != self.load_config().get('grid_power'):
+            return
+        try:
+            self.on_grid_power(self._grid_power_from_state(entity_id, new_state))
+        except (TypeError, ValueError):
+            pass  # unavailable/unknown
+
+    def _poll_grid_power(self):
+        """Watch grid power with a cheap single-entity poll while the state
+        mirror can't push changes."""
+        while True:
+            self.clock.sleep(GRID_POLL_INTERVAL)
+            if self.state_mirror is not None and self.state_mirror.is_live:
+                continue
+            entity_id = self.load_config().get('grid_power')
+            if not entity_id or self.grid_trigger_delta() is None or self._last_run_grid_power is None:
+                continue
             try:
-                self._current_battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
+                self.on_grid_power(self._grid_power_from_state(entity_id, self.hass.get_state(entity_id)))
             except Exception as e:
-                logger.error(f"Error loading battery config: {e}")
-                self._current_battery = None
+                logger.debug(f"Grid power poll failed: {e}")
+
+    def _wait_for_next_run(self, last_start: float) -> str:
+        """Block until the next pass is due; return its trigger.
+
+        Runs on the heartbeat, or early when woken by a grid change - after a
+        short debounce and never sooner than MIN_LOOP_INTERVAL after the last
+        pass started, so device min on/off times and HA aren't churned."""
+        if not self.clock.wait(self._wake, HEARTBEAT_INTERVAL):
+            return 'heartbeat'
+        self.clock.sleep(TRIGGER_DEBOUNCE)
+        remaining = MIN_LOOP_INTERVAL - (self.clock.monotonic() - last_start)
+        if remaining > 0:
+            self.clock.sleep(remaining)
+        return 'grid change'
 
-            # Get solar forecast and energy remaining information
-            solar_forecast_remaining = self.get_solar_forecast_remaining()
-            expected_energy_remaining = self.get_expected_energy_remaining(self._current_battery)
-            hours_until_sunset = self.get_hours_until_sunset()
+    def _run_control_loop_iteration(self):
+        # Account for every HA request the pass makes and time each phase
+        # (and, with detailed_timings set, each device within a phase); both
+        # go on the debug state and the phase durations into metrics
+        timings = Span('pass', detailed=bool(self.load_settings().get('detailed_timings', False)))
+        self._timings = timings
+        try:
+            with self.hass.account() as account, timings:
+                self._run_pass()
+        finally:
+            self._timings = NULL_SPAN
+        LOOP_SECONDS.observe(timings.duration_ms / 1000)
+        for phase in timings.children:
+            if phase.duration_ms is not None:
+                PHASE_SECONDS.observe(phase.duration_ms / 1000, phase=phase.name)
+        LOOP_PASSES.inc(trigger=self._trigger)
+        self.last_pass_requests = account
+        if self.debug_state is not None:
+            self.debug_state.ha_requests = account.to_dict()
+            self.debug_state.timings = timings.to_dict()
+
+    def _run_pass(self):
+        self._deadline = time.monotonic() + LOOP_DEADLINE
+        self._degraded_reasons = []
+        self._inputs_missing = False
+        try:
+            # Read every entity this pass needs (one bulk request, or concurrent
+            # per-entity reads if that fails); the getters below are served from
+            # the snapshot instead of one GET each
+            asyncio.run(self._gather_inputs())
+
+            # Get current conditions. Tariff mode, sun state, voltage and the
+            # control mode derived from them are evaluated once here; the
+            # getters return these values for the rest of the iteration
+            with self._timings.span('environment'):
+                grid_power = self.get_grid_power()
+                self._last_run_grid_power = grid_power
+                self._context = IterationContext(
+                    tariff_mode=self.get_current_tariff_mode(),
+                    is_daylight=self.is_between_dawn_and_dusk(),
+                    grid_voltage=self.get_grid_voltage(),
+                )
+                voltage = self._context.grid_voltage
+                current_time = self.clock.now()
 
-            # Get bring forward power for solar control mode
-            bring_forward_power = None
-            try:
-                battery = self._current_battery
-                if battery and battery.bring_forward_mode:
-                    bring_forward_power = self.get_bring_forward_power(battery)
+                # Load settings
+                settings = self.load_settings()
+                power_optimization_enabled = settings.get('power_optimization_enabled', True)
+
+                # Load battery config once for the whole loop iteration
+                try:
+                    self._current_battery = Battery.load(os.environ.get('DATA_DIR', '/data') + '/battery.json')
+                except Exception as e:
+                    logger.error(f"Error loading battery config: {e}")
+                    self._current_battery = None
+
+                # Battery SoC, solar forecast and the energy/bring-forward math
+                # derived from them, read once for every phase of this iteration
+                self._battery_status = self.get_battery_status(self._current_battery)
+                solar_forecast_remaining = self._battery_status.solar_forecast_kwh
+                expected_energy_remaining = self._battery_status.expected_energy_remaining_kwh
+                hours_until_sunset = self._battery_status.hours_until_sunset
+
+                # Bring forward power for solar control mode
+                bring_forward_power = None
+                if self._current_battery and self._current_battery.bring_forward_mode:
+                    bring_forward_power = self._battery_status.bring_forward_power_w
                     logger.debug(f"Bring forward power calculated: {bring_forward_power}W")
-            except Exception as e:
-                logger.error(f"Error getting bring forward power: {e}")
-            
+
+            with self._timings.span('mode_selection'):
+                self._context.control_mode = self._determine_control_mode()
+
             # Initialize debug state
             self.debug_state = DebugState(
                 timestamp=current_time,
@@ -1062,119 +1272,150 @@ class SolarController:
                 solar_forecast_remaining=solar_forecast_remaining,
                 expected_energy_remaining=expected_energy_remaining,
                 hours_until_sunset=hours_until_sunset,
-                bring_forward_power=bring_forward_power
+                bring_forward_power=bring_forward_power,
+                control_mode=self._context.control_mode,
+                trigger=self._trigger,
+                tariff_mode=self._context.tariff_mode,
+                is_daylight=self._context.is_daylight
             )
 
             # Phase 1: Handle mandatory devices (common to all control modes)
             mandatory_devices = []
-            devices_to_turn_on = []
-            
-            # Update energy delivered tracking for each device
-            for device_state in self.device_states.values():
-                device = device_state.device
-                if device.energy_sensor:
-                    device.update_energy_delivered()
-            
-            for device_state in self.device_states.values():
-                device = device_state.device
-
-                # Clear stale completion if the sensor has gone off again — this
-                # must run in every control mode, not just cheap/free tariff
-                self.refresh_completion_status(device_state)
-
-                # Check if device has completed its task
-                if device.run_once and device_state.is_on:
-                    if self.check_device_completion(device_state):
-                        device_state.has_completed = True
-                        logger.info(f"Device {device.name} has completed its task")
-                        continue
-
-                # Hands-off device: track its state above, but never add it to
-                # the control lists — min on/off timers and the car protection
-                # floor don't apply while the user is controlling it manually
-                if not device_state.auto_control:
-                    mandatory_devices.append({
-                        'name': device.name,
-                        'power': self.get_device_power(device_state) if device_state.is_on else 0,
-                        'reason': 'Manual control - auto control disabled'
-                    })
-                    continue
-
-                # Check minimum on/off times
-                if device_state.last_state_change:
-                    time_since_change = (current_time - device_state.last_state_change).total_seconds()
-
-                    if device_state.is_on and time_since_change < device.min_on_time:
-                        # Must stay on
-                        power = self.get_device_power(device_state)
-                        mandatory_devices.append({
-                            'name': device.name,
-                            'power': power,
-                            'reason': 'Minimum on time not met'
-                        })
-                        logger.info(f"Device {device.name} must stay on due to minimum on time")
-                        # For variable amperage devices in tariff mode, set to maximum
-                        if device.has_variable_amperage and self.get_current_tariff_mode() in ['cheap', 'free']:
-                            max_amperage = device.max_amperage
-                            power = voltage * max_amperage
-                            devices_to_turn_on.append((device_state, power, max_amperage))
-                        else:
-                            devices_to_turn_on.append((device_state, power, device_state.current_amperage))
-                        continue
-                        
-                    if not device_state.is_on and time_since_change < device.min_off_time:
-                        # Must stay off
-                        mandatory_devices.append({
-                            'name': device.name,
-                            'power': 0,
-                            'reason': 'Minimum off time not met'
-                        })
-                        logger.info(f"Device {device.name} must stay off due to minimum off time")
-                        continue
-
-                # Car protection floor: below car_floor_soc the car charges in any
-                # mode and at any tariff, at maximum rate
-                if device.is_car and self.get_car_charge_tier(device_state) == 'floor':
-                    if device.has_variable_amperage:
-                        floor_amperage = device.max_amperage
-                        floor_power = voltage * floor_amperage
-                    else:
-                        floor_amperage = None
-                        floor_power = self.get_device_power(device_state) if device_state.is_on else device.typical_power_draw
-                    mandatory_devices.append({
-                        'name': device.name,
-                        'power': floor_power,
-                        'reason': f'Car below protection floor ({device.car_floor_soc:.0f}%)'
-                    })
-                    devices_to_turn_on.append((device_state, floor_power, floor_amperage))
-                    logger.info(f"Car {device.name} below protection floor "
-                                f"(SoC {device_state.car_soc}%) - mandatory charge at max rate")
-                    continue
+            devices_to_turn_on = AllocationPlan()
+
+            with self._timings.span('mandatory') as phase:
+                for device_state in self.device_states.values():
+                    with phase.detail(device_state.device.name):
+                        device = device_state.device
+
+                        # Clear stale completion if the sensor has gone off again — this
+                        # must run in every control mode, not just cheap/free tariff
+                        self.refresh_completion_status(device_state)
+
+                        # Check if device has completed its task
+                        if device.run_once and device_state.is_on:
+                            if self.check_device_completion(device_state):
+                                device_state.has_completed = True
+                                logger.info(f"Device {device.name} has completed its task")
+                                continue
+
+                        # Hands-off device: track its state above, but never add it to
+                        # the control lists — min on/off timers and the car protection
+                        # floor don't apply while the user is controlling it manually
+                        if not device_state.auto_control:
+                            mandatory_devices.append({
+                                'name': device.name,
+                                'power': self.get_device_power(device_state) if device_state.is_on else 0,
+                                'reason': 'Manual control - auto control disabled'
+                            })
+                            continue
+
+                        # Check minimum on/off times
+                        if device_state.last_state_change:
+                            time_since_change = device_state.seconds_since_change(self.clock)
+
+                            if device_state.is_on and time_since_change < device.min_on_time:
+                                # Must stay on
+                                power = self.get_device_power(device_state)
+                                mandatory_devices.append({
+                                    'name': device.name,
+                                    'power': power,
+                                    'reason': 'Minimum on time not met'
+                                })
+                                logger.info(f"Device {device.name} must stay on due to minimum on time")
+                                # For variable amperage devices in tariff mode, set to maximum
+                                if device.has_variable_amperage and self._context.tariff_mode in ['cheap', 'free']:
+                                    max_amperage = device.max_amperage
+                                    power = voltage * max_amperage
+                                    devices_to_turn_on.set(device_state, power, max_amperage)
+                                else:
+                                    devices_to_turn_on.set(device_state, power, device_state.current_amperage)
+                                continue
+
+                            if not device_state.is_on and time_since_change < device.min_off_time:
+                                # Must stay off
+                                mandatory_devices.append({
+                                    'name': device.name,
+                                    'power': 0,
+                                    'reason': 'Minimum off time not met'
+                                })
+                                logger.info(f"Device {device.name} must stay off due to minimum off time")
+                                continue
+
+                        # Car protection floor: below car_floor_soc the car charges in any
+                        # mode and at any tariff, at maximum rate
+                        if device.is_car and self.get_car_charge_tier(device_state) == 'floor':
+                            if device.has_variable_amperage:
+                                floor_amperage = device.max_amperage
+                                floor_power = voltage * floor_amperage
+                            else:
+                                floor_amperage = None
+                                floor_power = self.get_device_power(device_state) if device_state.is_on else device.typical_power_draw
+                            mandatory_devices.append({
+                                'name': device.name,
+                                'power': floor_power,
+                                'reason': f'Car below protection floor ({device.car_floor_soc:.0f}%)'
+                            })
+                            devices_to_turn_on.set(device_state, floor_power, floor_amperage)
+                            logger.info(f"Car {device.name} below protection floor "
+                                        f"(SoC {device_state.car_soc}%) - mandatory charge at max rate")
+                            continue
 
             self.debug_state.mandatory_devices = mandatory_devices
 
-            # Determine control mode and run appropriate logic
-            control_mode = self._determine_control_mode()
+            # Run the logic for the control mode selected above
+            control_mode = self._context.control_mode
             logger.info(f"Selected control mode: {control_mode}")
-            
-            self.debug_state.control_mode = control_mode
-            if control_mode == 'free':
-                self._run_free_mode(voltage, devices_to_turn_on)
-            elif control_mode == 'solar':
-                available_power = self.get_available_power()
-                self.debug_state.available_power = available_power
-                self._run_solar_control(available_power, voltage, devices_to_turn_on)
-            else:  # tariff mode
-                self._run_tariff_control(voltage, devices_to_turn_on)
+
+            with self._timings.span('allocation'):
+                if control_mode == 'free':
+                    self._run_free_mode(voltage, devices_to_turn_on)
+                elif control_mode == 'solar':
+                    available_power = self.get_available_power()
+                    self.debug_state.available_power = available_power
+                    self._run_solar_control(available_power, voltage, devices_to_turn_on)
+                else:  # tariff mode
+                    self._run_tariff_control(voltage, devices_to_turn_on)
+
+            # Degraded mode: with stale-but-recent inputs the pass goes ahead;
+            # if an input had no usable value or HA is refusing requests,
+            # leave devices as they are rather than act on defaults
+            if self.hass.breaker.state != 'closed':
+                self.note_degraded(f"Home Assistant circuit {self.hass.breaker.state}", inputs_missing=True)
+            self.debug_state.degraded = self.is_degraded
+            self.debug_state.degraded_reasons = list(self._degraded_reasons)
+            self.debug_state.actuation_held = self._inputs_missing
+            self._export_plan_metrics(devices_to_turn_on)
 
             # Only apply state changes if optimization is enabled
-            if self.debug_state.power_optimization_enabled:
-                self._apply_state_changes(devices_to_turn_on)
-            else:
+            if not self.debug_state.power_optimization_enabled:
                 logger.info("Power optimization is disabled - skipping state changes")
+            elif self._inputs_missing:
+                logger.warning(f"Degraded pass - holding device states: {'; '.join(self._degraded_reasons)}")
+            else:
+                with self._timings.span('actuation') as phase:
+                    self._apply_state_changes(devices_to_turn_on, phase)
 
         except Exception as e:
             logger.error(f"Error in control loop: {e}")
+        finally:
+            self._snapshot = None
+            self._context = None
+            self._battery_status = None
+            self._deadline = None
+
+    def _export_plan_metrics(self, plan: AllocationPlan):
+        """Publish the pass's inputs and per-device allocation as gauges."""
+        AVAILABLE_POWER.set(self.debug_state.available_power or 0)
+        if self.debug_state.grid_power is not None:
+            GRID_POWER.set(self.debug_state.grid_power)
+        DEVICE_POWER.clear()
+        DEVICE_AMPERAGE.clear()
+        for name in self.device_states:
+            entry = plan.get(name)
+            DEVICE_POWER.set(entry.power if entry else 0, device=name)
+            if self.device_states[name].device.has_variable_amperage:
+                DEVICE_AMPERAGE.set((entry.amperage or 0) if entry else 0, device=name)
 
     def _determine_control_mode(self) -> str:
         """Determine which control mode to use based on tariff mode and time of day."""
@@ -1194,7 +1435,42 @@ class SolarController:
         logger.info("Selected control mode: tariff (night hours)")
         return 'tariff'
 
-    def _run_solar_control(self, available_power: float, voltage: float, devices_to_turn_on: List[Tuple]):
+    def _allocation_candidate(self, device_state: DeviceState, voltage: float) -> Candidate:
+        """Describe the ways an optional device could run, for the allocator.
+
+        Fixed-power devices have one option: their actual power if on, else
+        typical_power_draw. Variable-amperage devices have one option per whole
+        amp from min_amperage to max_amperage, budgeted with
+        estimate_variable_power (sensor-ratioed if on, so an unplugged car
+        doesn't consume phantom budget) - unless they are on but externally
+        controlled, in which case only max_amperage is offered.
+        """
+        device = device_state.device
+        if not device.has_variable_amperage:
+            if device_state.is_on:
+                power_needed = self.get_device_power(device_state)
+                logger.debug(f"Using actual power for {device.name}: {power_needed}W")
+            else:
+                power_needed = device.typical_power_draw
+                logger.debug(f"Using typical power for {device.name}: {power_needed}W")
+            return Candidate(device.name, device.order, [Option(power_needed)])
+
+        if device_state.is_on and device_state.current_amperage is None:
+            # Device is on but we didn't set the amperage — externally controlled
+            logger.info(f"Device {device.name} is externally controlled "
+                        f"(no amperage tracked) - using max_amperage {device.max_amperage}A")
+            amperages = [device.max_amperage]
+        else:
+            amperages = sorted({device.min_amperage, device.max_amperage} |
+                               {a for a in range(math.ceil(device.min_amperage),
+                                                        math.floor(device.max_amperage) + 1)})
+        nominal_voltage = self.get_grid_voltage()
+        options = [Option(power=self.estimate_variable_power(device, device_state, amperage, voltage),
+                          amperage=amperage, nominal_power=nominal_voltage * amperage)
+                   for amperage in amperages]
+        return Candidate(device.name, device.order, options)
+
+    def _run_solar_control(self, available_power: float, voltage: float, devices_to_turn_on: AllocationPlan):
         """Run solar-based power control logic"""
         logger.info(f"Running solar control mode with {available_power}W available")
         optional_devices = []
@@ -1217,14 +1493,14 @@ class SolarController:
         # Check battery priority - if battery is full enough or we have excess energy, allow normal control
         battery_priority_active = False
         try:
-            battery = self._current_battery
-            if battery and battery.expected_kwh_per_hour is not None:
+            status = self._battery_status
+            if status and status.battery and status.battery.expected_kwh_per_hour is not None:
                 # Check if battery is full enough (>95%)
-                if self.is_battery_full_enough(battery):
+                if status.is_full_enough:
                     logger.info("Battery is full enough (>95%) - allowing normal device control")
                 else:
                     # Check if we have excess energy remaining
-                    expected_energy_remaining = self.get_expected_energy_remaining(battery)
+                    expected_energy_remaining = status.expected_energy_remaining_kwh
                     if expected_energy_remaining is not None and expected_energy_remaining > 0:
                         logger.info(f"Excess energy available ({expected_energy_remaining:.2f}kWh) - allowing normal device control")
                     else:
@@ -1236,8 +1512,12 @@ class SolarController:
             logger.error(f"Error checking battery priority: {e}")
             # Default to allowing control if we can't determine battery status
         
+        # Variable-amperage devices whose current is shared out at the end
+        # (name -> mandatory)
+        balanced: Dict[str, bool] = {}
+
         # First, handle mandatory devices that must stay on
-        for device_state, power, amperage in devices_to_turn_on[:]:
+        for device_state, power, amperage in devices_to_turn_on:
             device = device_state.device
             # Cars below the protection floor keep the max-amperage decision from
             # phase 1 — don't downscale them to fit the solar budget
@@ -1253,7 +1533,10 @@ class SolarController:
                     logger.info(f"Mandatory device {device.name} is externally controlled "
                                 f"(no amperage tracked) - using max_amperage {optimal_amperage}A")
                 else:
-                    optimal_amperage = self.calculate_optimal_amperage(device, available_power)
+                    # Reserve the minimum for now; the remaining current is
+                    # shared with the optional devices below (water-filling)
+                    optimal_amperage = device.min_amperage
+                    balanced[device.name] = True
                 if optimal_amperage is None:
                     logger.info(f"Cannot calculate optimal amperage for {device.name}")
                     continue
@@ -1270,10 +1553,7 @@ class SolarController:
                     power_needed = self.estimate_variable_power(device, device_state, optimal_amperage, voltage)
 
                 # Update the power in devices_to_turn_on
-                for i, (d, p, a) in enumerate(devices_to_turn_on):
-                    if d == device_state:
-                        devices_to_turn_on[i] = (device_state, power_needed, optimal_amperage)
-                        break
+                devices_to_turn_on.set(device_state, power_needed, optimal_amperage)
 
                 logger.info(f"Mandatory device {device.name}: amperage={optimal_amperage}A, budgeted power={power_needed:.0f}W")
                 available_power -= power_needed
@@ -1283,14 +1563,15 @@ class SolarController:
         
         # Sort remaining devices by their order (priority)
         sorted_devices = sorted(
-            [d for d in self.device_states.values() if not any(d == x[0] for x in devices_to_turn_on)],
+            [d for d in self.device_states.values() if d not in devices_to_turn_on],
             key=lambda x: x.device.order
         )
         
-        # Process potential devices in priority order
+        # Work out which devices may be turned on, then let the allocator pick
+        # the combination (and amperages) that best uses the remaining power
+        eligible = []
         for device_state in sorted_devices:
             device = device_state.device
-            logger.debug(f"Processing device {device.name} with {available_power}W available")
 
             # Hands-off device: already listed in the mandatory debug list
             if not device_state.auto_control:
@@ -1299,101 +1580,133 @@ class SolarController:
             # Skip if device has completed its task
             if device.run_once and device_state.has_completed:
                 logger.info(f"Skipping {device.name} - task completed")
-                optional_devices.append({
-                    'name': device.name,
-                    'power': 0,
-                    'reason': 'Task completed'
-                })
+                eligible.append((device_state, 'Task completed'))
                 continue
 
             # Skip fully-charged cars
             if device.is_car and self.get_car_charge_tier(device_state) == 'full':
                 logger.info(f"Skipping {device.name} - car fully charged")
-                optional_devices.append({
-                    'name': device.name,
-                    'power': 0,
-                    'reason': 'Car fully charged'
-                })
+                eligible.append((device_state, 'Car fully charged'))
                 continue
 
             # Skip if device is in minimum off time
             if not device_state.is_on and device_state.last_state_change:
-                time_since_change = (datetime.now(timezone.utc) - device_state.last_state_change).total_seconds()
+                time_since_change = device_state.seconds_since_change(self.clock)
                 if time_since_change < device.min_off_time:
                     logger.info(f"Skipping {device.name} - in minimum off time")
-                    optional_devices.append({
-                        'name': device.name,
-                        'power': 0,
-                        'reason': 'Minimum off time not met'
-                    })
-                    continue
-            
-            # Calculate power needed based on current state of devices_to_turn_on
-            if device.has_variable_amperage:
-                # Determine optimal amperage to set on the device
-                if device_state.is_on and device_state.current_amperage is None:
-                    # Device is on but we didn't set the amperage — externally controlled
-                    optimal_amperage = device.max_amperage
-                    logger.info(f"Device {device.name} is externally controlled "
-                                f"(no amperage tracked) - using max_amperage {optimal_amperage}A")
-                else:
-                    optimal_amperage = self.calculate_optimal_amperage(device, available_power)
-                logger.debug(f"Calculated optimal amperage for {device.name}: {optimal_amperage}A")
-                if optimal_amperage is None:
-                    logger.info(f"Cannot calculate optimal amperage for {device.name}")
-                    optional_devices.append({
-                        'name': device.name,
-                        'power': 0,
-                        'reason': 'Cannot calculate optimal amperage'
-                    })
+                    eligible.append((device_state, 'Minimum off time not met'))
                     continue
 
-                # Power budget: use ratio from actual sensor if device is on (reflects real draw,
-                # e.g. 0W if car is unplugged). Falls back to theoretical if device is off or
-                # no sensor/amperage data available.
-                power_needed = self.estimate_variable_power(device, device_state, optimal_amperage, voltage)
-                logger.debug(f"Power needed for {device.name}: {power_needed:.0f}W at {optimal_amperage}A"
-                             f" ({'sensor-ratioed' if device_state.is_on and device.current_power_sensor else 'theoretical'})")
-            else:
-                # For non-variable devices, use actual power if device is on
-                if device_state.is_on:
-                    power_needed = self.get_device_power(device_state)
-                    logger.debug(f"Using actual power for {device.name}: {power_needed}W")
-                else:
-                    power_needed = device.typical_power_draw
-                    logger.debug(f"Using typical power for {device.name}: {power_needed}W")
-            
-            # Check if we have enough power and battery priority allows it
-            has_enough_power = power_needed <= available_power
-            battery_allows_control = not battery_priority_active
-            
-            if has_enough_power and battery_allows_control:
-                logger.info(f"Turning on {device.name} with {power_needed}W" + 
-                          (f" at {optimal_amperage}A" if device.has_variable_amperage else ""))
-                devices_to_turn_on.append((device_state, power_needed, optimal_amperage if device.has_variable_amperage else None))
-                available_power -= power_needed
-                
+            eligible.append((device_state, None))
+
+        candidates = [self._allocation_candidate(device_state, voltage)
+                      for device_state, skip_reason in eligible if skip_reason is None]
+        allocator = get_allocator(self.load_config().get('allocation_strategy'))
+        chosen = allocator.allocate(candidates, available_power)
+        logger.debug(f"{allocator.name} allocation of {available_power}W: "
+                     f"{ {name: option.power for name, option in chosen.items()} }")
+
+        for device_state, skip_reason in eligible:
+            device = device_state.device
+            if skip_reason is not None:
+                optional_devices.append({'name': device.name, 'power': 0, 'reason': skip_reason})
+                continue
+
+            option = chosen.get(device.name)
+            if option is not None and not battery_priority_active:
+                logger.info(f"Turning on {device.name} with {option.power}W" +
+                          (f" at {option.amperage}A" if device.has_variable_amperage else ""))
+                devices_to_turn_on.set(device_state, option.power, option.amperage)
+                available_power -= option.power
+                if device.has_variable_amperage and not (device_state.is_on and device_state.current_amperage is None):
+                    balanced[device.name] = False
+
                 optional_devices.append({
                     'name': device.name,
-                    'power': power_needed,
+                    'power': option.power,
                     'reason': 'Will be turned on'
                 })
             else:
-                if not has_enough_power:
+                if option is None:
                     reason = 'Not enough power available'
                 else:
                     reason = 'Battery priority active - reserving solar for battery charging'
-                
+
                 logger.info(f"Not turning on {device.name} - {reason}")
                 optional_devices.append({
                     'name': device.name,
                     'power': 0,
                     'reason': reason
                 })
-        
+
+        if balanced:
+            dropped = self._balance_variable_amperage(devices_to_turn_on, available_power, voltage, balanced)
+            for entry in optional_devices:
+                if entry['name'] in dropped:
+                    entry.update(power=0, reason='Not enough power available')
+                elif entry['name'] in devices_to_turn_on:
+                    entry['power'] = devices_to_turn_on.get(entry['name']).power
+
         self.debug_state.optional_devices = optional_devices
 
-    def _run_tariff_control(self, voltage: float, devices_to_turn_on: List[Tuple]):
+    def get_amperage_step(self, device: Device) -> float:
+        """Step size of the device's amperage control entity (its 'step'
+        attribute), defaulting to whole amps."""
+        if not device.variable_amperage_control:
+            return 1.0
+        step = self.entity_metadata.get(device.variable_amperage_control).step
+        return step if step and step > 0 else 1.0
+
+    def _balance_variable_amperage(self, devices_to_turn_on: AllocationPlan, leftover_power: float,
+                                   voltage: float, balanced: Dict[str, bool]) -> set:
+        """Share current across the variable-amperage devices being run.
+
+        The power budgeted to the balanced devices plus whatever is left over
+        is redistributed in one pass by priority-weighted water-filling, and
+        their entries in devices_to_turn_on are rewritten with the resulting
+        amperages. Devices drawing nothing (e.g. an unplugged car) keep their
+        allocation, since moving current to or from them changes nothing.
+
+        Returns:
+            Names of optional devices dropped because the shared budget
+            couldn't give them min_amperage.
+        """
+        entries = {}
+        pool = max(leftover_power, 0.0)
+        for name in balanced:
+            device_state, power, amperage = devices_to_turn_on.get(name)
+            watts_per_amp = self.estimate_variable_power(device_state.device, device_state, 1, voltage)
+            if watts_per_amp <= 0:
+                continue
+            entries[name] = (device_state, watts_per_amp)
+            pool += power
+        if not entries:
+            return set()
+
+        ranked = sorted(entries, key=lambda name: entries[name][0].device.order)
+        demands = [AmperageDemand(
+            name=name,
+            min_amperage=entries[name][0].device.min_amperage,
+            max_amperage=entries[name][0].device.max_amperage,
+            watts_per_amp=entries[name][1],
+            weight=share_weight(rank, len(ranked)),
+            step=self.get_amperage_step(entries[name][0].device),
+            mandatory=balanced[name],
+        ) for rank, name in enumerate(ranked)]
+        amperages = water_fill(demands, pool)
+        logger.info(f"Shared {pool:.0f}W across variable-amperage devices: {amperages}")
+
+        dropped = set()
+        for name, (device_state, watts_per_amp) in entries.items():
+            if name in amperages:
+                devices_to_turn_on.set(device_state, watts_per_amp * amperages[name], amperages[name])
+            else:
+                logger.info(f"Not turning on {name} - not enough power to share")
+                devices_to_turn_on.remove(name)
+                dropped.add(name)
+        return dropped
+
+    def _run_tariff_control(self, voltage: float, devices_to_turn_on: AllocationPlan):
         """Run tariff-based power control logic"""
         logger.info("Running tariff control mode")
         optional_devices = []
@@ -1423,7 +1736,7 @@ class SolarController:
                 continue
 
             # Check if device is already in devices_to_turn_on
-            existing_index = next((i for i, (d, _, _) in enumerate(devices_to_turn_on) if d == device_state), None)
+            existing = device_state in devices_to_turn_on
 
             # Car SoC tier ('floor'/'cheap' means the car wants this power)
             car_tier = self.get_car_charge_tier(device_state) if device.is_car else None
@@ -1460,8 +1773,7 @@ class SolarController:
                         'power': 0,
                         'reason': 'Task completed'
                     })
-                    if existing_index is not None:
-                        devices_to_turn_on.pop(existing_index)
+                    devices_to_turn_on.remove(device_state)
                     continue
                 
                 # Check if device just completed its task
@@ -1473,13 +1785,12 @@ class SolarController:
                         'power': 0,
                         'reason': 'Task completed'
                     })
-                    if existing_index is not None:
-                        devices_to_turn_on.pop(existing_index)
+                    devices_to_turn_on.remove(device_state)
                     continue
             
             # Skip if device is in minimum off time (and not already locked on by Phase 1)
-            if existing_index is None and not device_state.is_on and device_state.last_state_change:
-                time_since_change = (datetime.now(timezone.utc) - device_state.last_state_change).total_seconds()
+            if not existing and not device_state.is_on and device_state.last_state_change:
+                time_since_change = device_state.seconds_since_change(self.clock)
                 if time_since_change < device.min_off_time:
                     logger.info(f"Skipping {device.name} in tariff mode - minimum off time not met")
                     optional_devices.append({
@@ -1529,8 +1840,7 @@ class SolarController:
                     'power': 0,
                     'reason': reason
                 })
-                if existing_index is not None:
-                    devices_to_turn_on.pop(existing_index)
+                devices_to_turn_on.remove(device_state)
                 continue
 
             # If we get here, we need to turn the device on
@@ -1541,17 +1851,11 @@ class SolarController:
                 max_amperage = device.max_amperage
                 power_needed = voltage * max_amperage
                 logger.debug(f"Setting {device.name} to maximum amperage: {max_amperage}A ({power_needed}W)")
-                if existing_index is not None:
-                    devices_to_turn_on[existing_index] = (device_state, power_needed, max_amperage)
-                else:
-                    devices_to_turn_on.append((device_state, power_needed, max_amperage))
+                devices_to_turn_on.set(device_state, power_needed, max_amperage)
             else:
                 power_needed = device.typical_power_draw
                 logger.debug(f"Using typical power for {device.name}: {power_needed}W")
-                if existing_index is not None:
-                    devices_to_turn_on[existing_index] = (device_state, power_needed, None)
-                else:
-                    devices_to_turn_on.append((device_state, power_needed, None))
+                devices_to_turn_on.set(device_state, power_needed, None)
                 
             if car_needs_charging and not has_one_off and not has_regular:
                 turn_on_reason = ('Car below protection floor' if car_tier == 'floor'
@@ -1567,8 +1871,15 @@ class SolarController:
 
         self.debug_state.optional_devices = optional_devices
 
-    def _apply_state_changes(self, devices_to_turn_on: List[Tuple]):
-        """Apply state changes to devices"""
+    def _apply_state_changes(self, devices_to_turn_on: AllocationPlan, span: Span = NULL_SPAN):
+        """Apply state changes to devices.
+
+        The plan is turned into a desired {device: (on, amperage)} vector and
+        diffed against the last confirmed state; only the differences are
+        sent, as one batch ordered so turn-offs and amperage reductions free
+        power before anything is turned on or has its current raised."""
+        desired = {}
+        actual = {}
         for device_state in self.device_states.values():
             # Hands-off device: never send it commands. Without this guard a
             # manually-on device would be force-turned-off (anything not in
@@ -1576,25 +1887,55 @@ class SolarController:
             if not device_state.auto_control:
                 continue
 
-            # Find if this device should be on
-            should_be_on = False
-            power_needed = 0
-            amperage = None
-            
-            for turn_on_device, power, amp in devices_to_turn_on:
-                if turn_on_device == device_state:
-                    should_be_on = True
-                    power_needed = power
-                    amperage = amp
-                    break
-            
-            # Apply state changes
-            if should_be_on:
-                if not device_state.is_on or (device_state.device.has_variable_amperage and device_state.current_amperage != amperage):
-                    self.set_device_state(device_state, True, amperage)
+            name = device_state.device.name
+            entry = devices_to_turn_on.get(device_state)
+            amperage = entry.amperage if entry is not None and device_state.device.has_variable_amperage else None
+            if amperage is not None and device_state.device.variable_amperage_control:
+                # Compare what the entity will actually accept
+                amperage = self.entity_metadata.get(device_state.device.variable_amperage_control).clamp(amperage)
+            desired[name] = DeviceTarget(entry is not None, amperage)
+            actual[name] = DeviceTarget(device_state.is_on, device_state.current_amperage)
+
+        commands = self._reconciler.diff(desired, actual, now=self.clock.monotonic())
+        results = []
+        # Commands within a batch run concurrently (one worker per device, so
+        # each device still gets its amperage before its switch-on); batches
+        # run in order so power is freed before anything draws more
+        for batch in sorted({command.batch for command in commands}):
+            batch_commands = [command for command in commands if command.batch == batch]
+            if len(batch_commands) == 1:
+                results.append(self._actuate(batch_commands[0], span))
             else:
-                if device_state.is_on:
-                    self.set_device_state(device_state, False)
+                results.extend(self._actuation_pool.map(lambda command: self._actuate(command, span),
+                                                        batch_commands))
+        if self.debug_state is not None:
+            self.debug_state.actuation = results
+        logger.info(f"Reconciled {len(desired)} managed devices: {len(commands)} command(s) sent")
+
+    def _actuate(self, command: Command, span: Span = NULL_SPAN) -> dict:
+        """Send one device's command and report how it went."""
+        device_state = self.device_states[command.name]
+        turn_on = device_state.is_on if command.turn_on is None else command.turn_on
+        started = time.monotonic()
+        with span.detail(command.name):
+            if command.amperage is None:
+                self.set_device_state(device_state, turn_on)
+            else:
+                self.set_device_state(device_state, turn_on, command.amperage)
+        accepted = (device_state.is_on == turn_on
+                    and (command.amperage is None or device_state.current_amperage == command.amperage))
+        if accepted:
+            self._reconciler.sent(command, now=self.clock.monotonic())
+        else:
+            self._reconciler.forget(command.name)
+        COMMANDS.inc(result='ok' if accepted else 'failed')
+        return {
+            'name': command.name,
+            'turn_on': command.turn_on,
+            'amperage': command.amperage,
+            'ok': accepted,
+            'duration_ms': round((time.monotonic() - started) * 1000),
+        }
 
     def _handle_disabled_optimization(self):
         """Handle case when optimization is disabled - leave devices in their current state"""
@@ -1612,21 +1953,28 @@ class SolarController:
         self.debug_state.optional_devices = optional_devices
 
     def start_control_loop(self):
-        """Start the control loop in a separate thread"""
-        import threading
+        """Start the control loop in a separate thread.
+
+        Passes run every HEARTBEAT_INTERVAL, and early when grid power moves
+        by grid_trigger_delta (pushed by the state mirror, or polled while it
+        is down)."""
         def loop():
+            trigger = 'heartbeat'
             while True:
-                self.run_control_loop()
-                time.sleep(60)  # Sleep for a minute between iterations
+                self._wake.clear()
+                last_start = self.clock.monotonic()
+                self.run_control_loop(trigger)
+                trigger = self._wait_for_next_run(last_start)
                 
         thread = threading.Thread(target=loop, daemon=True)
         thread.start()
+        threading.Thread(target=self._poll_grid_power, daemon=True, name='grid-power-poll').start()
 
     def update_config(self, new_config: dict):
         """Update configuration with new values"""
         try:
             # Load existing config
-            current_config = self.load_config()
+            current_config = thaw(self.load_config())
             
             # Update with new values
             current_config.update(new_config)
@@ -1634,6 +1982,7 @@ class SolarController:
             # Save updated config
             with open(self.config_file, 'w') as f:
                 json.dump(current_config, f, indent=4)
+            invalidate(self.config_file)
                 
             logger.info(f"Configuration updated: {current_config}")
             
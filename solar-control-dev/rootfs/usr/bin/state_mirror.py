@@ -0,0 +1,218 @@
+"""Live in-memory mirror of Home Assistant entity states over the WebSocket API.
+
+Keeps the states of the entities referenced in solar_config.json,
+devices.json and battery.json up to date from HA's `state_changed` events,
+so the control loop and the Flask helpers can read them without a REST
+round trip. If the socket is down the mirror reports itself as not live and
+readers fall back to REST.
+"""
+
+import itertools
+import json
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import websocket
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_MIN_DELAY = 5     # seconds
+RECONNECT_MAX_DELAY = 300   # seconds
+
+
+def websocket_url(hass_url: str) -> str:
+    """Derive the WebSocket API URL from the REST base URL.
+
+    http://supervisor/core -> ws://supervisor/core/websocket"""
+    if hass_url.startswith('https://'):
+        return 'wss://' + hass_url[len('https://'):].rstrip('/') + '/websocket'
+    if hass_url.startswith('http://'):
+        return 'ws://' + hass_url[len('http://'):].rstrip('/') + '/websocket'
+    return hass_url.rstrip('/') + '/websocket'
+
+
+class StateMirror:
+    """Push-fed cache of a set of Home Assistant entity states."""
+
+    def __init__(self, hass_url: str, token: str):
+        self.url = websocket_url(hass_url)
+        self.token = token
+        self._lock = threading.Lock()
+        self._states: Dict[str, dict] = {}
+        self._entity_ids: Set[str] = set()
+        self._listeners: List[Callable[[str, Optional[dict]], None]] = []
+        self._registry_listeners: List[Callable[[Optional[str]], None]] = []
+        self._ws = None
+        self._ids = itertools.count(1)
+        self._get_states_id: Optional[int] = None
+        self._synced = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Reading ---
+
+    @property
+    def is_live(self) -> bool:
+        """True while connected and holding a full initial sync."""
+        return self._ws is not None and self._synced
+
+    def get(self, entity_id: str) -> Optional[dict]:
+        """Return the mirrored state object, or None if not live/not mirrored."""
+        if not self.is_live:
+            return None
+        with self._lock:
+            return self._states.get(entity_id)
+
+    def covers(self, entity_ids: Iterable[str]) -> bool:
+        """True if the mirror is live and tracking every one of entity_ids."""
+        if not self.is_live:
+            return False
+        with self._lock:
+            return set(entity_ids) <= self._entity_ids
+
+    def snapshot(self, entity_ids: Iterable[str]) -> Dict[str, dict]:
+        """Return the mirrored states for entity_ids (absent IDs are omitted)."""
+        with self._lock:
+            return {e: self._states[e] for e in entity_ids if e in self._states}
+
+    def add_listener(self, callback: Callable[[str, Optional[dict]], None]):
+        """Call callback(entity_id, new_state) for every mirrored state change."""
+        self._listeners.append(callback)
+
+    def add_registry_listener(self, callback: Callable[[Optional[str]], None]):
+        """Call callback(entity_id) when HA's entity registry changes an entity
+        (entity_id None after a reconnect, when updates may have been missed)."""
+        self._registry_listeners.append(callback)
+
+    # --- Tracking ---
+
+    def set_entities(self, entity_ids: Iterable[str]):
+        """Set which entities to mirror. Newly added IDs trigger a resync so
+        their current state is known straight away."""
+        entity_ids = set(entity_ids)
+        with self._lock:
+            added = entity_ids - self._entity_ids
+            self._entity_ids = entity_ids
+            self._states = {e: s for e, s in self._states.items() if e in entity_ids}
+            if added:
+                # Not authoritative for the new IDs until get_states answers
+                self._synced = False
+        if added and self._ws is not None:
+            logger.debug(f"State mirror now tracking {sorted(added)} - resyncing")
+            self._request_states()
+
+    # --- Connection ---
+
+    def start(self):
+        """Connect in a background thread, reconnecting with backoff."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='state-mirror')
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        delay = RECONNECT_MIN_DELAY
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                delay = RECONNECT_MIN_DELAY
+                self._receive_loop()
+            except Exception as e:
+                if not self._stop.is_set():
+                    logger.warning(f"State mirror connection lost: {e} - retrying in {delay}s")
+            finally:
+                self._ws = None
+                self._synced = False
+            self._stop.wait(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _connect(self):
+        ws = websocket.create_connection(self.url, timeout=30)
+        message = json.loads(ws.recv())
+        if message.get('type') == 'auth_required':
+            ws.send(json.dumps({'type': 'auth', 'access_token': self.token}))
+            message = json.loads(ws.recv())
+        if message.get('type') != 'auth_ok':
+            ws.close()
+            raise ConnectionError(f"WebSocket authentication failed: {message.get('message', message.get('type'))}")
+        # Block in recv() without a timeout from now on; liveness comes from
+        # HA's own pings/close frames
+        ws.settimeout(None)
+        self._ws = ws
+        self._send({'id': next(self._ids), 'type': 'subscribe_events', 'event_type': 'state_changed'})
+        self._send({'id': next(self._ids), 'type': 'subscribe_events', 'event_type': 'entity_registry_updated'})
+        self._notify_registry(None)
+        self._request_states()
+        logger.info(f"State mirror connected to {self.url}")
+
+    def _send(self, message: dict):
+        ws = self._ws
+        if ws is not None:
+            ws.send(json.dumps(message))
+
+    def _request_states(self):
+        msg_id = next(self._ids)
+        self._get_states_id = msg_id
+        try:
+            self._send({'id': msg_id, 'type': 'get_states'})
+        except Exception as e:
+            logger.warning(f"State mirror resync request failed: {e}")
+
+    def _receive_loop(self):
+        while not self._stop.is_set():
+            raw = self._ws.recv()
+            if not raw:
+                raise ConnectionError("WebSocket closed by server")
+            self.handle_message(json.loads(raw))
+
+    def handle_message(self, message: dict):
+        """Apply one message from the HA WebSocket API to the mirror."""
+        if message.get('type') == 'result' and message.get('id') == self._get_states_id:
+            if not message.get('success'):
+                logger.warning(f"State mirror get_states failed: {message.get('error')}")
+                return
+            with self._lock:
+                self._states = {
+                    s['entity_id']: s for s in message.get('result') or []
+                    if s.get('entity_id') in self._entity_ids
+                }
+            self._synced = True
+            logger.debug(f"State mirror synced {len(self._states)} entities")
+        elif message.get('type') == 'event':
+            event = message.get('event', {})
+            data = event.get('data', {})
+            entity_id = data.get('entity_id')
+            if event.get('event_type') == 'entity_registry_updated':
+                self._notify_registry(entity_id)
+                return
+            with self._lock:
+                if entity_id not in self._entity_ids:
+                    return
+                new_state = data.get('new_state')
+                if new_state is None:
+                    self._states.pop(entity_id, None)
+                else:
+                    self._states[entity_id] = new_state
+            for callback in self._listeners:
+                try:
+                    callback(entity_id, new_state)
+                except Exception as e:
+                    logger.error(f"State mirror listener failed for {entity_id}: {e}")
+
+    def _notify_registry(self, entity_id: Optional[str]):
+        for callback in self._registry_listeners:
+            try:
+                callback(entity_id)
+            except Exception as e:
+                logger.error(f"State mirror registry listener failed for {entity_id}: {e}")
@@ -0,0 +1,186 @@
+"""Local sunrise/sunset calculation (NOAA solar position algorithm).
+
+Dawn, sunrise, sunset and whether the sun is up are computed from Home
+Assistant's configured latitude/longitude instead of polling sun.sun or
+scanning its history. The location is read from /api/config once at startup;
+event times are cached per day. Accuracy is within about a minute, the same
+as HA's own sun integration.
+"""
+
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from clock import get_clock
+from hass_client import get_client
+
+logger = logging.getLogger(__name__)
+
+SUNRISE_ELEVATION = -0.833    # degrees: upper limb on the horizon, with refraction
+CIVIL_DAWN_ELEVATION = -6.0   # degrees
+LOCATION_RETRY_INTERVAL = 300  # seconds between /api/config retries after a failure
+
+_EPOCH_JULIAN_DAY = 2440587.5
+_J2000 = 2451545.0
+
+
+def _julian_century(moment: datetime) -> float:
+    julian_day = moment.timestamp() / 86400 + _EPOCH_JULIAN_DAY
+    return (julian_day - _J2000) / 36525
+
+
+def _solar_parameters(moment: datetime):
+    """Return (declination in degrees, equation of time in minutes) at moment."""
+    jc = _julian_century(moment)
+    mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    eccent = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+    m = math.radians(mean_anom)
+    center = (math.sin(m) * (1.914602 - jc * (0.004817 + 0.000014 * jc))
+              + math.sin(2 * m) * (0.019993 - 0.000101 * jc)
+              + math.sin(3 * m) * 0.000289)
+    omega = math.radians(125.04 - 1934.136 * jc)
+    apparent_long = mean_long + center - 0.00569 - 0.00478 * math.sin(omega)
+    mean_obliq = 23 + (26 + (21.448 - jc * (46.815 + jc * (0.00059 - jc * 0.001813))) / 60) / 60
+    obliq = math.radians(mean_obliq + 0.00256 * math.cos(omega))
+    declination = math.degrees(math.asin(math.sin(obliq) * math.sin(math.radians(apparent_long))))
+
+    y = math.tan(obliq / 2) ** 2
+    l0 = math.radians(mean_long)
+    eq_time = 4 * math.degrees(
+        y * math.sin(2 * l0)
+        - 2 * eccent * math.sin(m)
+        + 4 * eccent * y * math.sin(m) * math.cos(2 * l0)
+        - 0.5 * y * y * math.sin(4 * l0)
+        - 1.25 * eccent * eccent * math.sin(2 * m)
+    )
+    return declination, eq_time
+
+
+def solar_elevation(moment: datetime, latitude: float, longitude: float) -> float:
+    """Geometric elevation of the sun's centre in degrees (no refraction)."""
+    moment = moment.astimezone(timezone.utc)
+    declination, eq_time = _solar_parameters(moment)
+    minutes = moment.hour * 60 + moment.minute + moment.second / 60
+    true_solar_time = (minutes + eq_time + 4 * longitude) % 1440
+    hour_angle = math.radians(true_solar_time / 4 - 180)
+    lat, dec = math.radians(latitude), math.radians(declination)
+    cos_zenith = math.sin(lat) * math.sin(dec) + math.cos(lat) * math.cos(dec) * math.cos(hour_angle)
+    return 90 - math.degrees(math.acos(max(-1.0, min(1.0, cos_zenith))))
+
+
+def _event_time(day: date, latitude: float, longitude: float, elevation: float,
+                rising: bool) -> Optional[datetime]:
+    """UTC time the sun crosses `elevation` on the day whose solar noon falls
+    on `day` (a UTC date), or None if it doesn't that day (polar day/night)."""
+    midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    # Start from local solar noon and refine at the estimated event time
+    moment = midnight + timedelta(minutes=720 - 4 * longitude)
+    for _ in range(3):
+        declination, eq_time = _solar_parameters(moment)
+        lat, dec = math.radians(latitude), math.radians(declination)
+        cos_hour_angle = ((math.sin(math.radians(elevation)) - math.sin(lat) * math.sin(dec))
+                          / (math.cos(lat) * math.cos(dec)))
+        if not -1.0 <= cos_hour_angle <= 1.0:
+            return None
+        hour_angle = math.degrees(math.acos(cos_hour_angle))
+        noon = 720 - 4 * longitude - eq_time
+        minutes = noon - 4 * hour_angle if rising else noon + 4 * hour_angle
+        moment = midnight + timedelta(minutes=minutes)
+    return moment
+
+
+@dataclass(frozen=True)
+class SunTimes:
+    """Sun events for one day, as UTC datetimes (None if the event doesn't occur)."""
+    dawn: Optional[datetime]
+    sunrise: Optional[datetime]
+    sunset: Optional[datetime]
+    dusk: Optional[datetime]
+
+
+class SunCalculator:
+    """Sun events and position for a fixed location, cached per day."""
+
+    def __init__(self, latitude: float, longitude: float):
+        self.latitude = latitude
+        self.longitude = longitude
+        self._cache: Dict[date, SunTimes] = {}
+        self._lock = threading.Lock()
+
+    def times_for(self, day: date) -> SunTimes:
+        """Dawn, sunrise, sunset and dusk around solar noon on a UTC date."""
+        with self._lock:
+            times = self._cache.get(day)
+            if times is None:
+                times = SunTimes(
+                    dawn=_event_time(day, self.latitude, self.longitude, CIVIL_DAWN_ELEVATION, True),
+                    sunrise=_event_time(day, self.latitude, self.longitude, SUNRISE_ELEVATION, True),
+                    sunset=_event_time(day, self.latitude, self.longitude, SUNRISE_ELEVATION, False),
+                    dusk=_event_time(day, self.latitude, self.longitude, CIVIL_DAWN_ELEVATION, False),
+                )
+                if len(self._cache) > 7:
+                    self._cache.clear()
+                self._cache[day] = times
+            return times
+
+    def _events(self, now: datetime, field: str):
+        today = now.astimezone(timezone.utc).date()
+        for offset in (-1, 0, 1, 2):
+            event = getattr(self.times_for(today + timedelta(days=offset)), field)
+            if event is not None:
+                yield event
+
+    def last_sunrise(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Most recent sunrise at or before now (within the last two days)."""
+        now = now or get_clock().now()
+        past = [t for t in self._events(now, 'sunrise') if t <= now]
+        return max(past) if past else None
+
+    def next_sunset(self, now: Optional[datetime] = None) -> Optional[datetime]:
+        """Next sunset after now (within the next two days)."""
+        now = now or get_clock().now()
+        upcoming = [t for t in self._events(now, 'sunset') if t > now]
+        return min(upcoming) if upcoming else None
+
+    def is_above_horizon(self, now: Optional[datetime] = None) -> bool:
+        """True between sunrise and sunset (same definition as sun.sun)."""
+        now = now or get_clock().now()
+        return solar_elevation(now, self.latitude, self.longitude) > SUNRISE_ELEVATION
+
+
+_calculator: Optional[SunCalculator] = None
+_enabled = False
+_last_attempt = 0.0
+_state_lock = threading.Lock()
+
+
+def init_location(client) -> Optional[SunCalculator]:
+    """Read latitude/longitude from HA's /api/config and enable local sun
+    calculations. Called once at startup; if HA isn't reachable yet,
+    get_sun() retries periodically."""
+    global _calculator, _enabled, _last_attempt
+    with _state_lock:
+        _enabled = True
+        _last_attempt = time.monotonic()
+        try:
+            response = client.get('/api/config')
+            response.raise_for_status()
+            config = response.json()
+            _calculator = SunCalculator(float(config['latitude']), float(config['longitude']))
+            logger.info(f"Sun times calculated locally for {_calculator.latitude}, {_calculator.longitude}")
+        except Exception as e:
+            logger.warning(f"Could not read location from Home Assistant - using sun.sun until it is available: {e}")
+        return _calculator
+
+
+def get_sun() -> Optional[SunCalculator]:
+    """The shared calculator, or None if the location isn't known (callers
+    then fall back to the sun.sun entity)."""
+    if _calculator is None and _enabled and time.monotonic() - _last_attempt > LOCATION_RETRY_INTERVAL:
+        init_location(get_client())
+    return _calculator
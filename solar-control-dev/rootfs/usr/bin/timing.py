@@ -0,0 +1,93 @@
+"""Lightweight spans for timing the phases of a control loop pass.
+
+A pass opens a root Span and wraps each phase in a child span; phases can
+wrap each device they handle in a detail span. Phase spans are always
+recorded (a handful per pass). Detail spans are only recorded when the pass
+was started with detailed=True - otherwise detail() returns NULL_SPAN, a
+shared no-op, so per-device timing costs one method call when it's off.
+
+    root = Span('pass', detailed=True)
+    with root:
+        with root.span('mandatory') as phase:
+            for device in devices:
+                with phase.detail(device.name):
+                    ...
+    root.to_dict()
+
+Spans may be opened from worker threads (e.g. per-device energy updates).
+"""
+
+import threading
+import time
+from typing import List, Optional
+
+
+class Span:
+    """A named, timed section of a pass, with nested child spans."""
+
+    __slots__ = ('name', 'detailed', 'started', 'duration_ms', 'children', '_lock')
+
+    def __init__(self, name: str, detailed: bool = False):
+        self.name = name
+        self.detailed = detailed
+        self.started: Optional[float] = None
+        self.duration_ms: Optional[float] = None
+        self.children: List['Span'] = []
+        self._lock = threading.Lock()
+
+    def span(self, name: str) -> 'Span':
+        """A child span, always recorded."""
+        child = Span(name, self.detailed)
+        with self._lock:
+            self.children.append(child)
+        return child
+
+    def detail(self, name: str) -> 'Span':
+        """A child span recorded only when detailed timing is on."""
+        return self.span(name) if self.detailed else NULL_SPAN
+
+    def __enter__(self) -> 'Span':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration_ms = (time.perf_counter() - self.started) * 1000
+        return False
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            children = list(self.children)
+        result = {
+            'name': self.name,
+            'ms': round(self.duration_ms, 2) if self.duration_ms is not None else None,
+        }
+        if children:
+            result['children'] = [child.to_dict() for child in children]
+        return result
+
+
+class _NullSpan:
+    """Stands in for a span that isn't being recorded."""
+
+    __slots__ = ()
+    name = None
+    duration_ms = None
+    children = ()
+
+    def span(self, name: str) -> '_NullSpan':
+        return self
+
+    def detail(self, name: str) -> '_NullSpan':
+        return self
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def to_dict(self) -> Optional[dict]:
+        return None
+
+
+NULL_SPAN = _NullSpan()
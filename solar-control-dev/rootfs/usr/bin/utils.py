@@ -1,9 +1,10 @@
 import logging
-import requests
 import os
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 import json
+from hass_client import get_client
+from sun import get_sun
 
 # Module-level logger (used by set_mqtt_settings and get_sunrise_time)
 logger = logging.getLogger(__name__)
@@ -117,25 +118,29 @@ def entity_state_to_is_on(state):
 
 
 def get_sunrise_time():
+    """Most recent sunrise as a local ISO timestamp, or None.
+
+    Calculated locally when HA's location is known, otherwise taken from the
+    last sun.sun transition to above_horizon in the past 24h of history."""
+    sun_calc = get_sun()
+    if sun_calc is not None:
+        sunrise = sun_calc.last_sunrise()
+        if sunrise is not None:
+            return sunrise.astimezone().isoformat()
+
     try:
-        supervisor_token = os.environ.get('SUPERVISOR_TOKEN')
-        if not supervisor_token:
+        hass = get_client()
+        if not hass.has_token:
             logger.error("No supervisor token found in environment")
             return None
 
-        headers = {
-            "Authorization": f"Bearer {supervisor_token}",
-            "Content-Type": "application/json",
-        }
-
         # Get history for the past 24 hours
-        response = requests.get(
-            f'{os.environ.get("HASS_URL", "http://supervisor/core")}/api/history/period',
+        response = hass.get(
+            '/api/history/period',
             params={
                 'filter_entity_id': 'sun.sun',
                 'minimal_response': 'true'
-            },
-            headers=headers
+            }
         )
         response.raise_for_status()
         
@@ -0,0 +1,39 @@
+"""Offline simulation of the solar controller against a fake Home Assistant.
+
+Run from solar-control-dev/:  python -m simulator --hours 24
+
+The real SolarController runs pass after pass against an in-process fake HA
+(FakeHassAdapter, mounted on the shared HassClient's session) that models a
+house: grid power follows a solar curve, a house load profile and whatever
+the controller has switched on. Simulated time only moves when the
+simulation steps it, so a day of one-minute passes finishes in seconds, and
+the result reports self-consumption, grid import/export, device runtime and
+pass latency.
+
+python -m simulator.replay CASSETTE replays a pass recorded from a real
+house (see cassette.py) with the same fake-transport approach, and
+python -m simulator.backtest runs a whole day of a real house's history.
+python -m simulator.sweep backtests a grid of configuration variants across
+a process pool and ranks them.
+"""
+
+import os
+import sys
+import tempfile
+
+# The add-on's modules live in rootfs/usr/bin and read DATA_DIR / the HA
+# connection settings at import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rootfs', 'usr', 'bin'))
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='solar_control_sim_'))
+os.environ.setdefault('SUPERVISOR_TOKEN', 'simulator')
+os.environ.setdefault('HASS_URL', 'http://fake-hass')
+
+from simulator.profiles import HouseLoadProfile, SolarProfile  # noqa: E402
+from simulator.world import SimWorld  # noqa: E402
+from simulator.fake_hass import FakeHassAdapter, mounted  # noqa: E402
+from simulator.engine import Scenario, Simulation, SimulationResult, default_scenario  # noqa: E402
+
+__all__ = [
+    'FakeHassAdapter', 'HouseLoadProfile', 'Scenario', 'SimWorld', 'Simulation',
+    'SimulationResult', 'SolarProfile', 'default_scenario', 'mounted',
+]
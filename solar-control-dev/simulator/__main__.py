@@ -0,0 +1,32 @@
+"""Command line entry point: python -m simulator [--hours H] [--step S] [--json]"""
+
+import argparse
+import json
+import logging
+
+from simulator import Simulation, SolarProfile, default_scenario
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator',
+                                     description='Run the solar controller against a simulated house.')
+    parser.add_argument('--hours', type=float, default=24.0, help='simulated hours to run (default 24)')
+    parser.add_argument('--step', type=float, default=60.0, help='simulated seconds between passes (default 60)')
+    parser.add_argument('--peak', type=float, default=5000.0, help='solar peak in W (default 5000)')
+    parser.add_argument('--cloudiness', type=float, default=0.0, help='0-1, random generation dips (default 0)')
+    parser.add_argument('--latency', type=float, default=0.0, help='real seconds per fake HA request (default 0)')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    # The controller logs every decision, and warns each pass about optional
+    # entities a scenario doesn't configure; only errors matter here
+    logging.disable(logging.WARNING)
+
+    scenario = default_scenario()
+    scenario.solar = SolarProfile(peak_w=args.peak, cloudiness=args.cloudiness)
+    result = Simulation(scenario, step_s=args.step, latency_s=args.latency).run(args.hours)
+    print(json.dumps(result.to_dict(), indent=2) if args.json else result.report())
+
+
+if __name__ == '__main__':
+    main()
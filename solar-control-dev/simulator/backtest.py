@@ -0,0 +1,406 @@
+"""Backtest the controller on a real day of Home Assistant history.
+
+Run from solar-control-dev/:
+
+    python -m simulator.backtest --config /path/to/data --history day.json
+    python -m simulator.backtest --config cassette.json.gz --url http://homeassistant.local:8123 \\
+        --token TOKEN --date 2026-06-21 --save day.json
+
+--config is a copy of the add-on's /data (solar_config.json, devices.json,
+settings.json, battery.json) or a cassette, which carries the same files.
+History is HA's /api/history/period JSON, the CSV the history panel
+downloads, or fetched from HA for one UTC day.
+
+Measured grid power already contains the managed devices as they ran that
+day, so their historical load (power sensor, else switch state times typical
+draw) is taken out to leave the rest of the house. The simulated house then
+gets that background, the day's generation, and the devices the controller
+under test turns on; every other entity (tariff, forecast, SoC...) replays
+its history. The day runs on a virtual clock, thousands of times faster
+than real time, and the report sets import/export, device runtime and
+switch counts beside what happened on the day. Edit the copied config files
+- order, min on/off times, bring-forward mode, site_export_limit - to tune
+them before rolling them out.
+"""
+
+import argparse
+import bisect
+import csv
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from battery import Battery
+from cassette import Cassette
+from device import Device
+from entity_snapshot import collect_entity_ids
+from hass_client import HassClient
+
+from simulator.engine import Scenario, Simulation, SimulationResult
+from simulator.world import SUN_ENTITY
+
+SOLAR_THRESHOLD_W = 10.0   # generation above this counts as daylight
+SUNRISE_HOUR = 6.0         # used when the history has neither sun.sun nor generation
+SUNSET_HOUR = 18.0
+
+
+def _parse_time(text: str) -> datetime:
+    moment = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class StateSeries:
+    """One entity's state changes; calling it gives the state at a time."""
+
+    def __init__(self, changes: Iterable[Tuple[datetime, str]], attributes: Optional[dict] = None):
+        """
+        Args:
+            changes: (time, state) pairs
+            attributes: Attributes of the first state (HA's minimal history
+                response leaves them off the rest)
+        """
+        self.changes = sorted(changes, key=lambda change: change[0])
+        self.attributes = attributes or {}
+        self.unit = self.attributes.get('unit_of_measurement')
+        self._times = [moment for moment, _ in self.changes]
+
+    def __call__(self, at: datetime) -> Optional[str]:
+        """State at `at`, or None before the first change."""
+        i = bisect.bisect_right(self._times, at)
+        return self.changes[i - 1][1] if i else None
+
+    def number(self, at: datetime, default: float = 0.0) -> float:
+        try:
+            return float(self(at))
+        except (TypeError, ValueError):
+            return default
+
+    def watts(self, at: datetime, default: float = 0.0) -> float:
+        """Numeric state in W (a kW sensor is scaled)."""
+        value = self.number(at, default)
+        return value * 1000 if (self.unit or '').lower() == 'kw' else value
+
+    def durations(self, start: datetime, end: datetime) -> List[Tuple[Optional[str], float]]:
+        """(state, seconds) for each stretch between start and end."""
+        stretches = []
+        moment, state = start, self(start)
+        for changed, new_state in self.changes:
+            if changed <= start:
+                continue
+            if changed >= end:
+                break
+            stretches.append((state, (changed - moment).total_seconds()))
+            moment, state = changed, new_state
+        stretches.append((state, (end - moment).total_seconds()))
+        return stretches
+
+
+class History:
+    """State changes of several entities over a period."""
+
+    def __init__(self, series: Dict[str, StateSeries], start: datetime, end: datetime):
+        self.series = series
+        self.start = start
+        self.end = end
+
+    def get(self, entity_id: Optional[str]) -> Optional[StateSeries]:
+        return self.series.get(entity_id) if entity_id else None
+
+    @classmethod
+    def from_api(cls, data: list, start: Optional[datetime] = None,
+                 end: Optional[datetime] = None) -> 'History':
+        """From an /api/history/period response: one list per entity. With
+        minimal_response only the first state carries entity_id/attributes."""
+        series = {}
+        for states in data:
+            if not states:
+                continue
+            series[states[0]['entity_id']] = StateSeries(
+                ((_parse_time(s.get('last_changed') or s['last_updated']), s['state']) for s in states),
+                states[0].get('attributes'))
+        return cls._spanning(series, start, end)
+
+    @classmethod
+    def from_csv(cls, path: str) -> 'History':
+        """From the history panel's download (entity_id,state,last_changed)."""
+        changes: Dict[str, List[Tuple[datetime, str]]] = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                changes.setdefault(row['entity_id'], []).append((_parse_time(row['last_changed']), row['state']))
+        return cls._spanning({e: StateSeries(c) for e, c in changes.items()})
+
+    @classmethod
+    def _spanning(cls, series: Dict[str, StateSeries], start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> 'History':
+        times = [s.changes[0][0] for s in series.values() if s.changes]
+        if not times:
+            raise ValueError('History is empty')
+        last = max(s.changes[-1][0] for s in series.values() if s.changes)
+        return cls(series, start or min(times), end or last)
+
+    @classmethod
+    def load(cls, path: str) -> 'History':
+        if path.endswith('.csv'):
+            return cls.from_csv(path)
+        with open(path) as f:
+            data = json.load(f)
+        if isinstance(data, dict):  # saved by save(): the period is kept
+            return cls.from_api(data['history'], _parse_time(data['start']), _parse_time(data['end']))
+        return cls.from_api(data)
+
+    def save(self, path: str):
+        history = []
+        for entity_id, series in self.series.items():
+            states = [{'entity_id': entity_id, 'state': state, 'last_changed': moment.isoformat()}
+                      for moment, state in series.changes]
+            states[0]['attributes'] = series.attributes
+            history.append(states)
+        with open(path, 'w') as f:
+            json.dump({'start': self.start.isoformat(), 'end': self.end.isoformat(), 'history': history}, f)
+
+    @classmethod
+    def fetch(cls, client: HassClient, entity_ids: Iterable[str], start: datetime,
+              end: datetime) -> 'History':
+        """Every change of entity_ids between start and end, in one request."""
+        response = client.get(f"/api/history/period/{start.isoformat()}", params={
+            'end_time': end.isoformat(),
+            'filter_entity_id': ','.join(sorted(entity_ids)),
+            'minimal_response': '',
+            'significant_changes_only': '0',
+        })
+        response.raise_for_status()
+        return cls.from_api(response.json(), start, end)
+
+
+class HistoricalSolar:
+    """Generation replayed from history, for SimWorld's solar profile."""
+
+    def __init__(self, watts, sunrise_hour: float, sunset_hour: float):
+        """
+        Args:
+            watts: Generation (W) at a given time
+            sunrise_hour / sunset_hour: UTC hours, for sun.sun
+        """
+        self.watts = watts
+        self.sunrise_hour = sunrise_hour
+        self.sunset_hour = sunset_hour
+
+    def __call__(self, at: datetime) -> float:
+        return self.watts(at)
+
+    def is_daylight(self, at: datetime) -> bool:
+        return self.sunrise_hour <= _hour(at) < self.sunset_hour
+
+
+def _hour(moment: datetime) -> float:
+    moment = moment.astimezone(timezone.utc)
+    return moment.hour + moment.minute / 60 + moment.second / 3600
+
+
+def _daylight_hours(history: History, solar) -> Tuple[float, float]:
+    """UTC sunrise and sunset hours from sun.sun, else from generation."""
+    sun = history.get(SUN_ENTITY)
+    if sun is not None and sun.attributes.get('next_rising') and sun.attributes.get('next_setting'):
+        return _hour(_parse_time(sun.attributes['next_rising'])), _hour(_parse_time(sun.attributes['next_setting']))
+    if sun is not None:
+        risen = [moment for moment, state in sun.changes if state == 'above_horizon']
+        if risen:
+            set_ = [moment for moment, state in sun.changes if state == 'below_horizon' and moment > risen[0]]
+            if set_:
+                return _hour(risen[0]), _hour(set_[0])
+    moment, daylight = history.start, []
+    while moment < history.end:
+        if solar(moment) > SOLAR_THRESHOLD_W:
+            daylight.append(moment)
+        moment += timedelta(minutes=5)
+    if not daylight:
+        return SUNRISE_HOUR, SUNSET_HOUR
+    # Generation at either edge of the history doesn't say when the sun rose or set
+    sunrise = _hour(daylight[0]) if daylight[0] > history.start else min(SUNRISE_HOUR, _hour(daylight[0]))
+    last = daylight[-1] + timedelta(minutes=5)
+    sunset = _hour(last) if last < history.end else max(SUNSET_HOUR, _hour(last))
+    return sunrise, sunset
+
+
+def _device_load(device: Device, history: History, voltage: float):
+    """Historical load (W) of a managed device at a given time."""
+    power = history.get(device.current_power_sensor)
+    switch = history.get(device.switch_entity)
+    amperage = history.get(device.variable_amperage_control) if device.has_variable_amperage else None
+
+    def load(at: datetime) -> float:
+        if power is not None:
+            return power.watts(at)
+        if switch is None or switch(at) != 'on':
+            return 0.0
+        if amperage is not None:
+            return amperage.number(at) * voltage
+        return device.typical_power_draw or 0.0
+    return load
+
+
+def scenario_from_history(files: Dict[str, object], history: History) -> Scenario:
+    """A Scenario that replays history around the configured devices.
+
+    Args:
+        files: DATA_DIR file name -> content (solar_config.json, devices.json,
+            settings.json, battery.json)
+        history: At least the grid power entity's changes
+    """
+    config = files.get('solar_config.json') or {}
+    device_dicts = files.get('devices.json') or []
+    grid = history.get(config.get('grid_power'))
+    if grid is None:
+        raise ValueError(f"History has no grid power ({config.get('grid_power') or 'not configured'})")
+    voltage = float(config.get('grid_voltage_fixed') or 230.0)
+    devices = [Device.from_dict(d) for d in device_dicts]
+    loads = [_device_load(device, history, voltage) for device in devices]
+
+    def background(at: datetime) -> float:
+        """Grid power without the managed devices: house load minus generation."""
+        return grid.watts(at) - sum(load(at) for load in loads)
+
+    generation = history.get(config.get('solar_generation'))
+    if generation is not None:
+        def solar_w(at):
+            return max(generation.watts(at), 0.0)
+
+        def house_w(at):
+            return max(background(at) + solar_w(at), 0.0)
+    else:
+        # Only the net is known: split it into load and generation
+        def solar_w(at):
+            return max(-background(at), 0.0)
+
+        def house_w(at):
+            return max(background(at), 0.0)
+
+    modelled = {SUN_ENTITY, config.get('grid_power'), config.get('solar_generation')}
+    for device in devices:
+        modelled.update((device.switch_entity, device.variable_amperage_control,
+                         device.current_power_sensor, device.energy_sensor))
+    timelines = {entity_id: series for entity_id, series in history.series.items() if entity_id not in modelled}
+    return Scenario(
+        devices=device_dicts,
+        config=config,
+        solar=HistoricalSolar(solar_w, *_daylight_hours(history, solar_w)),
+        house_load=house_w,
+        settings=files.get('settings.json') or {'power_optimization_enabled': True},
+        battery=files.get('battery.json'),
+        start=history.start,
+        voltage=voltage,
+        timelines=timelines,
+    )
+
+
+def historical_outcome(files: Dict[str, object], history: History) -> dict:
+    """Import/export, device runtime and switch counts as they happened."""
+    config = files.get('solar_config.json') or {}
+    grid = history.get(config.get('grid_power'))
+    import_kwh = export_kwh = 0.0
+    for state, seconds in grid.durations(history.start, history.end):
+        try:
+            watts = float(state) * (1000 if (grid.unit or '').lower() == 'kw' else 1)
+        except (TypeError, ValueError):
+            continue
+        import_kwh += max(watts, 0.0) * seconds / 3600 / 1000
+        export_kwh += max(-watts, 0.0) * seconds / 3600 / 1000
+    runtime_h, switches = {}, {}
+    for device in files.get('devices.json') or []:
+        switch = history.get(device['switch_entity'])
+        stretches = switch.durations(history.start, history.end) if switch else []
+        runtime_h[device['name']] = sum(seconds for state, seconds in stretches if state == 'on') / 3600
+        states = [state for state, _ in stretches if state in ('on', 'off')]
+        switches[device['name']] = sum(1 for a, b in zip(states, states[1:]) if a != b)
+    return {'import_kwh': round(import_kwh, 3), 'export_kwh': round(export_kwh, 3),
+            'device_runtime_h': {n: round(h, 2) for n, h in runtime_h.items()}, 'switch_counts': switches}
+
+
+@dataclass
+class BacktestResult:
+    """The controller under test beside what actually happened."""
+    simulated: SimulationResult
+    historical: dict
+
+    def to_dict(self) -> dict:
+        return {'simulated': self.simulated.to_dict(), 'historical': self.historical}
+
+    def report(self) -> str:
+        sim, real = self.simulated.to_dict(), self.historical
+        lines = [
+            self.simulated.report(),
+            '',
+            f"{'Compared with the day':<22} {'Backtest':>10} {'Actual':>10}",
+            f"{'Grid import kWh':<22} {sim['import_kwh']:>10.2f} {real['import_kwh']:>10.2f}",
+            f"{'Grid export kWh':<22} {sim['export_kwh']:>10.2f} {real['export_kwh']:>10.2f}",
+        ]
+        for name in sim['device_runtime_h']:
+            lines.append(f"{(name + ' runtime h')[:22]:<22} {sim['device_runtime_h'][name]:>10.2f} "
+                         f"{real['device_runtime_h'].get(name, 0.0):>10.2f}")
+            lines.append(f"{(name + ' switches')[:22]:<22} {sim['switch_counts'][name]:>10} "
+                         f"{real['switch_counts'].get(name, 0):>10}")
+        return '\n'.join(lines)
+
+
+def backtest(files: Dict[str, object], history: History, step_s: float = 60.0) -> BacktestResult:
+    """Run the controller configured by files over history."""
+    scenario = scenario_from_history(files, history)
+    hours = (history.end - history.start).total_seconds() / 3600
+    return BacktestResult(Simulation(scenario, step_s=step_s).run(hours), historical_outcome(files, history))
+
+
+def load_files(path: str) -> Dict[str, object]:
+    """Configuration files from a copy of /data or from a cassette."""
+    if os.path.isfile(path):
+        return Cassette.load(path).files
+    files = {}
+    for name in ('solar_config.json', 'devices.json', 'settings.json', 'battery.json'):
+        if os.path.exists(os.path.join(path, name)):
+            with open(os.path.join(path, name)) as f:
+                files[name] = json.load(f)
+    return files
+
+
+def history_entities(files: Dict[str, object]) -> set:
+    """Every entity a backtest of these files can use."""
+    config = files.get('solar_config.json') or {}
+    devices = [Device.from_dict(d) for d in files.get('devices.json') or []]
+    battery = Battery.from_dict(files['battery.json']) if files.get('battery.json') else None
+    return collect_entity_ids(config, devices, battery)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator.backtest',
+                                     description='Run the controller over a day of real Home Assistant history.')
+    parser.add_argument('--config', required=True, help='copy of /data, or a cassette')
+    parser.add_argument('--history', help='history file (.json from the API or this tool, or .csv)')
+    parser.add_argument('--url', help='Home Assistant URL to fetch history from')
+    parser.add_argument('--token', default=os.environ.get('HA_TOKEN'), help='long-lived access token (default $HA_TOKEN)')
+    parser.add_argument('--date', help='UTC day to fetch, YYYY-MM-DD (default yesterday)')
+    parser.add_argument('--save', help='also write the fetched history here')
+    parser.add_argument('--step', type=float, default=60.0, help='simulated seconds between passes (default 60)')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    files = load_files(args.config)
+    if args.history:
+        history = History.load(args.history)
+    elif args.url:
+        day = (datetime.strptime(args.date, '%Y-%m-%d').replace(tzinfo=timezone.utc) if args.date
+               else datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1))
+        history = History.fetch(HassClient(args.url, args.token), history_entities(files), day, day + timedelta(days=1))
+        if args.save:
+            history.save(args.save)
+    else:
+        parser.error('give --history, or --url (and --token) to fetch it')
+
+    logging.disable(logging.WARNING)
+    result = backtest(files, history, args.step)
+    print(json.dumps(result.to_dict(), indent=2) if args.json else result.report())
+
+
+if __name__ == '__main__':
+    main()
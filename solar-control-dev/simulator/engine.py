@@ -0,0 +1,244 @@
+"""Run SolarController pass by pass against a simulated house.
+
+A Simulation writes the scenario's configuration into a scratch DATA_DIR,
+builds a real SolarController on the world's virtual clock, mounts a
+FakeHassAdapter on the shared HA client and then alternates: one control
+loop pass, then step_s of simulated time (energy is accounted at the loads
+the pass left running). Min on/off times, the energy ledger and sun
+position all run on simulated time.
+
+Each run also gets its own HA client (circuit breaker, request stats),
+entity metadata registry and energy ledger (in the scratch DATA_DIR), so
+runs in one process - a test session, a sweep worker - don't carry state
+into each other.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+from clock import Clock, set_clock
+from energy_ledger import LEDGER_FILE, EnergyLedger, set_ledger
+from entity_metadata import EntityMetadataRegistry, set_registry
+from hass_client import HassClient, percentile, set_client
+from solar_controller import SolarController
+
+from simulator.fake_hass import FakeHassAdapter, mounted
+from simulator.profiles import HouseLoadProfile, SolarProfile
+from simulator.world import GRID_POWER_ENTITY, SOLAR_POWER_ENTITY, SimWorld
+
+DEFAULT_START = datetime(2026, 6, 21, tzinfo=timezone.utc)
+
+
+@contextmanager
+def scratch_data_dir(files: Dict[str, object]) -> Iterator[str]:
+    """A temporary DATA_DIR holding files (name -> JSON content), set in the
+    environment for the duration of the block (settings and battery are read
+    from DATA_DIR)."""
+    data_dir = tempfile.mkdtemp(prefix='solar_control_sim_')
+    previous = os.environ.get('DATA_DIR')
+    os.environ['DATA_DIR'] = data_dir
+    try:
+        for name, content in files.items():
+            with open(os.path.join(data_dir, name), 'w') as f:
+                json.dump(content, f)
+        yield data_dir
+    finally:
+        if previous is None:
+            os.environ.pop('DATA_DIR', None)
+        else:
+            os.environ['DATA_DIR'] = previous
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+@contextmanager
+def isolated_run(data_dir: str, clock: Clock) -> Iterator[HassClient]:
+    """Fresh process-wide singletons for one run: clock, HA client, metadata
+    registry and an energy ledger in data_dir. The previous ones are put
+    back afterwards. Yields the run's client."""
+    client = HassClient()
+    set_clock(clock)
+    previous = (set_client(client), set_registry(EntityMetadataRegistry()),
+                set_ledger(EnergyLedger(os.path.join(data_dir, LEDGER_FILE))))
+    try:
+        yield client
+    finally:
+        set_clock(None)
+        set_client(previous[0])
+        set_registry(previous[1])
+        set_ledger(previous[2])
+        client.session.close()
+
+
+@dataclass
+class Scenario:
+    """A house to simulate: its devices, controller configuration and profiles."""
+    devices: List[dict]                       # devices.json entries
+    config: dict                              # solar_config.json
+    solar: SolarProfile = field(default_factory=SolarProfile)
+    house_load: Callable[[datetime], float] = field(default_factory=HouseLoadProfile)
+    settings: dict = field(default_factory=lambda: {'power_optimization_enabled': True})
+    battery: Optional[dict] = None            # battery.json, if the house has one
+    start: datetime = DEFAULT_START
+    voltage: float = 230.0
+    extra_states: Dict[str, str] = field(default_factory=dict)  # e.g. a tariff select
+    timelines: Dict[str, Callable[[datetime], Optional[str]]] = field(default_factory=dict)  # changing states
+
+
+def default_scenario() -> Scenario:
+    """A 5 kW array, a water heater, a pool pump and an EV charger."""
+    return Scenario(
+        devices=[
+            {'name': 'Hot water', 'switch_entity': 'switch.hot_water', 'typical_power_draw': 2400.0,
+             'order': 0, 'min_on_time': 600, 'min_off_time': 300},
+            {'name': 'Pool pump', 'switch_entity': 'switch.pool_pump', 'typical_power_draw': 800.0,
+             'order': 1, 'min_on_time': 900, 'min_off_time': 600},
+            {'name': 'EV charger', 'switch_entity': 'switch.ev_charger', 'typical_power_draw': 3680.0,
+             'order': 2, 'min_on_time': 300, 'min_off_time': 300, 'has_variable_amperage': True,
+             'min_amperage': 6, 'max_amperage': 16, 'variable_amperage_control': 'number.ev_amps'},
+        ],
+        config={'grid_power': GRID_POWER_ENTITY, 'grid_voltage_fixed': 230},
+    )
+
+
+@dataclass
+class SimulationResult:
+    """Energy flows, device behaviour and controller latency over a run."""
+    hours: float
+    passes: int
+    solar_kwh: float
+    house_kwh: float
+    device_kwh: Dict[str, float]
+    import_kwh: float
+    export_kwh: float
+    curtailed_kwh: float                      # generation lost to the site export limit
+    device_runtime_h: Dict[str, float]
+    switch_counts: Dict[str, int]
+    pass_ms: List[float]
+    ha_requests: int
+    wall_s: float
+
+    @property
+    def self_consumption_pct(self) -> float:
+        """Share of generation used on site rather than exported."""
+        if self.solar_kwh <= 0:
+            return 0.0
+        return max(0.0, (self.solar_kwh - self.export_kwh) / self.solar_kwh * 100)
+
+    def to_dict(self) -> dict:
+        return {
+            'hours': self.hours,
+            'passes': self.passes,
+            'solar_kwh': round(self.solar_kwh, 3),
+            'house_kwh': round(self.house_kwh, 3),
+            'device_kwh': {name: round(kwh, 3) for name, kwh in self.device_kwh.items()},
+            'import_kwh': round(self.import_kwh, 3),
+            'export_kwh': round(self.export_kwh, 3),
+            'curtailed_kwh': round(self.curtailed_kwh, 3),
+            'self_consumption_pct': round(self.self_consumption_pct, 1),
+            'device_runtime_h': {name: round(h, 2) for name, h in self.device_runtime_h.items()},
+            'switch_counts': dict(self.switch_counts),
+            'pass_ms': {
+                'p50': round(percentile(self.pass_ms, 50), 2),
+                'p95': round(percentile(self.pass_ms, 95), 2),
+                'max': round(max(self.pass_ms), 2) if self.pass_ms else 0.0,
+            },
+            'ha_requests': self.ha_requests,
+            'wall_s': round(self.wall_s, 2),
+        }
+
+    def report(self) -> str:
+        """Human-readable summary."""
+        d = self.to_dict()
+        lines = [
+            f"Simulated {d['hours']:.1f} h in {d['wall_s']:.2f} s ({d['passes']} passes, "
+            f"{d['ha_requests']} HA requests)",
+            f"Solar {d['solar_kwh']:.2f} kWh, house {d['house_kwh']:.2f} kWh",
+            f"Grid import {d['import_kwh']:.2f} kWh, export {d['export_kwh']:.2f} kWh, "
+            f"self-consumption {d['self_consumption_pct']:.1f}%"
+            + (f", curtailed {d['curtailed_kwh']:.2f} kWh" if d['curtailed_kwh'] else ''),
+            f"Pass latency p50 {d['pass_ms']['p50']:.2f} ms, p95 {d['pass_ms']['p95']:.2f} ms, "
+            f"max {d['pass_ms']['max']:.2f} ms",
+            f"{'Device':<20} {'kWh':>8} {'Runtime h':>10} {'Switches':>9}",
+        ]
+        for name in d['device_kwh']:
+            lines.append(f"{name:<20} {d['device_kwh'][name]:>8.2f} {d['device_runtime_h'][name]:>10.2f} "
+                         f"{d['switch_counts'][name]:>9}")
+        return '\n'.join(lines)
+
+
+class Simulation:
+    """One scenario run against a fresh controller and world."""
+
+    def __init__(self, scenario: Scenario, step_s: float = 60.0, latency_s: float = 0.0):
+        """
+        Args:
+            scenario: The house to simulate
+            step_s: Simulated seconds between control loop passes
+            latency_s: Real time each fake HA request takes
+        """
+        self.scenario = scenario
+        self.step_s = step_s
+        config = scenario.config
+        self.world = SimWorld(scenario.devices, scenario.solar, scenario.house_load,
+                              scenario.start, scenario.voltage, scenario.extra_states,
+                              timelines=scenario.timelines,
+                              export_limit_w=config.get('site_export_limit') or None,
+                              grid_entity=config.get('grid_power') or GRID_POWER_ENTITY,
+                              solar_entity=config.get('solar_generation') or SOLAR_POWER_ENTITY)
+        self.adapter = FakeHassAdapter(self.world, latency_s)
+
+    def _files(self) -> Dict[str, object]:
+        files = {
+            'solar_config.json': self.scenario.config,
+            'devices.json': self.scenario.devices,
+            'settings.json': self.scenario.settings,
+        }
+        if self.scenario.battery is not None:
+            files['battery.json'] = self.scenario.battery
+        return files
+
+    def run(self, hours: float = 24.0) -> SimulationResult:
+        """Simulate `hours` of passes every step_s and report what happened."""
+        controller = None
+        with scratch_data_dir(self._files()) as data_dir, isolated_run(data_dir, self.world.clock) as client:
+            try:
+                controller = SolarController(config_file=os.path.join(data_dir, 'solar_config.json'),
+                                             devices_file=os.path.join(data_dir, 'devices.json'),
+                                             clock=self.world.clock)
+                steps = int(round(hours * 3600 / self.step_s))
+                pass_ms = []
+                started = time.perf_counter()
+                with mounted(client, self.adapter):
+                    for _ in range(steps):
+                        pass_started = time.perf_counter()
+                        controller.run_control_loop('heartbeat')
+                        pass_ms.append((time.perf_counter() - pass_started) * 1000)
+                        self.world.advance(self.step_s)
+                wall_s = time.perf_counter() - started
+            finally:
+                if controller is not None:
+                    controller._actuation_pool.shutdown()
+
+        world = self.world
+        return SimulationResult(
+            hours=steps * self.step_s / 3600,
+            passes=steps,
+            solar_kwh=world.solar_kwh,
+            house_kwh=world.house_kwh,
+            device_kwh={d.name: d.energy_kwh for d in world.devices},
+            import_kwh=world.import_kwh,
+            export_kwh=world.export_kwh,
+            curtailed_kwh=world.curtailed_kwh,
+            device_runtime_h={d.name: d.runtime_s / 3600 for d in world.devices},
+            switch_counts={d.name: d.switches for d in world.devices},
+            pass_ms=pass_ms,
+            ha_requests=self.adapter.requests,
+            wall_s=wall_s,
+        )
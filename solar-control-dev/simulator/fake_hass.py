@@ -0,0 +1,86 @@
+"""An in-process Home Assistant REST API backed by a SimWorld.
+
+FakeHassAdapter is a requests transport adapter: mounted on the shared
+HassClient's session it answers the add-on's requests directly, with no
+network and no HA, so the controller runs unmodified. It serves:
+
+    GET  /api/states                    every entity
+    GET  /api/states/<entity_id>        one entity (404 if unknown)
+    POST /api/services/<domain>/<svc>   turn_on/turn_off/toggle/set_value
+    GET  /api/history/period[/<start>]  state changes, filter_entity_id
+"""
+
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import ContextManager, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from requests.adapters import BaseAdapter
+
+from cassette import json_response
+from simulator.world import SimWorld
+
+
+class FakeHassAdapter(BaseAdapter):
+    """Answers Home Assistant REST calls from a SimWorld."""
+
+    def __init__(self, world: SimWorld, latency_s: float = 0.0):
+        """
+        Args:
+            world: The simulated house to serve
+            latency_s: Real time each request takes, to model a slow HA
+        """
+        super().__init__()
+        self.world = world
+        self.latency_s = latency_s
+        self.requests = 0
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        self.requests += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        url = urlsplit(request.url)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = None
+        if request.body:
+            raw = request.body.decode() if isinstance(request.body, bytes) else request.body
+            body = json.loads(raw)
+        status, payload = self.handle(request.method, unquote(url.path), params, body)
+        return json_response(request, status, payload)
+
+    def close(self):
+        pass
+
+    def handle(self, method: str, path: str, params: dict, body: Optional[dict]) -> Tuple[int, object]:
+        """Route one request; returns (status code, JSON payload)."""
+        if path == '/api/states' and method == 'GET':
+            return 200, self.world.all_states()
+        if path.startswith('/api/states/') and method == 'GET':
+            state = self.world.get_state(path[len('/api/states/'):])
+            return (200, state) if state is not None else (404, {'message': 'Entity not found.'})
+        if path.startswith('/api/services/') and method == 'POST':
+            parts = path[len('/api/services/'):].split('/')
+            if len(parts) != 2:
+                return 404, {'message': 'Service not found.'}
+            changed = self.world.call_service(parts[0], parts[1], body or {})
+            return (200, changed) if changed is not None else (400, {'message': 'Service not modelled.'})
+        if path.startswith('/api/history/period') and method == 'GET':
+            return 200, self._history(path, params)
+        return 404, {'message': f'{method} {path} not modelled by the simulator'}
+
+    def _history(self, path: str, params: dict) -> list:
+        start_text = path[len('/api/history/period'):].lstrip('/')
+        start = (datetime.fromisoformat(start_text) if start_text
+                 else self.world.now - timedelta(days=1))
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        end = datetime.fromisoformat(params['end_time']) if params.get('end_time') else None
+        entity_ids = [e for e in params.get('filter_entity_id', '').split(',') if e]
+        return [history for history in (self.world.history(e, start, end) for e in entity_ids) if history]
+
+
+def mounted(client, adapter: BaseAdapter) -> ContextManager[BaseAdapter]:
+    """Route every request the client makes to its base URL through adapter
+    for the duration of the block."""
+    return client.mounted(adapter)
@@ -0,0 +1,64 @@
+"""Power profiles for the simulated house: solar generation and house load.
+
+Each profile is a callable taking a (UTC) datetime and returning watts.
+Optional noise is seeded, so a scenario gives the same day every run.
+"""
+
+import math
+import random
+from datetime import datetime
+from typing import Sequence, Tuple
+
+
+def _hour_of_day(moment: datetime) -> float:
+    return moment.hour + moment.minute / 60 + moment.second / 3600
+
+
+class SolarProfile:
+    """Half-sine generation curve between sunrise and sunset.
+
+    cloudiness (0-1) randomly knocks up to that fraction off each reading,
+    drawn per quarter hour so passing clouds last a while."""
+
+    def __init__(self, peak_w: float = 5000.0, sunrise_hour: float = 6.5, sunset_hour: float = 18.5,
+                 cloudiness: float = 0.0, seed: int = 0):
+        self.peak_w = peak_w
+        self.sunrise_hour = sunrise_hour
+        self.sunset_hour = sunset_hour
+        self.cloudiness = cloudiness
+        self.seed = seed
+
+    def is_daylight(self, moment: datetime) -> bool:
+        return self.sunrise_hour <= _hour_of_day(moment) < self.sunset_hour
+
+    def __call__(self, moment: datetime) -> float:
+        hour = _hour_of_day(moment)
+        if not self.is_daylight(moment):
+            return 0.0
+        fraction = (hour - self.sunrise_hour) / (self.sunset_hour - self.sunrise_hour)
+        power = self.peak_w * math.sin(math.pi * fraction)
+        if self.cloudiness:
+            slot = (moment.toordinal(), int(hour * 4))
+            power *= 1 - self.cloudiness * random.Random(hash((self.seed,) + slot)).random()
+        return power
+
+
+class HouseLoadProfile:
+    """Background load: a base draw plus fixed-time peaks (start hour, end
+    hour, extra watts), with optional seeded noise."""
+
+    def __init__(self, base_w: float = 300.0,
+                 peaks: Sequence[Tuple[float, float, float]] = ((7.0, 9.0, 1200.0), (17.0, 21.0, 1800.0)),
+                 noise_w: float = 0.0, seed: int = 0):
+        self.base_w = base_w
+        self.peaks = tuple(peaks)
+        self.noise_w = noise_w
+        self.seed = seed
+
+    def __call__(self, moment: datetime) -> float:
+        hour = _hour_of_day(moment)
+        power = self.base_w + sum(extra for start, end, extra in self.peaks if start <= hour < end)
+        if self.noise_w:
+            slot = (moment.toordinal(), int(hour * 60))
+            power += self.noise_w * (random.Random(hash((self.seed,) + slot)).random() - 0.5) * 2
+        return max(0.0, power)
@@ -0,0 +1,153 @@
+"""Replay a recorded cassette through the controller.
+
+Run from solar-control-dev/:  python -m simulator.replay cassette.json.gz --passes 50
+
+Record a cassette from the debug page (or POST /api/debug/cassette). Each
+replayed pass runs on a fresh SolarController built from the cassette's
+configuration files, on a virtual clock stopped at the moment of recording,
+with every HA request answered from the cassette. Every pass therefore does
+the same work: pass latency is a repeatable number to compare before and
+after a change, and the service calls show what the controller decides at
+that moment - which can be compared with what it decided in production.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from cassette import Cassette, RecordingAdapter, ReplayAdapter, record_pass
+from clock import VirtualClock
+from hass_client import percentile
+from solar_controller import SolarController
+
+from simulator.engine import Scenario, isolated_run, scratch_data_dir
+from simulator.fake_hass import FakeHassAdapter
+from simulator.world import SimWorld
+
+
+@dataclass
+class ReplayResult:
+    """Pass latency and decisions of a cassette replayed several times."""
+    passes: int
+    pass_ms: List[float]
+    requests: int                               # per pass
+    misses: List[str]                           # requests the cassette couldn't answer
+    recorded_calls: List[Tuple[str, object]]    # service calls made in production
+    replayed_calls: List[Tuple[str, object]]    # service calls made on replay
+
+    @property
+    def matches_recording(self) -> bool:
+        # Commands within a batch are sent concurrently, so their order varies
+        return sorted(map(json.dumps, self.recorded_calls)) == sorted(map(json.dumps, self.replayed_calls))
+
+    def to_dict(self) -> dict:
+        return {
+            'passes': self.passes,
+            'pass_ms': {
+                'p50': round(percentile(self.pass_ms, 50), 2),
+                'p95': round(percentile(self.pass_ms, 95), 2),
+                'min': round(min(self.pass_ms), 2) if self.pass_ms else 0.0,
+                'max': round(max(self.pass_ms), 2) if self.pass_ms else 0.0,
+            },
+            'requests': self.requests,
+            'misses': sorted(set(self.misses)),
+            'matches_recording': self.matches_recording,
+            'recorded_calls': [[path, body] for path, body in self.recorded_calls],
+            'replayed_calls': [[path, body] for path, body in self.replayed_calls],
+        }
+
+    def report(self) -> str:
+        """Human-readable summary."""
+        d = self.to_dict()
+        lines = [
+            f"Replayed {d['passes']} passes, {d['requests']} HA requests each",
+            f"Pass latency p50 {d['pass_ms']['p50']:.2f} ms, p95 {d['pass_ms']['p95']:.2f} ms, "
+            f"min {d['pass_ms']['min']:.2f} ms, max {d['pass_ms']['max']:.2f} ms",
+            f"Service calls {'match' if d['matches_recording'] else 'differ from'} the recording",
+        ]
+        if not d['matches_recording']:
+            lines.append('  recorded: ' + json.dumps(d['recorded_calls']))
+            lines.append('  replayed: ' + json.dumps(d['replayed_calls']))
+        if d['misses']:
+            lines.append(f"Not in the cassette ({len(d['misses'])}): " + ', '.join(d['misses']))
+        return '\n'.join(lines)
+
+
+def record_scenario(scenario: Scenario, at: Optional[datetime] = None) -> Cassette:
+    """Record one pass of a simulated house (at `at`, default the scenario's
+    start) - a cassette to benchmark with when there's no production one."""
+    world = SimWorld(scenario.devices, scenario.solar, scenario.house_load, at or scenario.start,
+                     scenario.voltage, scenario.extra_states)
+    files = {'solar_config.json': scenario.config, 'devices.json': scenario.devices,
+             'settings.json': scenario.settings}
+    if scenario.battery is not None:
+        files['battery.json'] = scenario.battery
+    with scratch_data_dir(files) as data_dir, isolated_run(data_dir, world.clock) as client:
+        controller = SolarController(config_file=os.path.join(data_dir, 'solar_config.json'),
+                                     devices_file=os.path.join(data_dir, 'devices.json'),
+                                     clock=world.clock)
+        try:
+            with client.mounted(FakeHassAdapter(world)):
+                return record_pass(controller, data_dir)
+        finally:
+            controller._actuation_pool.shutdown()
+
+
+def replay(cassette: Cassette, passes: int = 20, latency: bool = False) -> ReplayResult:
+    """Run the cassette's pass `passes` times, each on a fresh controller.
+
+    Args:
+        cassette: A recorded pass
+        passes: How many times to replay it
+        latency: Also replay each request's recorded duration
+    """
+    adapter = ReplayAdapter(cassette, latency)
+    pass_ms = []
+    replayed = Cassette()
+    with scratch_data_dir(cassette.files) as data_dir:
+        for _ in range(passes):
+            clock = VirtualClock(cassette.recorded_at)
+            adapter.rewind()
+            replayed = Cassette()
+            with isolated_run(data_dir, clock) as client:  # every pass starts from the same caches
+                controller = SolarController(config_file=os.path.join(data_dir, 'solar_config.json'),
+                                             devices_file=os.path.join(data_dir, 'devices.json'),
+                                             clock=clock)
+                try:
+                    with client.mounted(RecordingAdapter(adapter, replayed)):
+                        started = time.perf_counter()
+                        controller.run_control_loop('replay')
+                        pass_ms.append((time.perf_counter() - started) * 1000)
+                finally:
+                    controller._actuation_pool.shutdown()
+    return ReplayResult(
+        passes=passes,
+        pass_ms=pass_ms,
+        requests=len(replayed.interactions),
+        misses=adapter.misses,
+        recorded_calls=cassette.service_calls(),
+        replayed_calls=replayed.service_calls(),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator.replay',
+                                     description='Replay a recorded control loop pass offline.')
+    parser.add_argument('cassette', help='cassette file (.json or .json.gz)')
+    parser.add_argument('--passes', type=int, default=20, help='times to replay the pass (default 20)')
+    parser.add_argument('--latency', action='store_true', help="replay each request's recorded duration")
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    result = replay(Cassette.load(args.cassette), args.passes, args.latency)
+    print(json.dumps(result.to_dict(), indent=2) if args.json else result.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""Sweep configuration variants over backtests on a pool of processes.
+
+Run from solar-control-dev/:
+
+    python -m simulator.sweep --config /path/to/data --history day1.json day2.json \\
+        --set min_on_time=300,600,900 --set bring_forward_mode=false,true \\
+        --set allocation_strategy=optimal,greedy --workers 8
+
+Each --set adds an axis; every combination of the axes is a variant, and the
+unmodified configuration is always run too, as the baseline. A variant is
+backtested over every history day (without --history, over the simulator's
+default house), the variant-days spread over a pool of worker processes. A
+worker runs many variant-days in turn; each Simulation run installs its own
+clock, HA client, metadata registry and energy ledger (see
+engine.isolated_run), so a result doesn't depend on what ran before it in
+the same process. A grid can also be given as JSON ({"min_on_time": [300,
+600], ...}) with --grid. Results are totalled over the days and ranked by
+--rank.
+
+Parameters (see PARAMETERS):
+    bring_forward_mode, expected_kwh_per_hour      battery.json
+    site_export_limit, allocation_strategy         solar_config.json
+    min_on_time, min_off_time                      every device in devices.json
+    DEVICE NAME.FIELD                              one device, e.g. "Hot water.min_on_time"
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from simulator.backtest import History, backtest, load_files
+from simulator.engine import Simulation, SimulationResult, default_scenario
+
+# Parameter -> the file it's set in ('devices.json': on every device)
+PARAMETERS = {
+    'bring_forward_mode': 'battery.json',
+    'expected_kwh_per_hour': 'battery.json',
+    'site_export_limit': 'solar_config.json',
+    'allocation_strategy': 'solar_config.json',
+    'min_on_time': 'devices.json',
+    'min_off_time': 'devices.json',
+}
+
+# Metric -> True if higher is better
+RANKINGS = {
+    'import_kwh': False,
+    'export_kwh': False,
+    'self_consumption_pct': True,
+    'curtailed_kwh': False,
+    'switches': False,
+}
+
+DEFAULT_HOURS = 24.0  # of the default house, when there's no history
+
+
+def grid_variants(grid: Dict[str, Sequence]) -> List[Dict[str, object]]:
+    """Every combination of the grid's values, e.g. {'a': [1, 2], 'b': [3]} ->
+    [{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def apply_variant(files: Dict[str, object], params: Dict[str, object]) -> Dict[str, object]:
+    """A copy of files with the variant's parameters set.
+
+    Raises:
+        ValueError: An unknown parameter, a device that isn't configured, or
+            a battery parameter without battery.json
+    """
+    files = copy.deepcopy(files)
+    devices = files.get('devices.json') or []
+    for name, value in params.items():
+        target = PARAMETERS.get(name)
+        if target == 'devices.json':
+            for device in devices:
+                device[name] = value
+        elif target is not None:
+            if files.get(target) is None:
+                raise ValueError(f"Can't set {name}: there is no {target}")
+            files[target][name] = value
+        elif '.' in name:
+            device_name, key = name.rsplit('.', 1)
+            matching = [d for d in devices if d.get('name') == device_name]
+            if not matching:
+                raise ValueError(f"Can't set {name}: no device named '{device_name}'")
+            matching[0][key] = value
+        else:
+            raise ValueError(f"Unknown parameter '{name}' (known: {', '.join(PARAMETERS)}, or DEVICE.FIELD)")
+    return files
+
+
+def parse_values(text: str) -> list:
+    """'300,600' -> [300, 600]; each value is JSON if it parses (true, null,
+    1.5), else a string."""
+    values = []
+    for item in text.split(','):
+        try:
+            values.append(json.loads(item))
+        except ValueError:
+            values.append(item.strip())
+    return values
+
+
+def _label(params: Dict[str, object]) -> str:
+    if not params:
+        return '(current)'
+    return ' '.join(f"{name}={json.dumps(value)}" for name, value in params.items())
+
+
+# Set in each worker by _init_worker: the days every task indexes into
+_days: List[Optional[History]] = []
+
+
+def _init_worker(days: List[Optional[History]]):
+    global _days
+    _days = days
+    logging.disable(logging.WARNING)  # see simulator.__main__
+
+
+def _run(files: Dict[str, object], day: int, step_s: float, hours: float) -> SimulationResult:
+    """One variant over one day (in a worker, or this process with workers=1)."""
+    history = _days[day]
+    if history is not None:
+        return backtest(files, history, step_s).simulated
+    scenario = default_scenario()
+    scenario.devices = files['devices.json']
+    scenario.config = files['solar_config.json']
+    scenario.settings = files.get('settings.json') or scenario.settings
+    scenario.battery = files.get('battery.json')
+    return Simulation(scenario, step_s=step_s).run(hours)
+
+
+@dataclass
+class VariantResult:
+    """A variant's outcome, totalled over the days."""
+    params: Dict[str, object]
+    days: List[SimulationResult] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return _label(self.params)
+
+    def total(self, metric: str) -> float:
+        return sum(getattr(day, metric) for day in self.days)
+
+    @property
+    def switches(self) -> int:
+        return sum(sum(day.switch_counts.values()) for day in self.days)
+
+    @property
+    def self_consumption_pct(self) -> float:
+        solar = self.total('solar_kwh')
+        return max(0.0, (solar - self.total('export_kwh')) / solar * 100) if solar > 0 else 0.0
+
+    def metric(self, name: str) -> float:
+        return getattr(self, name) if name in ('switches', 'self_consumption_pct') else self.total(name)
+
+    def to_dict(self) -> dict:
+        if self.error:
+            return {'params': self.params, 'error': self.error}
+        return {
+            'params': self.params,
+            'import_kwh': round(self.total('import_kwh'), 3),
+            'export_kwh': round(self.total('export_kwh'), 3),
+            'curtailed_kwh': round(self.total('curtailed_kwh'), 3),
+            'self_consumption_pct': round(self.self_consumption_pct, 1),
+            'switches': self.switches,
+            'device_runtime_h': {name: round(sum(day.device_runtime_h[name] for day in self.days), 2)
+                                 for name in (self.days[0].device_runtime_h if self.days else {})},
+        }
+
+
+@dataclass
+class SweepResult:
+    """Every variant, best first by `rank`."""
+    variants: List[VariantResult]
+    rank: str
+    days: int
+    wall_s: float
+
+    def __post_init__(self):
+        higher_is_better = RANKINGS[self.rank]
+
+        def key(variant: VariantResult):
+            if variant.error:
+                return (1, 0.0, 0.0, 0)
+            value = variant.metric(self.rank)
+            # Ties go to less import, then fewer switches
+            return (0, -value if higher_is_better else value, variant.total('import_kwh'), variant.switches)
+        self.variants = sorted(self.variants, key=key)
+
+    @property
+    def best(self) -> VariantResult:
+        return self.variants[0]
+
+    def to_dict(self) -> dict:
+        return {'rank': self.rank, 'days': self.days, 'wall_s': round(self.wall_s, 2),
+                'variants': [v.to_dict() for v in self.variants]}
+
+    def report(self, top: Optional[int] = None) -> str:
+        """Ranked table."""
+        runs = len(self.variants) * self.days
+        lines = [
+            f"{len(self.variants)} variants x {self.days} day(s) = {runs} runs in {self.wall_s:.1f} s, "
+            f"ranked by {self.rank}",
+            f"{'#':>3} {'Import':>8} {'Export':>8} {'Self %':>7} {'Curtail':>8} {'Switch':>7}  Variant",
+        ]
+        for i, variant in enumerate(self.variants[:top], 1):
+            if variant.error:
+                lines.append(f"{i:>3} {'failed':>8}  {variant.label}: {variant.error}")
+                continue
+            d = variant.to_dict()
+            lines.append(f"{i:>3} {d['import_kwh']:>8.2f} {d['export_kwh']:>8.2f} {d['self_consumption_pct']:>7.1f} "
+                         f"{d['curtailed_kwh']:>8.2f} {d['switches']:>7}  {variant.label}")
+        if top is not None and len(self.variants) > top:
+            lines.append(f"    ... {len(self.variants) - top} more")
+        return '\n'.join(lines)
+
+
+def sweep(files: Dict[str, object], variants: List[Dict[str, object]],
+          days: Optional[List[History]] = None, step_s: float = 60.0, hours: float = DEFAULT_HOURS,
+          rank: str = 'import_kwh', workers: Optional[int] = None) -> SweepResult:
+    """Backtest each variant of files over each day, in parallel.
+
+    Args:
+        files: The configuration the variants change (see apply_variant)
+        variants: Parameter overrides; the unmodified files are run too
+        days: History to backtest over; None for the simulator's default house
+        step_s: Simulated seconds between passes
+        hours: Length of a default-house run (a history runs its whole period)
+        rank: A RANKINGS metric
+        workers: Processes (default: one per CPU); 1 runs in this process
+    """
+    if rank not in RANKINGS:
+        raise ValueError(f"Unknown ranking '{rank}' (known: {', '.join(RANKINGS)})")
+    days = list(days) if days else [None]
+    results = [VariantResult({})] + [VariantResult(params) for params in variants if params]
+    tasks = []  # (variant, files, day)
+    for variant in results:
+        try:
+            variant_files = apply_variant(files, variant.params)
+        except ValueError as e:
+            variant.error = str(e)
+            continue
+        tasks.extend((variant, variant_files, day) for day in range(len(days)))
+
+    started = time.perf_counter()
+    if workers == 1:
+        _init_worker(days)
+        try:
+            outcomes = [_outcome(lambda: _run(f, day, step_s, hours)) for _, f, day in tasks]
+        finally:
+            logging.disable(logging.NOTSET)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(days,)) as pool:
+            futures = [pool.submit(_run, f, day, step_s, hours) for _, f, day in tasks]
+            outcomes = [_outcome(future.result) for future in futures]
+    for (variant, _, _), (result, error) in zip(tasks, outcomes):
+        if error:
+            variant.error = variant.error or error
+        else:
+            variant.days.append(result)
+    return SweepResult(results, rank, len(days), time.perf_counter() - started)
+
+
+def _outcome(run):
+    """(result, None), or (None, error) - one failed run shouldn't lose the rest."""
+    try:
+        return run(), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m simulator.sweep',
+                                     description='Backtest a grid of configuration variants in parallel.')
+    parser.add_argument('--config', help='copy of /data, or a cassette (default: the simulator house)')
+    parser.add_argument('--history', nargs='*', default=[], help='history files, one per day (see simulator.backtest)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=V1,V2',
+                        help='a parameter and the values to try (repeatable)')
+    parser.add_argument('--grid', help='JSON file of {parameter: [values]}')
+    parser.add_argument('--rank', choices=list(RANKINGS), default='import_kwh', help='metric to rank by (default import_kwh)')
+    parser.add_argument('--workers', type=int, help='processes (default: one per CPU)')
+    parser.add_argument('--step', type=float, default=60.0, help='simulated seconds between passes (default 60)')
+    parser.add_argument('--hours', type=float, default=DEFAULT_HOURS,
+                        help='hours of the simulator house to run without --history (default 24)')
+    parser.add_argument('--top', type=int, help='show only the best N')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    grid = {}
+    if args.grid:
+        with open(args.grid) as f:
+            grid.update(json.load(f))
+    for item in args.set:
+        name, sep, values = item.partition('=')
+        if not sep:
+            parser.error(f"--set {item}: expected NAME=V1,V2")
+        grid[name.strip()] = parse_values(values)
+    if not grid:
+        parser.error('give at least one --set or a --grid')
+    if args.history and not args.config:
+        parser.error('--history needs --config')
+
+    if args.config:
+        files = load_files(args.config)
+    else:
+        scenario = default_scenario()
+        files = {'solar_config.json': scenario.config, 'devices.json': scenario.devices,
+                 'settings.json': scenario.settings}
+    days = [History.load(path) for path in args.history]
+    result = sweep(files, grid_variants(grid), days, args.step, args.hours, args.rank,
+                   args.workers or os.cpu_count())
+    print(json.dumps(result.to_dict(), indent=2) if args.json else result.report(args.top))
+
+
+if __name__ == '__main__':
+    main()
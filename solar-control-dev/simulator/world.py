@@ -0,0 +1,241 @@
+"""The simulated house: entity states, device loads and energy accounting.
+
+SimWorld owns the virtual clock and every entity the fake HA serves. Device
+entities (switches, amperage numbers, power and energy sensors) are derived
+from the same device configuration the controller loads, so the controller
+sees a house that responds to its commands: turning a device on adds its
+load to grid power from the next reading onwards.
+"""
+
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from clock import VirtualClock
+
+GRID_POWER_ENTITY = 'sensor.grid_power'
+SOLAR_POWER_ENTITY = 'sensor.solar_power'
+HOUSE_LOAD_ENTITY = 'sensor.house_load'
+SUN_ENTITY = 'sun.sun'
+
+
+class SimDevice:
+    """A controllable load, modelled from a devices.json entry."""
+
+    def __init__(self, config: dict, voltage: float):
+        self.name = config['name']
+        self.switch_entity = config['switch_entity']
+        self.typical_power_draw = float(config.get('typical_power_draw') or 0)
+        self.variable = bool(config.get('has_variable_amperage'))
+        self.amperage_entity = config.get('variable_amperage_control') if self.variable else None
+        self.min_amperage = float(config.get('min_amperage') or 0)
+        self.max_amperage = float(config.get('max_amperage') or 0)
+        self.power_sensor = config.get('current_power_sensor')
+        self.energy_sensor = config.get('energy_sensor')
+        self.voltage = voltage
+        self.on = False
+        self.amperage = self.min_amperage
+        self.energy_kwh = 0.0
+        self.runtime_s = 0.0
+        self.switches = 0
+
+    @property
+    def load_w(self) -> float:
+        if not self.on:
+            return 0.0
+        return self.amperage * self.voltage if self.variable else self.typical_power_draw
+
+
+class SimWorld:
+    """Entities, loads and energy totals of the simulated house at `now`."""
+
+    def __init__(self, devices: List[dict], solar: Callable[[datetime], float],
+                 house_load: Callable[[datetime], float], start: datetime,
+                 voltage: float = 230.0, extra_states: Optional[Dict[str, str]] = None,
+                 timelines: Optional[Dict[str, Callable[[datetime], Optional[str]]]] = None,
+                 export_limit_w: Optional[float] = None,
+                 grid_entity: str = GRID_POWER_ENTITY, solar_entity: str = SOLAR_POWER_ENTITY):
+        """
+        Args:
+            devices: devices.json entries; each gets its switch (and amperage
+                number, power and energy sensors, if configured) modelled
+            solar: Generation profile (W); needs is_daylight() and
+                sunrise_hour/sunset_hour for sun.sun
+            house_load: Background load profile (W)
+            start: Simulated start time (UTC)
+            voltage: Grid voltage used for variable-amperage loads
+            extra_states: Other entities to serve with a fixed state
+                (e.g. a tariff select)
+            timelines: Other entities whose state changes over time:
+                entity ID -> state at a given time (None: not known yet)
+            export_limit_w: Site export limit; generation that would export
+                more is curtailed
+            grid_entity: Entity serving grid power (the config's grid_power)
+            solar_entity: Entity serving generation (solar_generation)
+        """
+        self.clock = VirtualClock(start)  # the controller under test reads this too
+        self.solar = solar
+        self.house_load = house_load
+        self.voltage = voltage
+        self.timelines = dict(timelines or {})
+        self.export_limit_w = export_limit_w
+        self.grid_entity = grid_entity
+        self.solar_entity = solar_entity
+        self.devices = [SimDevice(config, voltage) for config in devices]
+        self._lock = threading.RLock()
+        self._states: Dict[str, dict] = {}
+        self._history: Dict[str, List[dict]] = {}
+        self.import_kwh = 0.0
+        self.export_kwh = 0.0
+        self.curtailed_kwh = 0.0
+        self.solar_kwh = 0.0
+        self.house_kwh = 0.0
+        for entity_id, state in (extra_states or {}).items():
+            self.set_state(entity_id, state)
+        self._refresh()
+
+    @property
+    def now(self) -> datetime:
+        return self.clock.now()
+
+    # -- entity states -----------------------------------------------------
+
+    def set_state(self, entity_id: str, state, attributes: Optional[dict] = None):
+        """Set an entity's state, keeping last_changed if the state didn't change."""
+        with self._lock:
+            stamp = self.now.isoformat()
+            previous = self._states.get(entity_id)
+            state = str(state)
+            changed = previous is None or previous['state'] != state
+            self._states[entity_id] = {
+                'entity_id': entity_id,
+                'state': state,
+                'attributes': dict(attributes or {}),
+                'last_changed': stamp if changed else previous['last_changed'],
+                'last_updated': stamp,
+            }
+            if changed:
+                self._history.setdefault(entity_id, []).append(
+                    {'entity_id': entity_id, 'state': state, 'attributes': dict(attributes or {}),
+                     'last_changed': stamp})
+
+    def get_state(self, entity_id: str) -> Optional[dict]:
+        with self._lock:
+            state = self._states.get(entity_id)
+            return dict(state) if state is not None else None
+
+    def all_states(self) -> List[dict]:
+        with self._lock:
+            return [dict(state) for state in self._states.values()]
+
+    def history(self, entity_id: str, start: datetime, end: Optional[datetime] = None) -> List[dict]:
+        """State changes between start and end, led by the state at start
+        (as HA's history API returns them)."""
+        end = end or self.now
+        with self._lock:
+            changes = list(self._history.get(entity_id, []))
+        before = [c for c in changes if datetime.fromisoformat(c['last_changed']) <= start]
+        during = [c for c in changes if start < datetime.fromisoformat(c['last_changed']) <= end]
+        return before[-1:] + during
+
+    # -- services ----------------------------------------------------------
+
+    def _device_for(self, entity_id: str) -> Tuple[Optional[SimDevice], str]:
+        for device in self.devices:
+            if entity_id == device.switch_entity:
+                return device, 'switch'
+            if entity_id == device.amperage_entity:
+                return device, 'amperage'
+        return None, ''
+
+    def call_service(self, domain: str, service: str, data: dict) -> Optional[List[dict]]:
+        """Apply a service call; returns the changed states, or None if the
+        service or entity isn't modelled."""
+        entity_ids = data.get('entity_id')
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        if not entity_ids:
+            return None
+        with self._lock:
+            for entity_id in entity_ids:
+                device, kind = self._device_for(entity_id)
+                if device is None:
+                    return None
+                if kind == 'switch' and service in ('turn_on', 'turn_off', 'toggle'):
+                    on = not device.on if service == 'toggle' else service == 'turn_on'
+                    device.switches += int(on != device.on)
+                    device.on = on
+                elif kind == 'amperage' and service == 'set_value':
+                    device.amperage = min(max(float(data['value']), device.min_amperage), device.max_amperage)
+                else:
+                    return None
+            self._refresh()
+            return [self.get_state(entity_id) for entity_id in entity_ids]
+
+    # -- physics -----------------------------------------------------------
+
+    def curtailed_power(self) -> float:
+        """Generation (W) the export limit is throwing away right now."""
+        if self.export_limit_w is None:
+            return 0.0
+        net = self.house_load(self.now) + sum(d.load_w for d in self.devices) - self.solar(self.now)
+        return max(-net - self.export_limit_w, 0.0)
+
+    def grid_power(self) -> float:
+        """Import (+) or export (-) in W right now."""
+        return (self.house_load(self.now) + sum(d.load_w for d in self.devices)
+                - self.solar(self.now) + self.curtailed_power())
+
+    def advance(self, seconds: float):
+        """Move simulated time on, accounting energy at the current loads."""
+        with self._lock:
+            hours = seconds / 3600
+            grid = self.grid_power()
+            self.import_kwh += max(grid, 0.0) * hours / 1000
+            self.export_kwh += max(-grid, 0.0) * hours / 1000
+            curtailed = self.curtailed_power()
+            self.curtailed_kwh += curtailed * hours / 1000
+            self.solar_kwh += (self.solar(self.now) - curtailed) * hours / 1000
+            self.house_kwh += self.house_load(self.now) * hours / 1000
+            for device in self.devices:
+                device.energy_kwh += device.load_w * hours / 1000
+                device.runtime_s += seconds if device.on else 0.0
+            self.clock.advance(seconds)
+            self._refresh()
+
+    def _sun_state(self) -> Tuple[str, dict]:
+        day = self.now.replace(hour=0, minute=0, second=0, microsecond=0)
+        rising = day + timedelta(hours=self.solar.sunrise_hour)
+        setting = day + timedelta(hours=self.solar.sunset_hour)
+        if rising <= self.now:
+            rising += timedelta(days=1)
+        if setting <= self.now:
+            setting += timedelta(days=1)
+        state = 'above_horizon' if self.solar.is_daylight(self.now) else 'below_horizon'
+        return state, {'next_rising': rising.isoformat(), 'next_setting': setting.isoformat()}
+
+    def _refresh(self):
+        """Recompute every derived entity for the current time and loads."""
+        with self._lock:
+            solar = self.solar(self.now) - self.curtailed_power()
+            house = self.house_load(self.now)
+            watts = {'unit_of_measurement': 'W', 'device_class': 'power'}
+            self.set_state(self.grid_entity, round(self.grid_power(), 1), watts)
+            self.set_state(self.solar_entity, round(solar, 1), watts)
+            self.set_state(HOUSE_LOAD_ENTITY, round(house, 1), watts)
+            self.set_state(SUN_ENTITY, *self._sun_state())
+            for entity_id, timeline in self.timelines.items():
+                state = timeline(self.now)
+                if state is not None:
+                    self.set_state(entity_id, state)
+            for device in self.devices:
+                self.set_state(device.switch_entity, 'on' if device.on else 'off')
+                if device.amperage_entity:
+                    self.set_state(device.amperage_entity, device.amperage,
+                                   {'min': device.min_amperage, 'max': device.max_amperage,
+                                    'step': 1, 'unit_of_measurement': 'A'})
+                if device.power_sensor:
+                    self.set_state(device.power_sensor, round(device.load_w, 1), watts)
+                if device.energy_sensor:
+                    self.set_state(device.energy_sensor, round(device.energy_kwh, 3),
+                                   {'unit_of_measurement': 'kWh', 'device_class': 'energy'})
@@ -36,3 +36,39 @@ def tmp_data_dir(tmp_path):
         del os.environ["DATA_DIR"]
     else:
         os.environ["DATA_DIR"] = old
+
+
+@pytest.fixture(autouse=True)
+def fresh_entity_metadata():
+    """Entity metadata is cached process-wide; start every test without it."""
+    from entity_metadata import get_registry
+    get_registry().invalidate()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def closed_hass_circuit():
+    """The HA client is a process-wide singleton; don't let one test's
+    simulated outage trip the circuit breaker for the next."""
+    from hass_client import get_client
+    get_client().breaker.reset()
+    yield
+
+
+# Most HA requests a single control loop pass may make in the budget tests
+PASS_REQUEST_BUDGET = 10
+
+
+@pytest.fixture()
+def assert_request_budget():
+    """Return a check that fails the test if a RequestAccount (e.g. a
+    controller's last_pass_requests) made more HA calls than allowed, in total
+    or to one endpoint. Catches regressions in per-pass call volume."""
+    def check(account, max_calls=PASS_REQUEST_BUDGET, endpoint=None):
+        assert account is not None, "no requests were accounted"
+        made = account.count if endpoint is None else account.count_for(endpoint)
+        where = f" to {endpoint}" if endpoint else ""
+        assert made <= max_calls, (
+            f"{made} HA requests{where} exceeds budget of {max_calls}: "
+            f"{account.to_dict()['by_endpoint']}")
+    return check
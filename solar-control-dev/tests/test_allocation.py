@@ -0,0 +1,165 @@
+"""Tests for allocation.py"""
+
+import random
+
+import pytest
+
+from allocation import (AllocationPlan, AmperageDemand, Candidate, GreedyAllocator,
+                        OptimalAllocator, Option, get_allocator, share_weight, water_fill)
+from device import Device
+from solar_controller import DeviceState
+
+
+def fixed(name, power, priority=0):
+    return Candidate(name, priority, [Option(power)])
+
+
+def variable(name, min_amps, max_amps, voltage=230.0, priority=0):
+    return Candidate(name, priority, [Option(voltage * a, a, voltage * a)
+                                      for a in range(min_amps, max_amps + 1)])
+
+
+class TestGreedyAllocator:
+    def test_priority_order_first_fit(self):
+        chosen = GreedyAllocator().allocate([fixed("a", 2000, 1), fixed("b", 1500, 2),
+                                             fixed("c", 1000, 3)], 3000)
+        assert set(chosen) == {"a", "c"}
+
+    def test_variable_device_gets_largest_fitting_amperage(self):
+        chosen = GreedyAllocator().allocate([variable("car", 6, 16)], 2000)
+        assert chosen["car"].amperage == 8
+
+    def test_variable_device_below_minimum_not_turned_on(self):
+        assert GreedyAllocator().allocate([variable("car", 6, 16)], 1000) == {}
+
+
+class TestOptimalAllocator:
+    def test_finds_combination_greedy_misses(self):
+        candidates = [fixed("a", 2000, 1), fixed("b", 1500, 2), fixed("c", 1500, 3)]
+        chosen = OptimalAllocator().allocate(candidates, 3000)
+        assert set(chosen) == {"b", "c"}
+        assert set(GreedyAllocator().allocate(candidates, 3000)) == {"a"}
+
+    def test_priority_breaks_ties(self):
+        chosen = OptimalAllocator().allocate([fixed("low", 1000, 5), fixed("high", 1000, 1)], 1500)
+        assert set(chosen) == {"high"}
+
+    def test_priority_outweighs_small_power_gain(self):
+        chosen = OptimalAllocator().allocate([fixed("high", 1900, 1), fixed("low", 2000, 2)], 2000)
+        assert set(chosen) == {"high"}
+
+    def test_variable_amperage_fills_around_fixed_device(self):
+        chosen = OptimalAllocator().allocate([variable("car", 6, 16, priority=2),
+                                              fixed("heater", 1200, 1)], 3600)
+        assert set(chosen) == {"car", "heater"}
+        assert chosen["car"].amperage == 10
+        assert sum(o.power for o in chosen.values()) <= 3600
+
+    def test_zero_power_device_kept_on(self):
+        # e.g. an unplugged car: budgeted at 0W but still commanded
+        idle = Candidate("car", 1, [Option(0.0, a, 230.0 * a) for a in range(6, 17)])
+        chosen = OptimalAllocator().allocate([idle], 2000)
+        assert chosen["car"].amperage == 8
+
+    def test_never_exceeds_budget(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            candidates = [fixed(f"d{i}", rng.randint(100, 3000), i) for i in range(12)]
+            budget = rng.randint(0, 10000)
+            chosen = OptimalAllocator().allocate(candidates, budget)
+            greedy = GreedyAllocator().allocate(candidates, budget)
+            used = sum(o.power for o in chosen.values())
+            assert used <= budget
+            # Never worse than greedy by more than quantization loss per device
+            assert used >= sum(o.power for o in greedy.values()) - 50 * len(candidates)
+
+    def test_negative_budget(self):
+        assert OptimalAllocator().allocate([fixed("a", 0)], -100) == {}
+
+    def test_times_out_to_greedy(self):
+        candidates = [fixed(f"d{i}", 100 * (i + 1), i) for i in range(5)]
+        allocator = OptimalAllocator(time_limit_s=-1)
+        assert allocator.allocate(candidates, 1000) == GreedyAllocator().allocate(candidates, 1000)
+
+    def test_large_problem_coarsened(self):
+        candidates = [variable(f"d{i}", 6, 32, priority=i) for i in range(500)]
+        chosen = OptimalAllocator().allocate(candidates, 50000)
+        assert 0 < sum(o.power for o in chosen.values()) <= 50000
+
+
+class TestGetAllocator:
+    @pytest.mark.parametrize("name,expected", [(None, OptimalAllocator), ("greedy", GreedyAllocator),
+                                               ("bogus", OptimalAllocator)])
+    def test_lookup(self, name, expected):
+        assert isinstance(get_allocator(name), expected)
+
+
+def demand(name, min_amps=6, max_amps=16, weight=1.0, step=1.0, mandatory=False, wpa=230.0):
+    return AmperageDemand(name, min_amps, max_amps, wpa, weight, step, mandatory)
+
+
+class TestWaterFill:
+    def test_equal_weights_share_evenly(self):
+        amps = water_fill([demand("car1"), demand("car2")], 230.0 * 20)
+        assert amps == {"car1": 10, "car2": 10}
+
+    def test_priority_weight_tilts_share(self):
+        amps = water_fill([demand("high", weight=1.5), demand("low", weight=1.0)], 230.0 * 20)
+        assert amps["high"] > amps["low"]
+        assert amps["high"] + amps["low"] == 20
+
+    def test_respects_max_and_redistributes(self):
+        amps = water_fill([demand("small", max_amps=8), demand("big", max_amps=32)], 230.0 * 30)
+        assert amps == {"small": 8, "big": 22}
+
+    def test_step_size(self):
+        amps = water_fill([demand("hp", min_amps=5, max_amps=20, step=5)], 230.0 * 13)
+        assert amps == {"hp": 10}
+
+    def test_rounding_leftover_handed_out(self):
+        amps = water_fill([demand("a"), demand("b"), demand("c")], 230.0 * 25)
+        assert sorted(amps.values()) == [8, 8, 9]
+
+    def test_drops_lowest_weight_that_cannot_reach_min(self):
+        amps = water_fill([demand("high", weight=1.5), demand("low", weight=1.0)], 230.0 * 10)
+        assert amps == {"high": 10}
+
+    def test_mandatory_kept_at_min(self):
+        amps = water_fill([demand("must", weight=1.0, mandatory=True),
+                           demand("opt", weight=1.5)], 230.0 * 4)
+        assert amps == {"must": 6}
+
+    def test_share_weight(self):
+        assert share_weight(0, 1) == 1.0
+        assert share_weight(0, 3) > share_weight(1, 3) > share_weight(2, 3) == 1.0
+
+
+def state(name):
+    return DeviceState(device=Device(name=name, switch_entity=f"switch.{name}", typical_power_draw=1000.0))
+
+
+class TestAllocationPlan:
+    def test_set_and_lookup_by_name_or_state(self):
+        plan = AllocationPlan()
+        a = state("a")
+        plan.set(a, 1000.0)
+        assert "a" in plan and a in plan and state("b") not in plan
+        assert plan.get(a).power == 1000.0
+
+    def test_update_keeps_position(self):
+        plan = AllocationPlan()
+        a, b = state("a"), state("b")
+        plan.set(a, 1000.0)
+        plan.set(b, 500.0)
+        plan.set(a, 2300.0, 10.0)
+        assert [tuple(entry) for entry in plan] == [(a, 2300.0, 10.0), (b, 500.0, None)]
+
+    def test_remove_while_iterating(self):
+        plan = AllocationPlan()
+        for name in "abc":
+            plan.set(state(name), 100.0)
+        for device_state, _, _ in plan:
+            if device_state.device.name != "b":
+                plan.remove(device_state)
+        assert list(plan.names()) == ["b"]
+        assert plan.remove("missing") is None
@@ -5,7 +5,7 @@ import os
 
 import pytest
 
-from battery import Battery
+from battery import Battery, BatteryStatus, bring_forward_power_w
 
 
 class TestBatteryInit:
@@ -144,3 +144,53 @@ class TestBatteryLoadSave:
         result = b.save(str(nested))
         assert result is True
         assert nested.exists()
+
+
+class TestBringForwardPower:
+    def _battery(self, max_kw=5.0):
+        return Battery(size_kwh=10.0, battery_percent_entity="sensor.b",
+                       max_charging_speed_kw=max_kw)
+
+    def test_zero_at_half_charge(self):
+        assert bring_forward_power_w(self._battery(), 50.0, 20.0) == 0.0
+
+    def test_full_battery_and_forecast_gives_max_speed(self):
+        assert bring_forward_power_w(self._battery(), 100.0, 10.0) == pytest.approx(5000.0)
+
+    def test_factors_interpolate(self):
+        # battery factor (75-50)/50 = 0.5, forecast factor 4/10 = 0.4
+        assert bring_forward_power_w(self._battery(), 75.0, 4.0) == pytest.approx(1000.0)
+
+    def test_unknown_inputs_give_none(self):
+        assert bring_forward_power_w(self._battery(max_kw=None), 90.0, 5.0) is None
+        assert bring_forward_power_w(self._battery(), None, 5.0) is None
+        assert bring_forward_power_w(self._battery(), 90.0, None) is None
+
+
+class TestBatteryStatus:
+    def test_derives_all_values_from_one_reading(self):
+        battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.b",
+                          max_charging_speed_kw=5.0, expected_kwh_per_hour=1.0)
+        status = BatteryStatus.evaluate(battery, soc_percent=80.0,
+                                        solar_forecast_kwh=10.0, hours_until_sunset=4.0)
+        assert status.charging_requirement_kwh == pytest.approx(2.0)
+        # 10 - (1.0 * 4 house + 2 battery) = 4
+        assert status.expected_energy_remaining_kwh == pytest.approx(4.0)
+        assert status.is_full_enough is False
+        # battery factor 0.6, forecast factor 0.4, 5kW
+        assert status.bring_forward_power_w == pytest.approx(1200.0)
+
+    def test_no_battery_uses_full_forecast(self):
+        status = BatteryStatus.evaluate(None, None, solar_forecast_kwh=7.0, hours_until_sunset=3.0)
+        assert status.expected_energy_remaining_kwh == 7.0
+        assert status.is_full_enough is True
+        assert status.charging_requirement_kwh is None
+        assert status.bring_forward_power_w is None
+
+    def test_unreadable_soc_counts_as_no_battery_demand(self):
+        battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.b",
+                          expected_kwh_per_hour=1.0)
+        status = BatteryStatus.evaluate(battery, None, solar_forecast_kwh=10.0, hours_until_sunset=2.0)
+        assert status.expected_energy_remaining_kwh == pytest.approx(8.0)
+        assert status.is_full_enough is True
+
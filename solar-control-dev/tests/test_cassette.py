@@ -0,0 +1,119 @@
+"""Tests for cassette.py"""
+
+from datetime import datetime, timezone
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from cassette import Cassette, RecordingAdapter, ReplayAdapter, json_response
+from hass_client import HassClient
+
+RECORDED_AT = datetime(2026, 6, 21, 12, 0, tzinfo=timezone.utc)
+HEATER = {"entity_id": "switch.heater", "state": "off", "attributes": {}}
+GRID = {"entity_id": "sensor.grid_power", "state": "-1500", "attributes": {}}
+
+
+class FakeHass(BaseAdapter):
+    """Serves a fixed set of states and accepts any service call."""
+
+    def __init__(self):
+        super().__init__()
+        self.states = {s["entity_id"]: s for s in (HEATER, GRID)}
+
+    def send(self, request, **kwargs):
+        path = request.url.split("fake-hass", 1)[1].split("?")[0]
+        if path == "/api/states":
+            return json_response(request, 200, list(self.states.values()))
+        if path.startswith("/api/states/"):
+            state = self.states.get(path[len("/api/states/"):])
+            return json_response(request, 200 if state else 404, state or {"message": "Entity not found."})
+        if path == "/api/unreachable":
+            raise requests.exceptions.ConnectionError("connection refused")
+        return json_response(request, 200, [])
+
+    def close(self):
+        pass
+
+
+def record(calls):
+    client = HassClient("http://fake-hass", "token")
+    cassette = Cassette(recorded_at=RECORDED_AT)
+    with client.mounted(RecordingAdapter(FakeHass(), cassette)):
+        calls(client)
+    return cassette
+
+
+class TestRecording:
+    def test_records_requests_without_headers(self):
+        cassette = record(lambda c: (c.get("/api/states"),
+                                     c.call_service("switch", "turn_on", {"entity_id": "switch.heater"})))
+        first, second = cassette.interactions
+        assert first["method"] == "GET" and first["path"] == "/api/states" and first["status"] == 200
+        assert second["body"] == {"entity_id": "switch.heater"}
+        assert cassette.service_calls() == [("/api/services/switch/turn_on", {"entity_id": "switch.heater"})]
+        assert "token" not in str(cassette.to_dict())
+
+    def test_records_connection_errors(self):
+        def unreachable(client):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                client.get("/api/unreachable")
+        assert record(unreachable).interactions[0]["error"] == "ConnectionError"
+
+    @pytest.mark.parametrize("name", ["cassette.json", "cassette.json.gz"])
+    def test_save_and_load(self, tmp_path, name):
+        cassette = record(lambda c: c.get("/api/states"))
+        cassette.files["devices.json"] = [{"name": "Heater"}]
+        cassette.save(str(tmp_path / name))
+        loaded = Cassette.load(str(tmp_path / name))
+        assert loaded.to_dict() == cassette.to_dict()
+        assert loaded.recorded_at == RECORDED_AT
+
+    def test_read_files(self, tmp_path):
+        (tmp_path / "devices.json").write_text('[{"name": "Heater"}]')
+        (tmp_path / "unrelated.json").write_text("{}")
+        cassette = Cassette()
+        cassette.read_files(str(tmp_path))
+        assert cassette.files == {"devices.json": [{"name": "Heater"}]}
+
+
+class TestReplay:
+    def test_serves_recorded_responses_in_order_then_repeats(self):
+        cassette = record(lambda c: c.get_state("switch.heater"))
+        cassette.interactions.append(dict(cassette.interactions[0], response=dict(HEATER, state="on")))
+        client = HassClient("http://fake-hass", "token")
+        adapter = ReplayAdapter(cassette)
+        with client.mounted(adapter):
+            assert [client.get_state("switch.heater")["state"] for _ in range(3)] == ["off", "on", "on"]
+            adapter.rewind()
+            assert client.get_state("switch.heater")["state"] == "off"
+        assert adapter.requests == 4 and adapter.misses == []
+
+    def test_falls_back_to_bulk_states_then_misses(self):
+        cassette = record(lambda c: c.get("/api/states"))
+        client = HassClient("http://fake-hass", "token")
+        adapter = ReplayAdapter(cassette)
+        with client.mounted(adapter):
+            assert client.get_state("sensor.grid_power")["state"] == "-1500"
+            with pytest.raises(requests.exceptions.HTTPError):
+                client.get_state("sensor.missing")
+        assert adapter.misses == ["GET /api/states/sensor.missing"]
+
+    def test_matches_history_by_path_when_query_moved(self):
+        cassette = record(lambda c: c.get("/api/history/period/2026-06-21T00:00:00+00:00",
+                                          params={"end_time": "2026-06-21T12:00:00.1+00:00"}))
+        client = HassClient("http://fake-hass", "token")
+        adapter = ReplayAdapter(cassette)
+        with client.mounted(adapter):
+            response = client.get("/api/history/period/2026-06-21T00:00:00+00:00",
+                                  params={"end_time": "2026-06-21T12:00:00.2+00:00"})
+        assert response.status_code == 200 and adapter.misses == []
+
+    def test_recorded_errors_raised_again(self):
+        def unreachable(client):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                client.get("/api/unreachable")
+        client = HassClient("http://fake-hass", "token")
+        with client.mounted(ReplayAdapter(record(unreachable))):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                client.get("/api/unreachable")
@@ -0,0 +1,64 @@
+"""Tests for clock.py"""
+
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from clock import Clock, RealClock, VirtualClock, get_clock, set_clock
+from energy_ledger import EnergyLedger
+
+START = datetime(2026, 6, 21, 12, 0, tzinfo=timezone.utc)
+
+
+class TestVirtualClock:
+    def test_only_moves_when_advanced(self):
+        c = VirtualClock(START)
+        assert c.now() == START and c.monotonic() == 0
+        c.advance(90)
+        assert c.now() == START + timedelta(seconds=90)
+        assert c.monotonic() == 90
+        with pytest.raises(ValueError):
+            c.advance(-1)
+
+    def test_sleep_and_wait_advance_instantly(self):
+        c = VirtualClock(START)
+        c.sleep(30)
+        event = threading.Event()
+        assert c.wait(event, 60) is False
+        assert c.monotonic() == 90
+        event.set()
+        assert c.wait(event, 60) is True
+        assert c.monotonic() == 90
+
+    def test_naive_start_is_utc(self):
+        assert VirtualClock(datetime(2026, 6, 21)).now().tzinfo == timezone.utc
+
+
+class TestClockInterface:
+    def test_incomplete_clock_cannot_be_created(self):
+        class WallOnly(Clock):
+            def now(self):
+                return START
+        with pytest.raises(TypeError):
+            WallOnly()
+
+
+class TestProcessClock:
+    def test_set_and_restore(self):
+        c = VirtualClock(START)
+        set_clock(c)
+        try:
+            assert get_clock() is c
+        finally:
+            set_clock(None)
+        assert isinstance(get_clock(), RealClock)
+
+    def test_ledger_reads_process_clock(self, tmp_path):
+        ledger = EnergyLedger(str(tmp_path / "ledger.json"))
+        set_clock(VirtualClock(START))
+        try:
+            ledger.update("sensor.energy", 5.0, START - timedelta(hours=6))
+            assert ledger._last_readings["sensor.energy"][0] == START
+        finally:
+            set_clock(None)
@@ -0,0 +1,105 @@
+"""Tests for config_store.py"""
+
+import json
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from config_store import JsonFileStore, invalidate, thaw, validate_solar_config
+from battery import Battery
+
+
+def write_json(path, data, age_s=10):
+    """Write data and backdate its mtime so it is outside the racy window."""
+    with open(path, "w") as f:
+        json.dump(data, f)
+    stamp = time.time() - age_s
+    os.utime(path, (stamp, stamp))
+
+
+def count_loads():
+    return patch("config_store.json.load", side_effect=json.load)
+
+
+class TestJsonFileStore:
+    def test_parses_once_while_unchanged(self, tmp_path):
+        path = tmp_path / "c.json"
+        write_json(path, {"grid_power": "sensor.grid"})
+        store = JsonFileStore(str(path))
+        with count_loads() as mock_load:
+            for _ in range(5):
+                assert store.get()["grid_power"] == "sensor.grid"
+        assert mock_load.call_count == 1
+
+    def test_rereads_when_file_changes(self, tmp_path):
+        path = tmp_path / "c.json"
+        write_json(path, {"grid_power": "sensor.a"}, age_s=20)
+        store = JsonFileStore(str(path))
+        assert store.get()["grid_power"] == "sensor.a"
+        write_json(path, {"grid_power": "sensor.bb"}, age_s=10)
+        assert store.get()["grid_power"] == "sensor.bb"
+
+    def test_recently_modified_file_is_not_trusted(self, tmp_path):
+        path = tmp_path / "c.json"
+        write_json(path, {"a": 1}, age_s=0)
+        store = JsonFileStore(str(path))
+        with count_loads() as mock_load:
+            store.get()
+            store.get()
+        assert mock_load.call_count == 2
+
+    def test_invalidate_forces_reread(self, tmp_path):
+        path = tmp_path / "c.json"
+        write_json(path, {"a": 1})
+        store = JsonFileStore(str(path))
+        store.get()
+        invalidate(str(path))
+        with count_loads() as mock_load:
+            store.get()
+        assert mock_load.call_count == 1
+
+    def test_values_are_read_only(self, tmp_path):
+        path = tmp_path / "c.json"
+        write_json(path, {"tariff_modes": {"peak": "normal"}})
+        config = JsonFileStore(str(path)).get()
+        with pytest.raises(TypeError):
+            config["grid_power"] = "x"
+        with pytest.raises(TypeError):
+            config["tariff_modes"]["peak"] = "cheap"
+        editable = thaw(config)
+        editable["tariff_modes"]["peak"] = "cheap"
+        assert json.dumps(editable)
+
+    def test_missing_and_invalid_files_return_default(self, tmp_path):
+        assert JsonFileStore(str(tmp_path / "none.json"), default={}).get() == {}
+        path = tmp_path / "bad.json"
+        path.write_text("[1, 2]")
+        assert JsonFileStore(str(path), default={"x": 1}).get() == {"x": 1}
+
+
+class TestValidateSolarConfig:
+    def test_drops_bad_optional_values(self):
+        config = validate_solar_config({"grid_power": "sensor.grid",
+                                        "grid_voltage_fixed": "abc",
+                                        "tariff_modes": "oops"})
+        assert config == {"grid_power": "sensor.grid", "grid_voltage_fixed": None,
+                          "tariff_modes": {}}
+
+
+class TestBatteryLoadCache:
+    def test_cached_and_refreshed_on_save(self, tmp_path):
+        path = str(tmp_path / "battery.json")
+        write_json(path, {"size_kwh": 10.0, "battery_percent_entity": "sensor.b"})
+        with count_loads() as mock_load:
+            assert Battery.load(path).size_kwh == 10.0
+            assert Battery.load(path).size_kwh == 10.0
+        assert mock_load.call_count == 1
+        Battery(size_kwh=13.5, battery_percent_entity="sensor.b").save(path)
+        assert Battery.load(path).size_kwh == 13.5
+
+    def test_missing_required_field_returns_none(self, tmp_path):
+        path = str(tmp_path / "battery.json")
+        write_json(path, {"size_kwh": 10.0})
+        assert Battery.load(path) is None
@@ -291,3 +291,15 @@ class TestDeviceCarFields:
     def test_old_config_without_car_fields_loads(self):
         device = Device.from_dict(make_device_dict())
         assert device.is_car is False
+
+
+class TestDeviceSetState:
+    def test_single_service_call_without_fetching_entity(self):
+        from unittest.mock import MagicMock, patch
+        device = make_device(switch_entity="input_boolean.pool_pump")
+        with patch("requests.Session.get") as mock_get, \
+             patch("requests.Session.post", return_value=MagicMock(status_code=200)) as mock_post:
+            assert device.set_state(True) is True
+        mock_get.assert_not_called()
+        mock_post.assert_called_once()
+        assert mock_post.call_args[0][0].endswith("/api/services/input_boolean/turn_on")
@@ -0,0 +1,50 @@
+"""Tests for energy_ledger.py"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+from energy_ledger import EnergyLedger
+
+SUNRISE = datetime(2026, 6, 1, 4, 0, tzinfo=timezone.utc)
+
+
+def at(minutes_after_sunrise):
+    return SUNRISE + timedelta(minutes=minutes_after_sunrise)
+
+
+class TestEnergyLedger:
+    def test_baseline_from_reading_just_before_sunrise(self, tmp_path):
+        ledger = EnergyLedger(str(tmp_path / "ledger.json"))
+        fetch = MagicMock(return_value=0.0)
+        yesterday = SUNRISE - timedelta(days=1)
+        ledger.update("sensor.e", 99.0, yesterday, fetch_baseline=lambda: 90.0, now=at(-2))
+        assert ledger.update("sensor.e", 100.5, SUNRISE, fetch_baseline=fetch, now=at(1)) == pytest.approx(1.5)
+        fetch.assert_not_called()
+
+    def test_history_fetched_once_without_recent_reading(self, tmp_path):
+        ledger = EnergyLedger(str(tmp_path / "ledger.json"))
+        fetch = MagicMock(return_value=100.0)
+        assert ledger.update("sensor.e", 102.0, SUNRISE, fetch_baseline=fetch, now=at(300)) == pytest.approx(2.0)
+        assert ledger.update("sensor.e", 103.0, SUNRISE, fetch_baseline=fetch, now=at(301)) == pytest.approx(3.0)
+        fetch.assert_called_once()
+
+    def test_baseline_survives_restart(self, tmp_path):
+        path = str(tmp_path / "ledger.json")
+        EnergyLedger(path).update("sensor.e", 102.0, SUNRISE, fetch_baseline=lambda: 100.0, now=at(60))
+        assert json.load(open(path))["sensor.e"]["baseline_kwh"] == 100.0
+        fetch = MagicMock()
+        assert EnergyLedger(path).update("sensor.e", 104.0, SUNRISE, fetch_baseline=fetch,
+                                         now=at(120)) == pytest.approx(4.0)
+        fetch.assert_not_called()
+
+    def test_meter_reset_keeps_total_continuous(self, tmp_path):
+        ledger = EnergyLedger(str(tmp_path / "ledger.json"))
+        ledger.update("sensor.e", 105.0, SUNRISE, fetch_baseline=lambda: 100.0, now=at(60))
+        assert ledger.update("sensor.e", 0.5, SUNRISE, now=at(61)) == pytest.approx(5.5)
+
+    def test_no_baseline_available(self, tmp_path):
+        ledger = EnergyLedger(str(tmp_path / "ledger.json"))
+        assert ledger.update("sensor.e", 5.0, SUNRISE, fetch_baseline=lambda: None, now=at(60)) is None
@@ -0,0 +1,82 @@
+"""Tests for entity_metadata.py"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from entity_metadata import EntityMetadata, EntityMetadataRegistry, domain_of
+
+NUMBER_STATE = {"entity_id": "number.charger_amps", "state": "16",
+                "attributes": {"min": 6, "max": 32, "step": 1, "unit_of_measurement": "A"}}
+
+
+class TestEntityMetadata:
+    def test_from_state(self):
+        metadata = EntityMetadata.from_state("number.charger_amps", NUMBER_STATE)
+        assert (metadata.domain, metadata.unit, metadata.min, metadata.max, metadata.step) == \
+            ("number", "A", 6.0, 32.0, 1.0)
+
+    @pytest.mark.parametrize("value,expected", [(40, 32), (3, 6), (10.7, 10)])
+    def test_clamp(self, value, expected):
+        assert EntityMetadata.from_state("number.x", NUMBER_STATE).clamp(value) == expected
+
+    def test_clamp_step_grid_starts_at_min(self):
+        metadata = EntityMetadata("input_number.hp", "input_number", min=5, max=20, step=5)
+        assert metadata.clamp(13) == 10
+
+    def test_clamp_without_limits(self):
+        assert EntityMetadata("number.x", "number").clamp(12.3) == 12.3
+
+    def test_domain_of(self):
+        assert domain_of("input_boolean.pool") == "input_boolean"
+
+
+class TestRegistry:
+    def test_fetched_once_then_cached(self):
+        fetch = MagicMock(return_value=NUMBER_STATE)
+        registry = EntityMetadataRegistry(fetch=fetch)
+        assert registry.get("number.charger_amps").max == 32
+        assert registry.get("number.charger_amps").max == 32
+        fetch.assert_called_once_with("number.charger_amps")
+
+    def test_state_in_hand_avoids_fetch(self):
+        fetch = MagicMock()
+        registry = EntityMetadataRegistry(fetch=fetch)
+        assert registry.get("number.charger_amps", NUMBER_STATE).step == 1
+        fetch.assert_not_called()
+
+    def test_expires_after_ttl(self):
+        fetch = MagicMock(return_value=NUMBER_STATE)
+        registry = EntityMetadataRegistry(ttl=60, fetch=fetch)
+        with patch("entity_metadata.time.monotonic", return_value=0):
+            registry.get("number.charger_amps")
+        with patch("entity_metadata.time.monotonic", return_value=61):
+            registry.get("number.charger_amps")
+        assert fetch.call_count == 2
+
+    def test_prime_and_invalidate(self):
+        fetch = MagicMock(return_value={"attributes": {"unit_of_measurement": "W"}})
+        registry = EntityMetadataRegistry(fetch=fetch)
+        registry.prime({"sensor.grid": {"attributes": {"unit_of_measurement": "kW"}}})
+        assert registry.get("sensor.grid").unit == "kW"
+        registry.invalidate("sensor.grid")
+        assert registry.get("sensor.grid").unit == "W"
+
+    def test_changed_attributes_refresh_a_fresh_entry(self):
+        fetch = MagicMock(return_value=NUMBER_STATE)
+        registry = EntityMetadataRegistry(ttl=60, fetch=fetch)
+        with patch("entity_metadata.time.monotonic", return_value=0):
+            registry.prime({"number.charger_amps": NUMBER_STATE})
+        lowered = {**NUMBER_STATE, "attributes": {**NUMBER_STATE["attributes"], "max": 20}}
+        with patch("entity_metadata.time.monotonic", return_value=50):
+            registry.prime({"number.charger_amps": lowered})
+            assert registry.get("number.charger_amps").clamp(32) == 20
+            assert registry.get("number.charger_amps", NUMBER_STATE).max == 32
+            registry.prime({"number.charger_amps": NUMBER_STATE})  # unchanged: keeps its age
+        with patch("entity_metadata.time.monotonic", return_value=109):
+            registry.get("number.charger_amps")
+        fetch.assert_not_called()
+
+    def test_fetch_failure_keeps_domain(self):
+        registry = EntityMetadataRegistry(fetch=MagicMock(side_effect=ConnectionError))
+        assert registry.get("switch.pump") == EntityMetadata("switch.pump", "switch")
@@ -0,0 +1,97 @@
+"""Tests for entity_snapshot.py"""
+
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from entity_snapshot import EntitySnapshot, LastGoodStates, collect_entity_ids
+from hass_client import HassClient
+from device import Device
+from battery import Battery
+
+
+def make_states_response(states):
+    mock = MagicMock()
+    mock.json.return_value = states
+    mock.raise_for_status = MagicMock()
+    return mock
+
+
+class TestCollectEntityIds:
+    def test_includes_config_battery_and_device_entities(self):
+        config = {
+            "grid_power": "sensor.grid",
+            "grid_voltage": "sensor.voltage",
+            "tariff_rate": "select.tariff",
+            "solar_forecast": "sensor.forecast",
+            "site_export_limit": 5000,
+        }
+        device = Device(
+            name="EV",
+            switch_entity="switch.ev",
+            typical_power_draw=7000.0,
+            current_power_sensor="sensor.ev_power",
+            energy_sensor="sensor.ev_energy",
+            variable_amperage_control="number.ev_amps",
+            car_soc_sensor="sensor.ev_soc",
+            completion_sensor="binary_sensor.ev_done",
+        )
+        battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.battery")
+        ids = collect_entity_ids(config, [device], battery)
+        assert ids == {
+            "sun.sun", "sensor.grid", "sensor.voltage", "select.tariff",
+            "sensor.forecast", "sensor.battery", "switch.ev", "sensor.ev_power",
+            "sensor.ev_energy", "number.ev_amps", "sensor.ev_soc",
+            "binary_sensor.ev_done",
+        }
+
+    def test_skips_unset_entities(self):
+        device = Device(name="Heater", switch_entity="switch.heater",
+                        typical_power_draw=1000.0)
+        assert collect_entity_ids({"grid_power": None}, [device]) == {
+            "sun.sun", "switch.heater"
+        }
+
+
+class TestEntitySnapshotFetch:
+    def test_single_bulk_request_filtered_to_wanted(self):
+        states = [
+            {"entity_id": "sensor.grid", "state": "-500"},
+            {"entity_id": "sensor.unrelated", "state": "1"},
+        ]
+        with patch("requests.Session.get", return_value=make_states_response(states)) as mock_get:
+            snapshot = EntitySnapshot.fetch(HassClient("http://hass", "token"), {"sensor.grid"})
+        mock_get.assert_called_once()
+        assert mock_get.call_args[0][0] == "http://hass/api/states"
+        assert "sensor.grid" in snapshot
+        assert "sensor.unrelated" not in snapshot
+        assert snapshot.get("sensor.grid")["state"] == "-500"
+
+    def test_missing_entity_is_covered_but_absent(self):
+        with patch("requests.Session.get", return_value=make_states_response([])):
+            snapshot = EntitySnapshot.fetch(HassClient("http://hass", "token"), {"sensor.gone"})
+        assert snapshot.covers("sensor.gone")
+        assert snapshot.get("sensor.gone") is None
+
+    def test_raises_on_http_error(self):
+        response = make_states_response([])
+        response.raise_for_status.side_effect = Exception("502")
+        with patch("requests.Session.get", return_value=response):
+            with pytest.raises(Exception):
+                EntitySnapshot.fetch(HassClient("http://hass", "token"), {"sensor.grid"})
+
+
+class TestLastGoodStates:
+    def test_returns_state_with_age(self):
+        last_good = LastGoodStates()
+        last_good.remember("sensor.grid", {"state": "-500"}, at=time.monotonic() - 30)
+        state, age = last_good.get("sensor.grid", max_age=60)
+        assert state["state"] == "-500"
+        assert 30 <= age < 31
+
+    def test_too_old_or_unknown_is_none(self):
+        last_good = LastGoodStates()
+        last_good.remember("sensor.grid", {"state": "-500"}, at=time.monotonic() - 120)
+        assert last_good.get("sensor.grid", max_age=60) is None
+        assert last_good.get("sensor.other", max_age=60) is None
@@ -0,0 +1,132 @@
+"""Tests for hass_client.py"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import requests
+
+from hass_client import (HassClient, CircuitBreaker, CircuitOpenError, endpoint_name, entity_of,
+                         percentile, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
+
+def make_response(status_code=200, json_data=None):
+    mock = MagicMock()
+    mock.status_code = status_code
+    mock.json.return_value = json_data or {}
+    return mock
+
+
+class TestEndpointName:
+    def test_entity_state_paths_grouped(self):
+        assert endpoint_name("/api/states/sensor.grid") == "/api/states/{entity_id}"
+
+    def test_history_paths_grouped(self):
+        assert endpoint_name("/api/history/period/2026-01-01T00:00:00") == "/api/history/period/{start}"
+
+    def test_other_paths_unchanged(self):
+        assert endpoint_name("/api/states") == "/api/states"
+        assert endpoint_name("/api/services/switch/turn_on") == "/api/services/switch/turn_on"
+
+
+class TestRequestAccounting:
+    def test_entity_of(self):
+        assert entity_of("/api/states/sensor.grid") == "sensor.grid"
+        assert entity_of("/api/services/switch/turn_on", {"entity_id": "switch.heater"}) == "switch.heater"
+        assert entity_of("/api/history/period/x", params={"filter_entity_id": "sensor.e"}) == "sensor.e"
+        assert entity_of("/api/states") is None
+
+    def test_percentile_nearest_rank(self):
+        samples = list(range(1, 101))
+        assert percentile(samples, 50) == 50
+        assert percentile(samples, 95) == 95
+        assert percentile(samples, 99) == 99
+        assert percentile([7.0], 99) == 7.0
+        assert percentile([], 50) == 0.0
+
+    def test_account_records_only_while_open(self):
+        client = HassClient("http://hass", "abc")
+        with patch("requests.Session.get", return_value=make_response()), \
+             patch("requests.Session.post", return_value=make_response()):
+            client.get("/api/states")
+            with client.account() as account:
+                client.get_state("sensor.grid")
+                client.get_state("sensor.grid")
+                client.call_service("switch", "turn_on", {"entity_id": "switch.heater"})
+            client.get("/api/states")
+        summary = account.to_dict()
+        assert summary["count"] == 3 and summary["errors"] == 0
+        assert summary["by_endpoint"]["/api/states/{entity_id}"]["count"] == 2
+        assert summary["by_entity"] == {"sensor.grid": 2, "switch.heater": 1}
+        assert account.count_for("/api/services/switch/turn_on") == 1
+        assert summary["p50_ms"] <= summary["p95_ms"] <= summary["p99_ms"] <= summary["max_ms"]
+
+
+class TestHassClient:
+    def test_session_carries_auth_header(self):
+        client = HassClient("http://hass/", "abc")
+        assert client.base_url == "http://hass"
+        assert client.session.headers["Authorization"] == "Bearer abc"
+        assert client.has_token
+
+    def test_default_timeout_applied(self):
+        client = HassClient("http://hass", "abc")
+        with patch("requests.Session.get", return_value=make_response()) as mock_get:
+            client.get("/api/states")
+        assert mock_get.call_args[0][0] == "http://hass/api/states"
+        assert mock_get.call_args[1]["timeout"] == (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
+    def test_call_service_posts_data(self):
+        client = HassClient("http://hass", "abc")
+        with patch("requests.Session.post", return_value=make_response()) as mock_post:
+            client.call_service("switch", "turn_on", {"entity_id": "switch.heater"})
+        assert mock_post.call_args[0][0] == "http://hass/api/services/switch/turn_on"
+        assert mock_post.call_args[1]["json"] == {"entity_id": "switch.heater"}
+
+    def test_stats_count_calls_and_errors(self):
+        client = HassClient("http://hass", "abc")
+        with patch("requests.Session.get", side_effect=[make_response(200, {"state": "1"}),
+                                                        make_response(500)]):
+            assert client.get_state("sensor.a") == {"state": "1"}
+            client.get("/api/states/sensor.b")
+        stats = client.stats()["/api/states/{entity_id}"]
+        assert stats["count"] == 2
+        assert stats["errors"] == 1
+
+    def test_network_error_counted_and_raised(self):
+        client = HassClient("http://hass", "abc")
+        with patch("requests.Session.get", side_effect=ConnectionError("down")):
+            with pytest.raises(ConnectionError):
+                client.get("/api/states")
+        assert client.stats()["/api/states"]["errors"] == 1
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures_and_rejects_fast(self):
+        client = HassClient("http://hass", "abc")
+        client.breaker = CircuitBreaker(threshold=3, cooldown=60)
+        with patch("requests.Session.get", side_effect=requests.exceptions.ConnectionError("down")) as mock_get:
+            for _ in range(3):
+                with pytest.raises(requests.exceptions.ConnectionError):
+                    client.get("/api/states")
+            with pytest.raises(CircuitOpenError):
+                client.get("/api/states")
+        assert mock_get.call_count == 3
+        assert client.breaker.to_dict() == {"state": "open", "consecutive_failures": 3, "rejected": 1}
+
+    def test_client_errors_dont_open_circuit(self):
+        client = HassClient("http://hass", "abc")
+        client.breaker = CircuitBreaker(threshold=2, cooldown=60)
+        with patch("requests.Session.get", return_value=make_response(404)):
+            for _ in range(3):
+                client.get("/api/states/sensor.gone")
+        assert client.breaker.state == "closed"
+
+    def test_half_open_trial_closes_on_success(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.record(True)
+        assert breaker.state == "half-open"
+        assert breaker.allow()
+        assert not breaker.allow()  # only one trial at a time
+        breaker.record(False)
+        assert breaker.state == "closed" and breaker.allow()
@@ -0,0 +1,65 @@
+"""Tests for metrics.py"""
+
+import pytest
+
+from metrics import Counter, Gauge, Histogram, MetricsRegistry, _Metric, resident_memory_bytes
+
+
+@pytest.fixture()
+def registry():
+    return MetricsRegistry()
+
+
+class TestMetrics:
+    def test_counter_with_labels(self, registry):
+        counter = Counter("requests_total", "Requests.", ["result"], registry=registry)
+        counter.inc(result="ok")
+        counter.inc(2, result="ok")
+        counter.inc(result="failed")
+        assert counter.value(result="ok") == 3
+        assert registry.render() == (
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{result="failed"} 1\n'
+            'requests_total{result="ok"} 3\n'
+        )
+
+    def test_wrong_labels_rejected(self, registry):
+        counter = Counter("c", "C.", ["result"], registry=registry)
+        with pytest.raises(ValueError):
+            counter.inc(endpoint="x")
+
+    def test_duplicate_name_rejected(self, registry):
+        Counter("c", "C.", registry=registry)
+        with pytest.raises(ValueError):
+            Gauge("c", "C.", registry=registry)
+
+    def test_metric_without_samples_cannot_be_created(self, registry):
+        class Incomplete(_Metric):
+            pass
+        with pytest.raises(TypeError):
+            Incomplete("i", "I.", registry=registry)
+        assert registry.get("i") is None
+
+    def test_gauge_set_clear_and_function(self, registry):
+        gauge = Gauge("power_watts", "Power.", ["device"], registry=registry)
+        gauge.set(1500.5, device='Pool "pump"')
+        assert 'power_watts{device="Pool \\"pump\\""} 1500.5' in registry.render()
+        gauge.clear()
+        assert "power_watts{" not in registry.render()
+        Gauge("rss_bytes", "RSS.", function=lambda: 2048, registry=registry)
+        assert "rss_bytes 2048" in registry.render()
+
+    def test_histogram_buckets_are_cumulative(self, registry):
+        histogram = Histogram("loop_seconds", "Loop.", buckets=(0.1, 1.0), registry=registry)
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value)
+        lines = registry.render().splitlines()
+        assert 'loop_seconds_bucket{le="0.1"} 1' in lines
+        assert 'loop_seconds_bucket{le="1"} 2' in lines
+        assert 'loop_seconds_bucket{le="+Inf"} 3' in lines
+        assert "loop_seconds_count 3" in lines
+        assert "loop_seconds_sum 5.55" in lines
+
+    def test_resident_memory(self):
+        assert resident_memory_bytes() > 0
@@ -0,0 +1,47 @@
+"""Tests for reconciler.py"""
+
+from reconciler import Command, DeviceTarget, Reconciler
+
+
+class TestReconciler:
+    def test_no_commands_when_in_sync(self):
+        state = {"a": DeviceTarget(True, 10.0), "b": DeviceTarget(False)}
+        assert Reconciler().diff(state, dict(state)) == []
+
+    def test_only_changes_emitted(self):
+        desired = {"a": DeviceTarget(True), "b": DeviceTarget(False), "c": DeviceTarget(True)}
+        actual = {"a": DeviceTarget(True), "b": DeviceTarget(True), "c": DeviceTarget(True)}
+        assert Reconciler().diff(desired, actual) == [Command("b", False, None, 0)]
+
+    def test_amperage_deadband(self):
+        reconciler = Reconciler(deadband=0.5)
+        actual = {"car": DeviceTarget(True, 10.0)}
+        assert reconciler.diff({"car": DeviceTarget(True, 10.2)}, actual) == []
+        assert reconciler.diff({"car": DeviceTarget(True, 11.0)}, actual) == [Command("car", None, 11.0, 2)]
+
+    def test_batch_order(self):
+        desired = {"up": DeviceTarget(True, 16.0), "new": DeviceTarget(True),
+                   "down": DeviceTarget(True, 6.0), "off": DeviceTarget(False)}
+        actual = {"up": DeviceTarget(True, 10.0), "new": DeviceTarget(False),
+                  "down": DeviceTarget(True, 10.0), "off": DeviceTarget(True)}
+        names = [c.name for c in Reconciler().diff(desired, actual)]
+        assert names[:2] == ["off", "down"]
+        assert set(names[2:]) == {"up", "new"}
+
+    def test_in_flight_command_not_resent(self):
+        reconciler = Reconciler(in_flight_timeout=30)
+        desired, actual = {"a": DeviceTarget(True)}, {"a": DeviceTarget(False)}
+        [command] = reconciler.diff(desired, actual, now=0)
+        reconciler.sent(command, now=0)
+        # HA hasn't reported the switch on yet
+        assert reconciler.diff(desired, actual, now=5) == []
+        assert reconciler.deduplicated == 1
+        assert reconciler.diff(desired, actual, now=31) == [command]
+
+    def test_confirmation_clears_in_flight(self):
+        reconciler = Reconciler()
+        [command] = reconciler.diff({"a": DeviceTarget(True)}, {"a": DeviceTarget(False)}, now=0)
+        reconciler.sent(command, now=0)
+        reconciler.diff({"a": DeviceTarget(True)}, {"a": DeviceTarget(True)}, now=1)
+        # Turned off externally afterwards: the same command goes out again
+        assert reconciler.diff({"a": DeviceTarget(True)}, {"a": DeviceTarget(False)}, now=2) == [command]
@@ -0,0 +1,241 @@
+"""Tests for the simulator package"""
+
+from datetime import datetime, timezone
+
+import pytest
+import requests
+
+from hass_client import HassClient
+from simulator import (FakeHassAdapter, HouseLoadProfile, Scenario, SimWorld, Simulation,
+                       SolarProfile, default_scenario, mounted)
+
+PEAK = datetime(2026, 6, 21, 12, 30, tzinfo=timezone.utc)  # midway between sunrise and sunset
+HEATER = {"name": "Heater", "switch_entity": "switch.heater", "typical_power_draw": 2000.0}
+EV = {"name": "EV", "switch_entity": "switch.ev", "typical_power_draw": 3680.0,
+      "has_variable_amperage": True, "min_amperage": 6, "max_amperage": 16,
+      "variable_amperage_control": "number.ev_amps"}
+
+
+def make_world(devices=(HEATER, EV), start=PEAK):
+    return SimWorld(list(devices), SolarProfile(peak_w=5000.0), HouseLoadProfile(base_w=500.0, peaks=()), start)
+
+
+class TestSimWorld:
+    def test_grid_power_follows_solar_load_and_devices(self):
+        world = make_world()
+        assert world.grid_power() == pytest.approx(500.0 - 5000.0)
+        world.call_service("switch", "turn_on", {"entity_id": "switch.heater"})
+        assert world.get_state("sensor.grid_power")["state"] == "-2500.0"
+        assert world.get_state("sun.sun")["state"] == "above_horizon"
+
+    def test_amperage_clamped_to_number_limits(self):
+        world = make_world()
+        world.call_service("switch", "turn_on", {"entity_id": "switch.ev"})
+        world.call_service("number", "set_value", {"entity_id": "number.ev_amps", "value": 40})
+        assert world.get_state("number.ev_amps")["state"] == "16.0"
+        assert world.grid_power() == pytest.approx(500.0 + 16 * 230.0 - 5000.0)
+
+    def test_advance_accounts_energy_and_runtime(self):
+        world = make_world()
+        world.call_service("switch", "turn_on", {"entity_id": "switch.heater"})
+        world.advance(3600)
+        assert world.solar_kwh == pytest.approx(5.0)
+        assert world.export_kwh == pytest.approx(2.5)
+        assert world.devices[0].runtime_s == 3600 and world.devices[0].switches == 1
+
+    def test_export_limit_curtails_generation(self):
+        world = SimWorld([HEATER], SolarProfile(peak_w=5000.0), HouseLoadProfile(base_w=500.0, peaks=()), PEAK,
+                         export_limit_w=3000.0, timelines={"select.tariff": lambda at: "peak"})
+        assert world.grid_power() == pytest.approx(-3000.0)
+        assert world.get_state("select.tariff")["state"] == "peak"
+        world.advance(3600)
+        assert world.curtailed_kwh == pytest.approx(1.5)
+        assert world.solar_kwh == pytest.approx(3.5)
+
+    def test_unmodelled_service(self):
+        assert make_world().call_service("light", "turn_on", {"entity_id": "light.kitchen"}) is None
+
+
+class TestFakeHassAdapter:
+    def test_serves_rest_api_through_client(self):
+        world = make_world()
+        client = HassClient("http://fake-hass", "token")
+        with mounted(client, FakeHassAdapter(world)) as adapter:
+            states = client.get("/api/states").json()
+            assert {"sensor.grid_power", "sun.sun", "switch.heater", "number.ev_amps"} <= {
+                s["entity_id"] for s in states}
+            client.call_service("switch", "turn_on", {"entity_id": "switch.heater"})
+            assert client.get_state("switch.heater")["state"] == "on"
+            with pytest.raises(requests.exceptions.HTTPError):
+                client.get_state("sensor.missing")
+            history = client.get("/api/history/period/2026-06-21T00:00:00+00:00",
+                                 params={"filter_entity_id": "switch.heater"}).json()
+            assert [s["state"] for s in history[0]] == ["off", "on"]
+        assert adapter.requests == 5
+        assert "http://fake-hass/" not in client.session.adapters
+
+
+class TestSimulation:
+    def test_daytime_run_uses_surplus(self):
+        scenario = default_scenario()
+        scenario.start = datetime(2026, 6, 21, 10, 0, tzinfo=timezone.utc)
+        result = Simulation(scenario, step_s=300).run(hours=4)
+        summary = result.to_dict()
+        assert summary["passes"] == 48
+        assert summary["solar_kwh"] > 0
+        assert summary["self_consumption_pct"] > 80
+        assert sum(summary["device_runtime_h"].values()) > 0
+        assert summary["ha_requests"] >= summary["passes"]
+        assert "self-consumption" in result.report()
+
+    def test_runs_in_one_process_do_not_share_state(self):
+        from energy_ledger import get_ledger
+        from entity_metadata import get_registry
+        from hass_client import get_client
+
+        def run():
+            scenario = default_scenario()
+            scenario.devices[0].update(energy_sensor="sensor.hot_water_energy", min_daily_power=6000)
+            summary = Simulation(scenario, step_s=600).run(hours=24).to_dict()
+            del summary["pass_ms"], summary["wall_s"]
+            return summary
+
+        before = (get_client(), get_registry(), get_ledger())
+        first = run()
+        assert run() == first
+        assert (get_client(), get_registry(), get_ledger()) == before
+
+    def test_restores_data_dir(self, tmp_data_dir):
+        scenario = Scenario(devices=[HEATER], config={"grid_power": "sensor.grid_power"})
+        Simulation(scenario, step_s=600).run(hours=1)
+        import os
+        assert os.environ["DATA_DIR"] == str(tmp_data_dir)
+
+
+class TestReplay:
+    def test_recorded_pass_replays_identically(self):
+        from simulator.replay import record_scenario, replay
+
+        cassette = record_scenario(default_scenario(), PEAK)
+        assert cassette.recorded_at == PEAK
+        assert set(cassette.files) == {"solar_config.json", "devices.json", "settings.json"}
+        assert cassette.service_calls()  # midday surplus switches something on
+
+        result = replay(cassette, passes=3)
+        assert result.matches_recording, result.report()
+        assert result.misses == []
+        assert len(result.pass_ms) == 3 and result.requests == len(cassette.interactions)
+
+
+class TestBacktest:
+    def test_series_state_at_and_durations(self):
+        from datetime import timedelta
+        from simulator.backtest import StateSeries
+        series = StateSeries([(PEAK, "off"), (PEAK + timedelta(hours=1), "on")])
+        assert series(PEAK - timedelta(seconds=1)) is None
+        assert series(PEAK + timedelta(minutes=90)) == "on"
+        assert series.durations(PEAK, PEAK + timedelta(hours=3)) == [("off", 3600.0), ("on", 7200.0)]
+        assert StateSeries([(PEAK, "1.5")], {"unit_of_measurement": "kW"}).watts(PEAK) == 1500.0
+
+    def test_history_files_round_trip(self, tmp_path):
+        from simulator.backtest import History
+        csv_file = tmp_path / "history.csv"
+        csv_file.write_text("entity_id,state,last_changed\n"
+                            "sensor.grid_power,-500,2026-06-21T10:00:00.000Z\n"
+                            "sensor.grid_power,300,2026-06-21T11:00:00.000Z\n")
+        history = History.load(str(csv_file))
+        assert history.get("sensor.grid_power").number(PEAK) == 300.0
+        history.save(str(tmp_path / "history.json"))
+        loaded = History.load(str(tmp_path / "history.json"))
+        assert (loaded.start, loaded.end) == (history.start, history.end)
+        assert loaded.get("sensor.grid_power").changes == history.get("sensor.grid_power").changes
+
+    def test_device_load_taken_out_of_grid_power(self):
+        from simulator.backtest import History, scenario_from_history
+        history = History.from_api([
+            [{"entity_id": "sensor.grid_power", "state": "-1.5", "attributes": {"unit_of_measurement": "kW"},
+              "last_changed": PEAK.isoformat()}],
+            [{"entity_id": "switch.heater", "state": "on", "last_changed": PEAK.isoformat()}],
+            [{"entity_id": "select.tariff", "state": "peak", "last_changed": PEAK.isoformat()}],
+        ])
+        scenario = scenario_from_history({"solar_config.json": {"grid_power": "sensor.grid_power"},
+                                          "devices.json": [HEATER]}, history)
+        assert scenario.solar(PEAK) == 3500.0 and scenario.house_load(PEAK) == 0.0
+        assert set(scenario.timelines) == {"select.tariff"}
+
+    def test_same_config_reproduces_the_day(self):
+        from datetime import timedelta
+        from simulator.backtest import History, backtest
+        scenario = default_scenario()
+        scenario.start = datetime(2026, 6, 21, 9, 0, tzinfo=timezone.utc)
+        day = Simulation(scenario, step_s=300)
+        day.run(hours=4)
+        world = day.world
+        entities = ["sensor.grid_power", "sun.sun", "number.ev_amps"] + [d["switch_entity"] for d in scenario.devices]
+        client = HassClient("http://fake-hass", "token")
+        with mounted(client, FakeHassAdapter(world)):
+            history = History.fetch(client, entities, scenario.start, world.now)
+        files = {"solar_config.json": scenario.config, "devices.json": scenario.devices,
+                 "settings.json": scenario.settings}
+
+        result = backtest(files, history, step_s=300)
+        simulated, actual = result.simulated.to_dict(), result.historical
+        assert simulated["hours"] == 4
+        assert simulated["import_kwh"] == pytest.approx(actual["import_kwh"], abs=0.01)
+        assert simulated["export_kwh"] == pytest.approx(actual["export_kwh"], abs=0.01)
+        assert simulated["device_runtime_h"] == actual["device_runtime_h"]
+        assert "Compared with the day" in result.report()
+
+
+class TestSweep:
+    def test_grid_variants_and_values(self):
+        from simulator.sweep import grid_variants, parse_values
+        assert parse_values("300,true,null,greedy") == [300, True, None, "greedy"]
+        assert grid_variants({"a": [1, 2], "b": ["x"]}) == [{"a": 1, "b": "x"}, {"a": 2, "b": "x"}]
+
+    def test_apply_variant_copies_and_targets_files(self):
+        from simulator.sweep import apply_variant
+        files = {"solar_config.json": {}, "devices.json": [dict(HEATER), dict(EV)],
+                 "battery.json": {"bring_forward_mode": False}}
+        varied = apply_variant(files, {"min_on_time": 600, "EV.min_amperage": 8, "bring_forward_mode": True,
+                                       "allocation_strategy": "greedy"})
+        assert [d["min_on_time"] for d in varied["devices.json"]] == [600, 600]
+        assert varied["devices.json"][1]["min_amperage"] == 8
+        assert varied["battery.json"]["bring_forward_mode"] is True
+        assert varied["solar_config.json"] == {"allocation_strategy": "greedy"}
+        assert "min_on_time" not in files["devices.json"][0] and files["solar_config.json"] == {}
+        for params in ({"colour": "red"}, {"Boiler.min_on_time": 60}):
+            with pytest.raises(ValueError):
+                apply_variant(files, params)
+        with pytest.raises(ValueError, match="no battery.json"):
+            apply_variant({"devices.json": []}, {"expected_kwh_per_hour": 0.5})
+
+    def test_sweep_runs_variants_in_worker_processes_and_ranks_them(self):
+        from simulator.sweep import sweep
+        scenario = default_scenario()
+        scenario.start = PEAK
+        files = {"solar_config.json": scenario.config, "devices.json": scenario.devices}
+        variants = [{"site_export_limit": 0}, {"bring_forward_mode": True}]
+        result = sweep(files, variants, step_s=600, hours=1, rank="export_kwh", workers=2)
+
+        assert [v.label for v in result.variants][-1] == "bring_forward_mode=true"
+        assert "no battery.json" in result.variants[-1].error
+        ranked = [v.to_dict()["export_kwh"] for v in result.variants[:-1]]
+        assert ranked == sorted(ranked) and len(ranked) == 2
+        assert {v.label for v in result.variants} >= {"(current)", "site_export_limit=0"}
+        assert "ranked by export_kwh" in result.report()
+
+    def test_sweep_over_history_days_totals_them(self):
+        from simulator.backtest import History
+        from simulator.sweep import sweep
+        history = History.from_api([
+            [{"entity_id": "sensor.grid_power", "state": "-3000", "last_changed": PEAK.isoformat()},
+             {"entity_id": "sensor.grid_power", "state": "-3000",
+              "last_changed": PEAK.replace(hour=13).isoformat()}],
+        ])
+        files = {"solar_config.json": {"grid_power": "sensor.grid_power"}, "devices.json": [HEATER]}
+        result = sweep(files, [{"min_on_time": 600}], [history, history], step_s=300, workers=1)
+        best = result.best
+        assert result.days == 2 and len(best.days) == 2
+        assert best.total("export_kwh") == pytest.approx(2 * best.days[0].export_kwh)
+        assert best.to_dict()["device_runtime_h"]["Heater"] == pytest.approx(2.0, abs=0.2)
@@ -11,13 +11,16 @@ import pytest
 from solar_controller import SolarController, DeviceState, DebugState
 from device import Device
 from battery import Battery
+from allocation import AllocationPlan
+from timing import NULL_SPAN
+from clock import VirtualClock
 
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
-def make_controller(tmp_path, config=None, devices=None):
+def make_controller(tmp_path, config=None, devices=None, clock=None):
     """Return a SolarController backed by temp config/devices files."""
     config_file = str(tmp_path / "solar_config.json")
     devices_file = str(tmp_path / "devices.json")
@@ -28,7 +31,7 @@ def make_controller(tmp_path, config=None, devices=None):
     with open(devices_file, "w") as f:
         json.dump(devices or [], f)
 
-    return SolarController(config_file=config_file, devices_file=devices_file)
+    return SolarController(config_file=config_file, devices_file=devices_file, clock=clock)
 
 
 def make_device(
@@ -180,7 +183,7 @@ class TestGetDevicePower:
         )
         ds = DeviceState(device=device, is_on=True)
         mock_resp = make_mock_response("650", {"unit_of_measurement": "W"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             power = ctrl.get_device_power(ds)
         assert power == 650.0
 
@@ -192,7 +195,7 @@ class TestGetDevicePower:
         )
         ds = DeviceState(device=device, is_on=True)
         mock_resp = make_mock_response("1.5", {"unit_of_measurement": "kW"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             power = ctrl.get_device_power(ds)
         assert power == 1500.0
 
@@ -215,7 +218,7 @@ class TestGetDevicePower:
             current_power_sensor="sensor.broken",
         )
         ds = DeviceState(device=device, is_on=True)
-        with patch("requests.get", side_effect=Exception("network error")):
+        with patch("requests.Session.get", side_effect=Exception("network error")):
             power = ctrl.get_device_power(ds)
         assert power == 750.0
 
@@ -246,7 +249,7 @@ class TestGetAvailablePower:
         ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
         # Grid power = -1000W (exporting 1000W)
         mock_resp = make_mock_response("-1000", {"unit_of_measurement": "W"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             with patch.object(ctrl, "get_current_tariff_mode", return_value="normal"):
                 power = ctrl.get_available_power()
         assert power == pytest.approx(1000.0)
@@ -255,7 +258,7 @@ class TestGetAvailablePower:
         """When grid_power is positive (importing), available_power should clamp to 0."""
         ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
         mock_resp = make_mock_response("500", {"unit_of_measurement": "W"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             with patch.object(ctrl, "get_current_tariff_mode", return_value="normal"):
                 power = ctrl.get_available_power()
         assert power == 0.0
@@ -263,14 +266,14 @@ class TestGetAvailablePower:
     def test_converts_kw_to_watts(self, tmp_path):
         ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid_kw"})
         mock_resp = make_mock_response("-2.0", {"unit_of_measurement": "kW"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             with patch.object(ctrl, "get_current_tariff_mode", return_value="normal"):
                 power = ctrl.get_available_power()
         assert power == pytest.approx(2000.0)
 
     def test_returns_zero_on_request_exception(self, tmp_path):
         ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
-        with patch("requests.get", side_effect=Exception("timeout")):
+        with patch("requests.Session.get", side_effect=Exception("timeout")):
             with patch.object(ctrl, "get_current_tariff_mode", return_value="normal"):
                 power = ctrl.get_available_power()
         assert power == 0.0
@@ -286,7 +289,7 @@ class TestGetAvailablePower:
 
         # Grid reports 0W (balanced), but device is on consuming 500W of solar
         mock_resp = make_mock_response("0", {"unit_of_measurement": "W"})
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             with patch.object(ctrl, "get_current_tariff_mode", return_value="normal"):
                 power = ctrl.get_available_power()
         # available = -grid_power + controlled_power = 0 + 500 = 500
@@ -336,7 +339,7 @@ class TestGetBatteryChargingRequirement:
             battery_percent_entity="sensor.batt_pct",
         )
         mock_resp = make_mock_response("80")  # 80% charged
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             result = ctrl.get_battery_charging_requirement(battery=battery)
         # 10kWh * (100 - 80) / 100 = 2kWh needed
         assert result == pytest.approx(2.0)
@@ -345,14 +348,14 @@ class TestGetBatteryChargingRequirement:
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
         mock_resp = make_mock_response("100")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             result = ctrl.get_battery_charging_requirement(battery=battery)
         assert result == pytest.approx(0.0)
 
     def test_returns_none_on_request_error(self, tmp_path):
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
-        with patch("requests.get", side_effect=Exception("timeout")):
+        with patch("requests.Session.get", side_effect=Exception("timeout")):
             result = ctrl.get_battery_charging_requirement(battery=battery)
         assert result is None
 
@@ -371,28 +374,28 @@ class TestIsBatteryFullEnough:
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
         mock_resp = make_mock_response("96")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             assert ctrl.is_battery_full_enough(battery=battery) is True
 
     def test_below_95_percent_is_not_full_enough(self, tmp_path):
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
         mock_resp = make_mock_response("90")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             assert ctrl.is_battery_full_enough(battery=battery) is False
 
     def test_exactly_95_is_not_full_enough(self, tmp_path):
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
         mock_resp = make_mock_response("95")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             # > 95 required, so exactly 95 should be False
             assert ctrl.is_battery_full_enough(battery=battery) is False
 
     def test_returns_true_on_request_error(self, tmp_path):
         ctrl = make_controller(tmp_path)
         battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct")
-        with patch("requests.get", side_effect=Exception("network error")):
+        with patch("requests.Session.get", side_effect=Exception("network error")):
             assert ctrl.is_battery_full_enough(battery=battery) is True
 
 
@@ -472,7 +475,7 @@ class TestGetCurrentTariffMode:
         }
         ctrl = make_controller(tmp_path, config=config)
         mock_resp = make_mock_response("offpeak")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             result = ctrl.get_current_tariff_mode()
         assert result == "cheap"
 
@@ -483,14 +486,14 @@ class TestGetCurrentTariffMode:
         }
         ctrl = make_controller(tmp_path, config=config)
         mock_resp = make_mock_response("unknown_tariff")
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             result = ctrl.get_current_tariff_mode()
         assert result == "normal"
 
     def test_defaults_to_normal_on_request_error(self, tmp_path):
         config = {"tariff_rate": "sensor.tariff"}
         ctrl = make_controller(tmp_path, config=config)
-        with patch("requests.get", side_effect=Exception("timeout")):
+        with patch("requests.Session.get", side_effect=Exception("timeout")):
             result = ctrl.get_current_tariff_mode()
         assert result == "normal"
 
@@ -518,8 +521,8 @@ class TestSetDeviceStateTimerReset:
 
         mock_entity = make_mock_response("16")
         mock_entity.json.return_value["entity_id"] = "number.charger_amps"
-        with patch("requests.get", return_value=mock_entity), \
-             patch("requests.post", return_value=MagicMock(raise_for_status=MagicMock())), \
+        with patch("requests.Session.get", return_value=mock_entity), \
+             patch("requests.Session.post", return_value=MagicMock(raise_for_status=MagicMock())), \
              patch.object(device, "set_state") as mock_set_state:
             ctrl.set_device_state(ds, True, amperage=16.0)
 
@@ -547,6 +550,22 @@ class TestSetDeviceStateTimerReset:
         mock_set_state.assert_not_called()
         assert ds.is_on is True
 
+    def test_min_on_time_runs_on_injected_clock(self, tmp_path):
+        clock = VirtualClock(datetime(2026, 6, 21, 12, 0, tzinfo=timezone.utc))
+        ctrl = make_controller(tmp_path, clock=clock)
+        device = make_device(min_on_time=600)
+        ds = DeviceState(device=device, is_on=False, last_state_change=None)
+        with patch.object(device, "set_state", return_value=True) as mock_set_state:
+            ctrl.set_device_state(ds, True)
+            assert ds.last_state_change == clock.now()
+            clock.advance(599)
+            ctrl.set_device_state(ds, False)
+            assert ds.is_on is True
+            clock.advance(1)
+            ctrl.set_device_state(ds, False)
+        assert ds.is_on is False
+        assert mock_set_state.call_count == 2
+
 
 # ---------------------------------------------------------------------------
 # Bug fix: completion status resets in every control mode
@@ -613,9 +632,31 @@ class TestDeviceStateErrorHandling:
     def test_get_device_state_returns_none_on_error(self, tmp_path):
         ctrl = make_controller(tmp_path)
         device = make_device()
-        with patch("requests.get", side_effect=Exception("timeout")):
+        with patch("requests.Session.get", side_effect=Exception("timeout")):
             assert ctrl.get_device_state_from_hass(device) is None
 
+    def test_min_on_time_ignores_wall_clock_steps(self, tmp_path):
+        class SteppedWallClock(VirtualClock):
+            """Wall time can be stepped (as by NTP) without monotonic time moving."""
+            offset = timedelta()
+
+            def now(self):
+                return super().now() + self.offset
+
+        clock = SteppedWallClock(datetime(2026, 6, 21, 12, 0, tzinfo=timezone.utc))
+        ctrl = make_controller(tmp_path, clock=clock)
+        device = make_device(min_on_time=600)
+        ds = DeviceState(device=device, is_on=False, last_state_change=None)
+        with patch.object(device, "set_state", return_value=True):
+            ctrl.set_device_state(ds, True)
+            clock.offset = timedelta(hours=1)
+            ctrl.set_device_state(ds, False)
+            assert ds.is_on is True
+            clock.offset = -timedelta(hours=1)
+            clock.advance(600)
+            ctrl.set_device_state(ds, False)
+            assert ds.is_on is False
+
     def test_initialize_keeps_state_on_fetch_error(self, tmp_path):
         devices = [make_device().to_dict()]
         ctrl = make_controller(tmp_path, devices=devices)
@@ -773,11 +814,11 @@ class TestCarTariffControl:
             grid_voltage=230.0,
             grid_power=0,
         )
-        devices_to_turn_on = []
+        devices_to_turn_on = AllocationPlan()
         with patch.object(ctrl, "get_current_tariff_mode", return_value="cheap"), \
              patch.object(ctrl, "check_device_completion", return_value=False):
             ctrl._run_tariff_control(230.0, devices_to_turn_on)
-        return devices_to_turn_on
+        return [tuple(entry) for entry in devices_to_turn_on]
 
     def test_car_charges_on_cheap_when_below_target(self, tmp_path):
         ctrl = make_controller(tmp_path)
@@ -819,7 +860,7 @@ class TestEntityStateInterpretation:
     def _state(self, ctrl, raw_state):
         device = make_device(switch_entity="climate.hvac")
         mock_resp = make_mock_response(raw_state)
-        with patch("requests.get", return_value=mock_resp):
+        with patch("requests.Session.get", return_value=mock_resp):
             return ctrl.get_device_state_from_hass(device)
 
     def test_switch_on(self, tmp_path):
@@ -867,7 +908,7 @@ class TestAutoControlHandsOff:
         state = DeviceState(device=make_device(), is_on=True, auto_control=False)
         ctrl.device_states["Test Device"] = state
         with patch.object(ctrl, "set_device_state") as mock_set:
-            ctrl._apply_state_changes([])
+            ctrl._apply_state_changes(AllocationPlan())
         mock_set.assert_not_called()
 
     def test_apply_state_changes_still_commands_managed_devices(self, tmp_path):
@@ -877,7 +918,7 @@ class TestAutoControlHandsOff:
                                 auto_control=False)
         ctrl.device_states = {"Managed": managed, "Manual": hands_off}
         with patch.object(ctrl, "set_device_state") as mock_set:
-            ctrl._apply_state_changes([])
+            ctrl._apply_state_changes(AllocationPlan())
         mock_set.assert_called_once_with(managed, False)
 
     def test_free_mode_skips_hands_off_device(self, tmp_path):
@@ -885,9 +926,9 @@ class TestAutoControlHandsOff:
         self._make_debug_state(ctrl)
         state = DeviceState(device=make_device(), auto_control=False)
         ctrl.device_states["Test Device"] = state
-        devices_to_turn_on = []
+        devices_to_turn_on = AllocationPlan()
         ctrl._run_free_mode(230.0, devices_to_turn_on)
-        assert devices_to_turn_on == []
+        assert len(devices_to_turn_on) == 0
 
     def test_tariff_cheap_mode_skips_hands_off_device(self, tmp_path):
         ctrl = make_controller(tmp_path)
@@ -895,20 +936,147 @@ class TestAutoControlHandsOff:
         state = make_car_state(soc=10.0)  # below floor: would normally charge
         state.auto_control = False
         ctrl.device_states["Car"] = state
-        devices_to_turn_on = []
+        devices_to_turn_on = AllocationPlan()
         with patch.object(ctrl, "get_current_tariff_mode", return_value="cheap"), \
              patch.object(ctrl, "check_device_completion", return_value=False):
             ctrl._run_tariff_control(230.0, devices_to_turn_on)
-        assert devices_to_turn_on == []
+        assert len(devices_to_turn_on) == 0
 
     def test_solar_mode_skips_hands_off_device(self, tmp_path):
         ctrl = make_controller(tmp_path)
         self._make_debug_state(ctrl)
         state = DeviceState(device=make_device(), auto_control=False)
         ctrl.device_states["Test Device"] = state
-        devices_to_turn_on = []
+        devices_to_turn_on = AllocationPlan()
         ctrl._run_solar_control(5000.0, 230.0, devices_to_turn_on)
-        assert devices_to_turn_on == []
+        assert len(devices_to_turn_on) == 0
+
+    def test_solar_mode_allocates_best_combination(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        self._make_debug_state(ctrl)
+        for order, (name, power) in enumerate([("Big", 2000.0), ("A", 1500.0), ("B", 1500.0)]):
+            ctrl.device_states[name] = DeviceState(device=make_device(
+                name=name, switch_entity=f"switch.{name.lower()}", typical_power_draw=power, order=order))
+        devices_to_turn_on = AllocationPlan()
+        ctrl._run_solar_control(3000.0, 230.0, devices_to_turn_on)
+        assert sorted(d.device.name for d, _, _ in devices_to_turn_on) == ["A", "B"]
+        reasons = {d["name"]: d["reason"] for d in ctrl.debug_state.optional_devices}
+        assert reasons["Big"] == "Not enough power available"
+
+    def test_solar_mode_greedy_strategy(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"allocation_strategy": "greedy"})
+        self._make_debug_state(ctrl)
+        for order, (name, power) in enumerate([("Big", 2000.0), ("A", 1500.0), ("B", 1500.0)]):
+            ctrl.device_states[name] = DeviceState(device=make_device(
+                name=name, switch_entity=f"switch.{name.lower()}", typical_power_draw=power, order=order))
+        devices_to_turn_on = AllocationPlan()
+        ctrl._run_solar_control(3000.0, 230.0, devices_to_turn_on)
+        assert [d.device.name for d, _, _ in devices_to_turn_on] == ["Big"]
+
+    def test_solar_mode_shares_current_between_chargers(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        self._make_debug_state(ctrl)
+        for order, name in enumerate(["Charger1", "Charger2"]):
+            ctrl.device_states[name] = DeviceState(device=make_device(
+                name=name, switch_entity=f"switch.{name.lower()}", order=order,
+                has_variable_amperage=True, min_amperage=6.0, max_amperage=16.0,
+                variable_amperage_control=f"number.{name.lower()}_amps"))
+        devices_to_turn_on = AllocationPlan()
+        with patch.object(ctrl, "get_grid_voltage", return_value=230.0), \
+             patch.object(ctrl, "get_amperage_step", return_value=1.0):
+            ctrl._run_solar_control(230.0 * 20, 230.0, devices_to_turn_on)
+        amps = {d.device.name: a for d, _, a in devices_to_turn_on}
+        # Priority-weighted 3:2 split, not 14A for the first and 6A for the second
+        assert amps == {"Charger1": 12, "Charger2": 8}
+
+    def test_apply_state_changes_reduces_before_raising(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        up = DeviceState(device=make_device(name="Up", has_variable_amperage=True, min_amperage=6.0,
+                                            max_amperage=16.0), is_on=True, current_amperage=6.0)
+        down = DeviceState(device=make_device(name="Down", has_variable_amperage=True, min_amperage=6.0,
+                                              max_amperage=16.0), is_on=True, current_amperage=16.0)
+        off = DeviceState(device=make_device(name="Off"), is_on=True)
+        ctrl.device_states = {"Up": up, "Down": down, "Off": off}
+        with patch.object(ctrl, "set_device_state") as mock_set:
+            plan = AllocationPlan()
+            plan.set(up, 2300.0, 10.0)
+            plan.set(down, 2300.0, 10.0)
+            ctrl._apply_state_changes(plan)
+        assert [c.args[0].device.name for c in mock_set.call_args_list] == ["Off", "Down", "Up"]
+
+    def test_apply_state_changes_skips_devices_already_in_state(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        states = {f"D{i}": DeviceState(device=make_device(name=f"D{i}"), is_on=True) for i in range(5)}
+        ctrl.device_states = dict(states)
+        plan = AllocationPlan()
+        for state in states.values():
+            plan.set(state, 1000.0)
+        with patch.object(ctrl, "set_device_state") as mock_set:
+            ctrl._apply_state_changes(plan)
+        mock_set.assert_not_called()
+
+    def test_amperage_write_clamped_to_entity_step_in_one_post(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        state = DeviceState(device=make_device(
+            has_variable_amperage=True, min_amperage=6.0, max_amperage=32.0,
+            variable_amperage_control="number.charger_amps"), is_on=True)
+        ctrl.entity_metadata.observe("number.charger_amps", {
+            "attributes": {"min": 6, "max": 16, "step": 2}})
+        with patch("requests.Session.get") as mock_get, \
+             patch("requests.Session.post", return_value=MagicMock(status_code=200)) as mock_post:
+            ctrl.set_device_state(state, True, 32.0)
+        mock_get.assert_not_called()
+        mock_post.assert_called_once()
+        assert mock_post.call_args.kwargs["json"] == {"entity_id": "number.charger_amps", "value": 16.0}
+        assert state.current_amperage == 16.0
+
+    def test_clamped_amperage_not_rewritten_every_pass(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        state = DeviceState(device=make_device(
+            has_variable_amperage=True, min_amperage=6.0, max_amperage=32.0,
+            variable_amperage_control="number.charger_amps"), is_on=True, current_amperage=16.0)
+        ctrl.device_states = {"Test Device": state}
+        ctrl.entity_metadata.observe("number.charger_amps", {"attributes": {"min": 6, "max": 16}})
+        plan = AllocationPlan()
+        plan.set(state, 7360.0, 32.0)
+        with patch.object(ctrl, "set_device_state") as mock_set:
+            ctrl._apply_state_changes(plan)
+        mock_set.assert_not_called()
+
+    def test_apply_state_changes_actuates_devices_concurrently(self, tmp_path):
+        import time as time_module
+        ctrl = make_controller(tmp_path)
+        self._make_debug_state(ctrl)
+        states = {f"D{i}": DeviceState(device=make_device(name=f"D{i}")) for i in range(4)}
+        ctrl.device_states = dict(states)
+        plan = AllocationPlan()
+        for state in states.values():
+            plan.set(state, 1000.0)
+
+        def slow_switch(device_state, turn_on, amperage=None):
+            time_module.sleep(0.2)
+            device_state.is_on = turn_on
+
+        with patch.object(ctrl, "set_device_state", side_effect=slow_switch):
+            started = time_module.monotonic()
+            ctrl._apply_state_changes(plan)
+            elapsed = time_module.monotonic() - started
+        assert elapsed < 0.6  # about one round trip, not four
+        results = {r["name"]: r for r in ctrl.debug_state.actuation}
+        assert set(results) == set(states)
+        assert all(r["ok"] and r["turn_on"] is True for r in results.values())
+
+    def test_failed_command_reported(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        self._make_debug_state(ctrl)
+        state = DeviceState(device=make_device())
+        ctrl.device_states = {"Test Device": state}
+        plan = AllocationPlan()
+        plan.set(state, 1000.0)
+        with patch.object(ctrl, "set_device_state"):  # state never changes
+            ctrl._apply_state_changes(plan)
+        assert ctrl.debug_state.actuation[0]["ok"] is False
+        assert ctrl.debug_state.to_dict()["actuation"][0]["name"] == "Test Device"
 
     def test_car_floor_does_not_fire_when_hands_off(self, tmp_path):
         """Hands-off wins over the car protection floor."""
@@ -937,10 +1105,461 @@ class TestAutoControlHandsOff:
                                 auto_control=False)
         ctrl.device_states = {"Managed": managed, "Manual": hands_off}
         mock_resp = make_mock_response("0", {"unit_of_measurement": "W"})
-        with patch("requests.get", return_value=mock_resp), \
+        with patch("requests.Session.get", return_value=mock_resp), \
              patch.object(ctrl, "get_current_tariff_mode", return_value="normal"), \
              patch.object(ctrl, "get_device_power", return_value=1000.0) as mock_power:
             power = ctrl.get_available_power()
         # Only the managed device's 1000W is added back (grid reads 0W)
         assert power == pytest.approx(1000.0)
         mock_power.assert_called_once_with(managed)
+
+
+# ---------------------------------------------------------------------------
+# Per-iteration entity snapshot
+# ---------------------------------------------------------------------------
+
+class TestEntitySnapshotReads:
+    def _snapshot(self, states):
+        from entity_snapshot import EntitySnapshot
+        return EntitySnapshot({s["entity_id"]: s for s in states})
+
+    def test_getters_read_from_snapshot_without_requests(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={
+            "grid_power": "sensor.grid",
+            "grid_voltage": "sensor.voltage",
+            "tariff_rate": "select.tariff",
+            "tariff_modes": {"offpeak": "cheap"},
+        })
+        ctrl._snapshot = self._snapshot([
+            {"entity_id": "sensor.grid", "state": "-1.2", "attributes": {"unit_of_measurement": "kW"}},
+            {"entity_id": "sensor.voltage", "state": "241", "attributes": {}},
+            {"entity_id": "select.tariff", "state": "offpeak", "attributes": {}},
+            {"entity_id": "switch.test", "state": "on", "attributes": {}},
+        ])
+        with patch("requests.Session.get", side_effect=AssertionError("unexpected GET")):
+            assert ctrl.get_grid_power() == pytest.approx(-1200.0)
+            assert ctrl.get_grid_voltage() == 241.0
+            assert ctrl.get_current_tariff_mode() == "cheap"
+            assert ctrl.get_device_state_from_hass(make_device()) is True
+
+    def test_entity_missing_from_snapshot_uses_fallback(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path, config={"grid_voltage": "sensor.voltage"})
+        ctrl._snapshot = EntitySnapshot({}, requested={"sensor.voltage"})
+        with patch("requests.Session.get", side_effect=AssertionError("unexpected GET")):
+            assert ctrl.get_grid_voltage() == 230.0
+
+    def test_uncovered_entity_falls_back_to_single_get(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        ctrl._snapshot = self._snapshot([])
+        with patch("requests.Session.get", return_value=make_mock_response("on")) as mock_get:
+            assert ctrl.get_device_state_from_hass(make_device()) is True
+        mock_get.assert_called_once()
+
+    def test_snapshot_cleared_after_iteration(self, tmp_path):
+        ctrl = make_controller(tmp_path)
+        with patch.object(ctrl, "take_entity_snapshot", return_value=self._snapshot([])), \
+             patch.object(ctrl, "initialize_device_states", side_effect=Exception("boom")):
+            ctrl._run_control_loop_iteration()
+        assert ctrl._snapshot is None
+
+    def test_snapshot_taken_from_live_mirror_without_requests(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        mirror = MagicMock()
+        mirror.covers.return_value = True
+        mirror.snapshot.return_value = {"sensor.grid": {"entity_id": "sensor.grid", "state": "-800"}}
+        ctrl.state_mirror = mirror
+        with patch("requests.Session.get", side_effect=AssertionError("unexpected GET")):
+            snapshot = ctrl.take_entity_snapshot()
+        mirror.set_entities.assert_called_once_with({"sun.sun", "sensor.grid"})
+        assert snapshot.get("sensor.grid")["state"] == "-800"
+        assert snapshot.covers("sun.sun") and snapshot.get("sun.sun") is None
+
+    def test_rest_only_pass_ignores_live_mirror(self, tmp_path):
+        """Recording a cassette needs every read on the wire."""
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        mirror = MagicMock()
+        mirror.covers.return_value = True
+        ctrl.state_mirror = mirror
+        bulk = MagicMock(status_code=200)
+        bulk.json.return_value = [{"entity_id": "sensor.grid", "state": "-800"}]
+        ctrl._rest_only = True
+        with patch("requests.Session.get", return_value=bulk) as mock_get:
+            snapshot = ctrl.take_entity_snapshot()
+        mock_get.assert_called_once()
+        mirror.snapshot.assert_not_called()
+        assert snapshot.get("sensor.grid")["state"] == "-800"
+
+
+# ---------------------------------------------------------------------------
+# Concurrent data gathering
+# ---------------------------------------------------------------------------
+
+class TestGatherInputs:
+    def test_bulk_failure_falls_back_to_concurrent_per_entity_reads(self, tmp_path):
+        import asyncio
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid",
+                                                 "grid_voltage": "sensor.voltage"})
+        responses = {
+            "http://test-hass/api/states/sensor.grid": make_mock_response("-500"),
+            "http://test-hass/api/states/sensor.voltage": make_mock_response("240"),
+        }
+
+        def fake_get(url, **kwargs):
+            if url not in responses:
+                raise ConnectionError("unreachable")
+            return responses[url]
+
+        with patch("requests.Session.get", side_effect=fake_get):
+            asyncio.run(ctrl._gather_inputs())
+        assert ctrl._snapshot.get("sensor.grid")["state"] == "-500"
+        assert ctrl._snapshot.get("sensor.voltage")["state"] == "240"
+        # sun.sun failed: covered but unavailable, so getters use their fallback
+        assert ctrl._snapshot.covers("sun.sun") and ctrl._snapshot.get("sun.sun") is None
+
+    def test_energy_updates_run_concurrently(self, tmp_path):
+        import asyncio
+        import threading
+        devices = [make_device(name=f"D{i}", switch_entity=f"switch.d{i}",
+                               energy_sensor=f"sensor.d{i}_energy") for i in range(3)]
+        ctrl = make_controller(tmp_path)
+        ctrl.device_states = {d.name: DeviceState(device=d) for d in devices}
+        ctrl._snapshot = None
+        # Every update waits for all three to be in flight at once
+        barrier = threading.Barrier(3, timeout=5)
+        with patch.object(Device, "update_energy_delivered",
+                          autospec=True, side_effect=lambda *a: barrier.wait()) as mock_update:
+            asyncio.run(ctrl._update_energy_tracking())
+        assert mock_update.call_count == 3
+
+
+# ---------------------------------------------------------------------------
+# HA request accounting
+# ---------------------------------------------------------------------------
+
+class TestPassRequestBudget:
+    def test_pass_stays_within_request_budget(self, tmp_path, assert_request_budget):
+        config = {"grid_power": "sensor.grid", "grid_voltage": "sensor.voltage",
+                  "tariff_rate": "select.tariff", "tariff_modes": {"peak": "normal"}}
+        devices = [{"name": f"Heater {i}", "switch_entity": f"switch.heater_{i}",
+                    "typical_power_draw": 1000.0} for i in range(5)]
+        ctrl = make_controller(tmp_path, config=config, devices=devices)
+        states = [{"entity_id": "sensor.grid", "state": "-3500", "attributes": {"unit_of_measurement": "W"}},
+                  {"entity_id": "sensor.voltage", "state": "230", "attributes": {}},
+                  {"entity_id": "select.tariff", "state": "peak", "attributes": {}},
+                  {"entity_id": "sun.sun", "state": "above_horizon", "attributes": {}}]
+        states += [{"entity_id": f"switch.heater_{i}", "state": "off", "attributes": {}} for i in range(5)]
+        bulk = MagicMock(status_code=200)
+        bulk.json.return_value = states
+        with patch("requests.Session.get", return_value=bulk), \
+             patch("requests.Session.post", return_value=make_mock_response("ok")):
+            ctrl._run_control_loop_iteration()
+
+        summary = ctrl.debug_state.to_dict()["ha_requests"]
+        assert summary["by_endpoint"]["/api/states"]["count"] == 1
+        assert summary["by_endpoint"]["/api/services/switch/turn_on"]["count"] == 3
+        assert_request_budget(ctrl.last_pass_requests, max_calls=4)
+        assert_request_budget(ctrl.last_pass_requests, max_calls=0, endpoint="/api/states/{entity_id}")
+
+
+class TestPassMetrics:
+    def test_pass_exports_allocation_and_timings(self, tmp_path):
+        import metrics
+        from solar_controller import COMMANDS, LOOP_SECONDS, PHASE_SECONDS
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid", "grid_voltage_fixed": 230},
+                               devices=[{"name": "Heater", "switch_entity": "switch.heater",
+                                         "typical_power_draw": 1000.0},
+                                        {"name": "Car", "switch_entity": "switch.car",
+                                         "typical_power_draw": 2300.0, "has_variable_amperage": True,
+                                         "min_amperage": 6, "max_amperage": 16,
+                                         "variable_amperage_control": "number.car_amps"}])
+        states = [{"entity_id": "sensor.grid", "state": "-1200", "attributes": {"unit_of_measurement": "W"}},
+                  {"entity_id": "sun.sun", "state": "above_horizon", "attributes": {}},
+                  {"entity_id": "switch.heater", "state": "off", "attributes": {}},
+                  {"entity_id": "switch.car", "state": "off", "attributes": {}},
+                  {"entity_id": "number.car_amps", "state": "6", "attributes": {}}]
+        bulk = MagicMock(status_code=200)
+        bulk.json.return_value = states
+        loops, actuations = LOOP_SECONDS.count(), PHASE_SECONDS.count(phase="actuation")
+        commands_ok = COMMANDS.value(result="ok")
+        with patch("requests.Session.get", return_value=bulk), \
+             patch("requests.Session.post", return_value=make_mock_response("ok")):
+            ctrl._run_control_loop_iteration()
+
+        assert LOOP_SECONDS.count() == loops + 1
+        assert PHASE_SECONDS.count(phase="actuation") == actuations + 1
+        assert COMMANDS.value(result="ok") == commands_ok + 1
+        text = metrics.REGISTRY.render()
+        assert 'solar_control_device_allocated_power_watts{device="Heater"} 1000' in text
+        assert 'solar_control_device_allocated_power_watts{device="Car"} 0' in text
+        assert 'solar_control_device_allocated_amperage_amps{device="Car"} 0' in text
+        assert "solar_control_available_power_watts 1200" in text
+        assert 'solar_control_ha_requests_total{endpoint="/api/states",result="ok"}' in text
+        assert "process_resident_memory_bytes" in text
+
+    def test_phase_timings_on_debug_state(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path, devices=[{"name": "Heater", "switch_entity": "switch.heater",
+                                                   "typical_power_draw": 1000.0}])
+        snapshot = EntitySnapshot({"switch.heater": {"entity_id": "switch.heater", "state": "off"},
+                                   "sun.sun": {"entity_id": "sun.sun", "state": "above_horizon"}})
+        with patch.object(ctrl, "take_entity_snapshot", return_value=snapshot), \
+             patch.object(ctrl, "_apply_state_changes"):
+            ctrl._run_control_loop_iteration()
+        timings = ctrl.debug_state.to_dict()["timings"]
+        phases = [phase["name"] for phase in timings["children"]]
+        assert phases == ["state_sync", "device_states", "car_refresh", "energy", "environment",
+                          "mode_selection", "mandatory", "allocation", "actuation"]
+        assert all("children" not in phase for phase in timings["children"])
+        assert ctrl._timings is NULL_SPAN
+
+    def test_detailed_timings_per_device(self, tmp_path, tmp_data_dir):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path, devices=[{"name": "Heater", "switch_entity": "switch.heater",
+                                                   "typical_power_draw": 1000.0}])
+        with open(ctrl.settings_file, "w") as f:
+            json.dump({"detailed_timings": True}, f)
+        snapshot = EntitySnapshot({"switch.heater": {"entity_id": "switch.heater", "state": "off"},
+                                   "sun.sun": {"entity_id": "sun.sun", "state": "above_horizon"}})
+        with patch.object(ctrl, "take_entity_snapshot", return_value=snapshot), \
+             patch.object(ctrl, "_apply_state_changes"):
+            ctrl._run_control_loop_iteration()
+        mandatory = next(phase for phase in ctrl.debug_state.timings["children"] if phase["name"] == "mandatory")
+        assert [child["name"] for child in mandatory["children"]] == ["Heater"]
+
+    def test_lock_skip_counted(self, tmp_path):
+        from solar_controller import LOOP_SKIPS
+        ctrl = make_controller(tmp_path)
+        skips = LOOP_SKIPS.value()
+        ctrl._loop_lock.acquire()
+        try:
+            ctrl.run_control_loop()
+        finally:
+            ctrl._loop_lock.release()
+        assert LOOP_SKIPS.value() == skips + 1
+
+
+# ---------------------------------------------------------------------------
+# Degraded mode: HA slow or unreachable
+# ---------------------------------------------------------------------------
+
+class TestDegradedMode:
+    def _run_with_grid_unreadable(self, ctrl):
+        from entity_snapshot import EntitySnapshot
+        snapshot = EntitySnapshot({"sun.sun": {"entity_id": "sun.sun", "state": "above_horizon"}},
+                                  requested={"sensor.grid", "sun.sun"}, failed={"sensor.grid"})
+        with patch.object(ctrl, "take_entity_snapshot", return_value=snapshot), \
+             patch.object(ctrl, "initialize_device_states"), \
+             patch.object(ctrl, "refresh_car_states"), \
+             patch.object(ctrl, "_apply_state_changes") as mock_apply:
+            ctrl._run_control_loop_iteration()
+        return mock_apply
+
+    def test_unreachable_entity_served_from_last_good_state(self, tmp_path):
+        import requests
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        with patch("requests.Session.get", return_value=make_mock_response("-900")):
+            assert ctrl.get_grid_power() == -900.0
+        with patch("requests.Session.get", side_effect=requests.exceptions.ConnectionError("down")):
+            assert ctrl.get_grid_power() == -900.0
+        assert ctrl.is_degraded
+        assert not ctrl._inputs_missing
+
+    def test_missing_entity_is_not_served_stale(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_voltage": "sensor.voltage"})
+        ctrl._last_good.remember("sensor.voltage", {"state": "245"})
+        import requests
+        response = make_mock_response("", status_code=404)
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=response)
+        with patch("requests.Session.get", return_value=response):
+            assert ctrl.get_grid_voltage() == 230.0
+        assert not ctrl.is_degraded
+
+    def test_no_reads_after_loop_deadline(self, tmp_path):
+        import time
+        ctrl = make_controller(tmp_path, config={"grid_voltage": "sensor.voltage"})
+        ctrl._last_good.remember("sensor.voltage", {"state": "245"})
+        ctrl._deadline = time.monotonic() - 1
+        with patch("requests.Session.get", side_effect=AssertionError("unexpected GET")):
+            assert ctrl.get_grid_voltage() == 245.0
+        assert ctrl.is_degraded
+
+    def test_actuation_held_when_input_has_no_usable_value(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        mock_apply = self._run_with_grid_unreadable(ctrl)
+        mock_apply.assert_not_called()
+        assert ctrl.debug_state.degraded and ctrl.debug_state.actuation_held
+        assert ctrl.debug_state.to_dict()["degraded_reasons"][0].startswith("sensor.grid unavailable")
+
+    def test_stale_input_still_actuates(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        ctrl._last_good.remember("sensor.grid", {"state": "-1500"})
+        mock_apply = self._run_with_grid_unreadable(ctrl)
+        mock_apply.assert_called_once()
+        assert ctrl.debug_state.grid_power == -1500.0
+        assert ctrl.debug_state.degraded and not ctrl.debug_state.actuation_held
+
+    def test_open_circuit_holds_actuation(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path)
+        for _ in range(ctrl.hass.breaker.threshold):
+            ctrl.hass.breaker.record(True)
+        with patch.object(ctrl, "take_entity_snapshot", return_value=EntitySnapshot({})), \
+             patch.object(ctrl, "initialize_device_states"), \
+             patch.object(ctrl, "refresh_car_states"), \
+             patch.object(ctrl, "_apply_state_changes") as mock_apply:
+            ctrl._run_control_loop_iteration()
+        mock_apply.assert_not_called()
+        assert ctrl.debug_state.actuation_held
+
+
+# ---------------------------------------------------------------------------
+# Per-iteration evaluation context
+# ---------------------------------------------------------------------------
+
+class TestIterationContext:
+    def test_tariff_and_sun_evaluated_once_per_iteration(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path, config={
+            "tariff_rate": "select.tariff",
+            "tariff_modes": {"offpeak": "cheap"},
+            "grid_voltage_fixed": 240,
+        })
+        just_now = datetime.now(timezone.utc)
+        for i in range(3):
+            device = make_device(name=f"EV{i}", switch_entity=f"switch.ev{i}",
+                                 has_variable_amperage=True, min_amperage=6.0,
+                                 max_amperage=32.0, min_on_time=600,
+                                 variable_amperage_control=f"number.ev{i}")
+            ctrl.device_states[device.name] = DeviceState(
+                device=device, is_on=True, last_state_change=just_now, current_amperage=10.0)
+        snapshot = EntitySnapshot({
+            "select.tariff": {"entity_id": "select.tariff", "state": "offpeak"},
+            "sun.sun": {"entity_id": "sun.sun", "state": "below_horizon"},
+        })
+        reads = []
+        real_get_entity_state = ctrl.get_entity_state
+
+        def counting_get_entity_state(entity_id):
+            reads.append(entity_id)
+            return real_get_entity_state(entity_id)
+
+        with patch.object(ctrl, "take_entity_snapshot", return_value=snapshot), \
+             patch.object(ctrl, "initialize_device_states"), \
+             patch.object(ctrl, "refresh_car_states"), \
+             patch.object(ctrl, "check_device_completion", return_value=False), \
+             patch.object(ctrl, "get_entity_state", side_effect=counting_get_entity_state), \
+             patch.object(ctrl, "_apply_state_changes"):
+            ctrl._run_control_loop_iteration()
+
+        assert reads.count("select.tariff") == 1
+        assert ctrl.debug_state.tariff_mode == "cheap"
+        assert ctrl.debug_state.is_daylight is False
+        assert ctrl.debug_state.control_mode == "tariff"
+        assert ctrl._context is None
+
+    def test_battery_soc_read_once_per_iteration(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path, config={"solar_forecast": "sensor.forecast"})
+        battery = Battery(size_kwh=10.0, battery_percent_entity="sensor.batt_pct",
+                          max_charging_speed_kw=5.0, expected_kwh_per_hour=0.5,
+                          bring_forward_mode=True)
+        snapshot = EntitySnapshot({
+            "sensor.batt_pct": {"entity_id": "sensor.batt_pct", "state": "80"},
+            "sensor.forecast": {"entity_id": "sensor.forecast", "state": "12",
+                                "attributes": {"unit_of_measurement": "kWh"}},
+            "sun.sun": {"entity_id": "sun.sun", "state": "above_horizon",
+                        "attributes": {"next_setting": (datetime.now(timezone.utc)
+                                                        + timedelta(hours=4)).isoformat()}},
+        })
+        reads = []
+        real_get_entity_state = ctrl.get_entity_state
+
+        def counting_get_entity_state(entity_id):
+            reads.append(entity_id)
+            return real_get_entity_state(entity_id)
+
+        with patch("battery.Battery.load", return_value=battery), \
+             patch.object(ctrl, "take_entity_snapshot", return_value=snapshot), \
+             patch.object(ctrl, "initialize_device_states"), \
+             patch.object(ctrl, "refresh_car_states"), \
+             patch.object(ctrl, "get_entity_state", side_effect=counting_get_entity_state), \
+             patch.object(ctrl, "_apply_state_changes"):
+            ctrl._run_control_loop_iteration()
+
+        assert reads.count("sensor.batt_pct") == 1
+        assert reads.count("sensor.forecast") == 1
+        # 12 - (0.5 * ~4h + 2kWh) = ~8kWh expected; bring forward 0.6 * 0.8 * 5kW
+        assert ctrl.debug_state.expected_energy_remaining == pytest.approx(8.0, abs=0.01)
+        assert ctrl.debug_state.bring_forward_power == pytest.approx(2400.0, abs=5)
+        assert ctrl.debug_state.control_mode == "solar"
+
+
+# ---------------------------------------------------------------------------
+# Event-driven scheduling
+# ---------------------------------------------------------------------------
+
+class TestGridChangeTrigger:
+    def test_large_grid_change_wakes_loop(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        ctrl._last_run_grid_power = -2000.0
+        ctrl.on_grid_power(-1800.0)
+        assert not ctrl._wake.is_set()
+        ctrl.on_grid_power(-1500.0)  # kettle on: 500W less export
+        assert ctrl._wake.is_set()
+
+    def test_configured_delta_and_disable(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid",
+                                                 "grid_trigger_delta": 1000})
+        ctrl._last_run_grid_power = 0.0
+        ctrl.on_grid_power(800.0)
+        assert not ctrl._wake.is_set()
+        ctrl.update_config({"grid_trigger_delta": 0})
+        assert ctrl.grid_trigger_delta() is None
+        ctrl.on_grid_power(5000.0)
+        assert not ctrl._wake.is_set()
+
+    def test_no_trigger_before_first_pass(self, tmp_path):
+        ctrl = make_controller(tmp_path, config={"grid_power": "sensor.grid"})
+        ctrl.on_grid_power(5000.0)
+        assert not ctrl._wake.is_set()
+
+    def test_mirror_listener_only_watches_grid_entity(self, tmp_path):
+        mirror = MagicMock()
+        config_file = str(tmp_path / "solar_config.json")
+        with open(config_file, "w") as f:
+            json.dump({"grid_power": "sensor.grid"}, f)
+        ctrl = SolarController(config_file=config_file, devices_file=str(tmp_path / "d.json"),
+                               state_mirror=mirror)
+        listener = mirror.add_listener.call_args[0][0]
+        ctrl._last_run_grid_power = 0.0
+        listener("sensor.other", {"state": "9000"})
+        assert not ctrl._wake.is_set()
+        listener("sensor.grid", {"state": "1.2", "attributes": {"unit_of_measurement": "kW"}})
+        assert ctrl._wake.is_set()
+
+    def test_early_run_respects_min_interval(self, tmp_path):
+        import solar_controller
+        ctrl = make_controller(tmp_path)
+        ctrl._wake.set()
+        with patch.object(solar_controller.time, "sleep") as mock_sleep, \
+             patch.object(solar_controller.time, "monotonic", return_value=1002.0):
+            trigger = ctrl._wait_for_next_run(last_start=1000.0)
+        assert trigger == "grid change"
+        slept = sum(call.args[0] for call in mock_sleep.call_args_list)
+        assert slept == pytest.approx(solar_controller.TRIGGER_DEBOUNCE
+                                      + solar_controller.MIN_LOOP_INTERVAL - 2.0)
+
+    def test_trigger_recorded_in_debug_state(self, tmp_path):
+        from entity_snapshot import EntitySnapshot
+        ctrl = make_controller(tmp_path)
+        with patch.object(ctrl, "take_entity_snapshot", return_value=EntitySnapshot({})), \
+             patch.object(ctrl, "initialize_device_states"), \
+             patch.object(ctrl, "refresh_car_states"), \
+             patch.object(ctrl, "get_grid_power", return_value=-750.0), \
+             patch.object(ctrl, "get_current_tariff_mode", return_value="normal"), \
+             patch.object(ctrl, "is_between_dawn_and_dusk", return_value=False), \
+             patch.object(ctrl, "_apply_state_changes"):
+            ctrl.run_control_loop("grid change")
+        assert ctrl.debug_state.trigger == "grid change"
+        assert ctrl._last_run_grid_power == -750.0
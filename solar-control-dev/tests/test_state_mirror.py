@@ -0,0 +1,93 @@
+"""Tests for state_mirror.py"""
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from state_mirror import StateMirror, websocket_url
+
+
+def make_live_mirror(entity_ids, states):
+    """Return a mirror that looks connected and has completed its initial sync."""
+    mirror = StateMirror("http://supervisor/core", "token")
+    mirror.set_entities(entity_ids)
+    mirror._ws = MagicMock()
+    mirror._get_states_id = 7
+    mirror.handle_message({"id": 7, "type": "result", "success": True, "result": states})
+    return mirror
+
+
+def state_changed(entity_id, new_state):
+    return {
+        "type": "event",
+        "event": {"event_type": "state_changed",
+                  "data": {"entity_id": entity_id, "new_state": new_state}},
+    }
+
+
+class TestWebsocketUrl:
+    def test_supervisor_url(self):
+        assert websocket_url("http://supervisor/core") == "ws://supervisor/core/websocket"
+
+    def test_https_url(self):
+        assert websocket_url("https://ha.example.com/") == "wss://ha.example.com/websocket"
+
+
+class TestStateMirror:
+    def test_not_live_before_connect(self):
+        mirror = StateMirror("http://supervisor/core", "token")
+        mirror.set_entities({"sensor.grid"})
+        assert mirror.is_live is False
+        assert mirror.get("sensor.grid") is None
+
+    def test_initial_sync_keeps_only_tracked_entities(self):
+        mirror = make_live_mirror({"sensor.grid"}, [
+            {"entity_id": "sensor.grid", "state": "-300"},
+            {"entity_id": "sensor.other", "state": "1"},
+        ])
+        assert mirror.is_live
+        assert mirror.get("sensor.grid")["state"] == "-300"
+        assert mirror.get("sensor.other") is None
+
+    def test_state_changed_updates_mirror_and_notifies(self):
+        mirror = make_live_mirror({"sensor.grid"}, [{"entity_id": "sensor.grid", "state": "0"}])
+        seen = []
+        mirror.add_listener(lambda entity_id, state: seen.append((entity_id, state["state"])))
+        mirror.handle_message(state_changed("sensor.grid", {"entity_id": "sensor.grid", "state": "250"}))
+        mirror.handle_message(state_changed("sensor.other", {"entity_id": "sensor.other", "state": "9"}))
+        assert mirror.get("sensor.grid")["state"] == "250"
+        assert seen == [("sensor.grid", "250")]
+
+    def test_registry_update_notifies_registry_listeners(self):
+        mirror = make_live_mirror({"sensor.grid"}, [{"entity_id": "sensor.grid", "state": "0"}])
+        changed, states = [], []
+        mirror.add_registry_listener(changed.append)
+        mirror.add_listener(lambda entity_id, state: states.append(entity_id))
+        mirror.handle_message({"type": "event", "event": {
+            "event_type": "entity_registry_updated",
+            "data": {"action": "update", "entity_id": "number.charger_amps"}}})
+        assert changed == ["number.charger_amps"]
+        assert states == []
+
+    def test_removed_entity_is_dropped(self):
+        mirror = make_live_mirror({"sensor.grid"}, [{"entity_id": "sensor.grid", "state": "0"}])
+        mirror.handle_message(state_changed("sensor.grid", None))
+        assert mirror.get("sensor.grid") is None
+
+    def test_new_entity_requires_resync_before_covering(self):
+        mirror = make_live_mirror({"sensor.grid"}, [{"entity_id": "sensor.grid", "state": "0"}])
+        assert mirror.covers({"sensor.grid"})
+        mirror.set_entities({"sensor.grid", "sensor.voltage"})
+        assert not mirror.covers({"sensor.grid", "sensor.voltage"})
+        mirror._ws.send.assert_called()  # get_states re-requested
+        mirror.handle_message({"id": mirror._get_states_id, "type": "result", "success": True,
+                               "result": [{"entity_id": "sensor.grid", "state": "0"},
+                                          {"entity_id": "sensor.voltage", "state": "240"}]})
+        assert mirror.covers({"sensor.grid", "sensor.voltage"})
+        assert mirror.get("sensor.voltage")["state"] == "240"
+
+    def test_stale_get_states_result_ignored(self):
+        mirror = make_live_mirror({"sensor.grid"}, [{"entity_id": "sensor.grid", "state": "0"}])
+        mirror.handle_message({"id": 1, "type": "result", "success": True,
+                               "result": [{"entity_id": "sensor.grid", "state": "999"}]})
+        assert mirror.get("sensor.grid")["state"] == "0"
@@ -0,0 +1,85 @@
+"""Tests for sun.py"""
+
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+import sun
+from sun import SunCalculator
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def assert_close(actual, expected, minutes=2):
+    assert abs((actual - expected).total_seconds()) <= minutes * 60, f"{actual} != {expected}"
+
+
+class TestSunTimes:
+    def test_london_midsummer(self):
+        times = SunCalculator(51.5074, -0.1278).times_for(date(2024, 6, 21))
+        # 04:43 / 21:21 BST
+        assert_close(times.sunrise, utc(2024, 6, 21, 3, 43))
+        assert_close(times.sunset, utc(2024, 6, 21, 20, 21))
+        assert times.dawn < times.sunrise < times.sunset < times.dusk
+
+    def test_sydney_across_utc_midnight(self):
+        calc = SunCalculator(-33.8688, 151.2093)
+        # Solar noon falls on the 20th UTC; sunrise 05:40 AEDT is 18:40 UTC on the 19th
+        times = calc.times_for(date(2024, 12, 20))
+        assert_close(times.sunrise, utc(2024, 12, 19, 18, 40))
+        assert_close(times.sunset, utc(2024, 12, 20, 9, 5))
+
+    def test_polar_day_has_no_sunset(self):
+        calc = SunCalculator(69.65, 18.96)  # Tromsø
+        times = calc.times_for(date(2024, 6, 21))
+        assert times.sunrise is None and times.sunset is None
+        assert calc.is_above_horizon(utc(2024, 6, 21, 23, 0))
+
+    def test_times_cached_per_day(self):
+        calc = SunCalculator(51.5, 0.0)
+        assert calc.times_for(date(2024, 1, 1)) is calc.times_for(date(2024, 1, 1))
+
+
+class TestSunQueries:
+    calc = SunCalculator(51.5074, -0.1278)
+
+    def test_last_sunrise_before_midnight_is_today(self):
+        assert_close(self.calc.last_sunrise(utc(2024, 6, 21, 22, 0)), utc(2024, 6, 21, 3, 43))
+
+    def test_last_sunrise_after_midnight_is_yesterday(self):
+        assert_close(self.calc.last_sunrise(utc(2024, 6, 22, 1, 0)), utc(2024, 6, 21, 3, 43))
+
+    def test_next_sunset_after_sunset_is_tomorrow(self):
+        assert self.calc.next_sunset(utc(2024, 6, 21, 21, 0)).date() == date(2024, 6, 22)
+
+    def test_above_horizon(self):
+        assert self.calc.is_above_horizon(utc(2024, 6, 21, 12, 0))
+        assert not self.calc.is_above_horizon(utc(2024, 6, 21, 23, 30))
+
+
+class TestLocation:
+    @pytest.fixture(autouse=True)
+    def reset_module_state(self, monkeypatch):
+        monkeypatch.setattr(sun, "_calculator", None)
+        monkeypatch.setattr(sun, "_enabled", False)
+        monkeypatch.setattr(sun, "_last_attempt", 0.0)
+
+    def test_disabled_until_initialised(self):
+        assert sun.get_sun() is None
+
+    def test_init_reads_location_from_ha_config(self):
+        client = MagicMock()
+        client.get.return_value.json.return_value = {"latitude": 51.5, "longitude": -0.1}
+        calc = sun.init_location(client)
+        client.get.assert_called_once_with("/api/config")
+        assert sun.get_sun() is calc
+        assert (calc.latitude, calc.longitude) == (51.5, -0.1)
+
+    def test_failed_init_falls_back(self):
+        client = MagicMock()
+        client.get.side_effect = ConnectionError("HA not ready")
+        assert sun.init_location(client) is None
+        assert sun.get_sun() is None  # retried only after LOCATION_RETRY_INTERVAL
@@ -0,0 +1,45 @@
+"""Tests for timing.py"""
+
+import threading
+
+from timing import NULL_SPAN, Span
+
+
+class TestSpan:
+    def test_nested_spans_recorded(self):
+        root = Span("pass", detailed=True)
+        with root:
+            with root.span("mandatory") as phase:
+                with phase.detail("Heater"):
+                    pass
+        result = root.to_dict()
+        assert result["name"] == "pass" and result["ms"] >= 0
+        assert result["children"][0]["name"] == "mandatory"
+        assert result["children"][0]["children"] == [{"name": "Heater", "ms": result["children"][0]["children"][0]["ms"]}]
+
+    def test_detail_is_noop_unless_detailed(self):
+        root = Span("pass")
+        with root:
+            with root.span("mandatory") as phase:
+                assert phase.detail("Heater") is NULL_SPAN
+        assert "children" not in root.to_dict()["children"][0]
+
+    def test_null_span(self):
+        with NULL_SPAN.span("a") as span:
+            with span.detail("b"):
+                pass
+        assert NULL_SPAN.to_dict() is None
+
+    def test_children_from_threads(self):
+        root = Span("energy", detailed=True)
+
+        def work(name):
+            with root.detail(name):
+                pass
+
+        threads = [threading.Thread(target=work, args=(f"d{i}",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(child.name for child in root.children) == [f"d{i}" for i in range(8)]